@@ -0,0 +1,165 @@
+"""
+Load test: many AsyncChatClients in one process against server_new.
+
+Without --host, runs server_new in a child process. Measures:
+
+  - connect: all clients logged in, `--concurrency` at a time
+  - memory: Python heap per logged in client, on the client side
+  - chat: `--senders` clients send `--rate` messages per second each
+    for `--duration` seconds, every client receives every message;
+    delivered messages per second and send-to-receive latency, p50
+    and p99
+
+    python benchmarks/chat_load.py
+    python benchmarks/chat_load.py --clients 300 --senders 5 --rate 20
+    python benchmarks/chat_load.py --host 192.168.0.125 --port 1234
+    python benchmarks/chat_load.py --clients 2000 --no-compression
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server_new  # noqa: E402
+from net import SUPPORTED_CODECS, AsyncChatClient, RateLimits  # noqa: E402
+
+
+def start_server(port, workdir):
+    server_new.HOST = "127.0.0.1"
+    server_new.PORT = port
+    server_new.LISTENER_LIMIT = 1024
+    server_new.METRICS_PORT = None
+    server_new.LOG_FILE = None
+    server_new.MAILBOX_FILE = None
+    server_new.STATE_DIR = None
+    server_new.DISCOVERY_BEACONS = False
+    server_new.RECV_DIR = os.path.join(workdir, "received")
+    server_new.RATE_LIMITS = RateLimits(1e9, 1e9, 1e12, 1e12, 1e12, 1e12)
+    pid = os.fork()
+    if pid == 0:
+        import logging
+        logging.disable(logging.CRITICAL)
+        try:
+            server_new.main()
+        finally:
+            os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+
+class LoadClient(AsyncChatClient):
+    """Counts what it receives, the text carries the send time."""
+
+    def __init__(self, latencies, codecs):
+        super().__init__(codecs=codecs)
+        self.latencies = latencies
+        self.count = 0
+
+    def on_message(self, sender, text, private, body):
+        self.count += 1
+        if text.startswith("t="):
+            self.latencies.append(time.perf_counter() - float(text[2:].split(" ", 1)[0]))
+
+
+async def send_for(client, rate, duration, padding):
+    interval = 1.0 / rate
+    deadline = time.perf_counter() + duration
+    next_send = time.perf_counter()
+    while next_send < deadline:
+        client.send_chat(f"t={time.perf_counter():.6f} {padding}")
+        next_send += interval
+        await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+
+async def run(args):
+    latencies = []
+    codecs = () if args.no_compression else SUPPORTED_CODECS
+    clients = [LoadClient(latencies, codecs) for _ in range(args.clients)]
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def login(index, client):
+        async with slots:
+            await client.connect(f"load{index}", args.host, args.port, timeout=30.0)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    await asyncio.gather(*(login(i, client) for i, client in enumerate(clients)))
+    connect_seconds = time.perf_counter() - started
+    heap_per_client = (tracemalloc.get_traced_memory()[0] - before) / args.clients
+    tracemalloc.stop()
+
+    # Roster deltas of the later logins settle first
+    await asyncio.sleep(1.0)
+    latencies.clear()
+    padding = "x" * args.size
+    started = time.perf_counter()
+    await asyncio.gather(*(send_for(client, args.rate, args.duration, padding)
+                           for client in clients[:args.senders]))
+    expected = args.senders * round(args.rate * args.duration) * (args.clients - 1)
+    while len(latencies) < expected and time.perf_counter() - started < args.duration + 10:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    for client in clients:
+        client.close()
+    await asyncio.sleep(0.1)
+
+    latencies.sort()
+    return {
+        "connect_seconds": connect_seconds,
+        "heap_per_client": heap_per_client,
+        "delivered": len(latencies),
+        "expected": expected,
+        "per_second": len(latencies) / elapsed,
+        "p50_ms": 1e3 * latencies[len(latencies) // 2] if latencies else 0.0,
+        "p99_ms": 1e3 * latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int, default=50998)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--no-compression", action="store_true",
+                        help="clients offer no codec, the lightweight setup for bots")
+    args = parser.parse_args()
+
+    pid = workdir = None
+    if args.host is None:
+        args.host = "127.0.0.1"
+        workdir = tempfile.mkdtemp(prefix="load-bench-")
+        pid = start_server(args.port, workdir)
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        if pid is not None:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'clients':24}{args.clients:>10}")
+    print(f"{'connect, all':24}{result['connect_seconds']:>9.2f}s")
+    print(f"{'client heap per client':24}{result['heap_per_client'] / 1024:>8.1f}KB")
+    print(f"{'delivered':24}{result['delivered']:>10}   of {result['expected']}")
+    print(f"{'delivered per second':24}{result['per_second']:>10.0f}")
+    print(f"{'latency p50':24}{result['p50_ms']:>8.1f}ms")
+    print(f"{'latency p99':24}{result['p99_ms']:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
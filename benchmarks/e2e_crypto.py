@@ -0,0 +1,109 @@
+"""
+What end-to-end encryption costs a client, per message and per peer.
+
+No server involved: two or more EndToEnd sessions are wired to each
+other in memory, and the benchmark times the client-side work that
+comes with every message (sealing or opening an envelope, base64
+included) and the one-off work per peer:
+
+  - key setup: X25519 and HKDF for a new peer, done once and cached
+  - sender key: sealing our room key for one member, once per member
+    and rotation
+  - private message: seal by the sender, open by the recipient
+  - room message: sealed once by the sender, whatever the room size,
+    opened by each member
+
+    python benchmarks/e2e_crypto.py
+    python benchmarks/e2e_crypto.py --messages 50000 --sizes 16 256 4096
+
+Needs the `cryptography` package.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from net import EndToEnd, Identity, Op  # noqa: E402
+from net import e2e  # noqa: E402
+
+
+class Peer:
+    """An EndToEnd session that keeps what it sends instead of writing it."""
+
+    def __init__(self, name):
+        self.sent = []
+        self.session = EndToEnd(Identity(), lambda op, body: self.sent.append((op, body)),
+                                lambda op, body: None)
+        self.session.start(name)
+
+
+def connect(sender, receiver):
+    """Hand each side the other's public key, as a KEYS frame would."""
+    for a, b in ((sender, receiver), (receiver, sender)):
+        a.session.handle(Op.KEYS, {"keys": {b.session.username: b.session.identity.public_key}})
+
+
+def per_call(fn, count):
+    """Median of a few runs of count calls, in microseconds per call."""
+    runs = []
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(count):
+            fn()
+        runs.append((time.perf_counter() - started) / count * 1e6)
+    return statistics.median(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--peers", type=int, default=500)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 256, 4096])
+    args = parser.parse_args()
+    if not e2e.AVAILABLE:
+        sys.exit("needs the cryptography package: pip install cryptography")
+
+    alice, bob = Peer("alice"), Peer("bob")
+    connect(alice, bob)
+
+    identity = Identity()
+    publics = [Identity().public_key for _ in range(args.peers)]
+    keys = iter(publics * 5)
+    setup_us = per_call(lambda: identity.pairwise("@a|b", next(keys)), args.peers)
+
+    alice.session.set_members(["bob"])
+    alice.session.send_chat({"text": ""})
+    share_us = per_call(lambda: alice.session._share("bob"), args.peers)
+    for op, body in alice.sent:
+        if op == Op.SENDER_KEY:
+            bob.session.handle(op, dict(body, **{"from": "alice"}))
+            break
+
+    print(f"{'key setup, per peer':34}{setup_us:>10.1f}us   (once, then cached)")
+    print(f"{'sender key to a member':34}{share_us:>10.1f}us   (per member and rotation)")
+    print()
+    print(f"{'per message':20}{'size':>8}{'seal':>12}{'open':>12}{'overhead':>12}")
+    for size in args.sizes:
+        text = "x" * size
+        for kind in ("private", "room"):
+            alice.sent.clear()
+            if kind == "private":
+                seal = lambda: alice.session.send_private("bob", {"to": "bob", "text": text})
+            else:
+                seal = lambda: alice.session.send_chat({"text": text})
+            seal_us = per_call(seal, args.messages)
+            op, body = alice.sent[-1]
+            received = {"from": "alice", "text": body["text"]}
+            opened = bob.session.open(op, received)
+            assert opened["text"] == text
+            open_us = per_call(lambda: bob.session.open(op, received), args.messages)
+            overhead = len(body["text"]) - size
+            print(f"{kind:20}{size:>7}B{seal_us:>10.1f}us{open_us:>10.1f}us{overhead:>11}B")
+
+
+if __name__ == "__main__":
+    main()
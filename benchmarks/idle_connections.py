@@ -0,0 +1,119 @@
+"""
+Memory cost of an idle client connection on server_new.
+
+Starts the server in a child process, logs in `--clients` clients that
+then stay silent, and reports how much the server's resident and
+virtual memory grew per connection. Run it once per configuration to
+compare, e.g.
+
+    python benchmarks/idle_connections.py --clients 2000
+    python benchmarks/idle_connections.py --clients 2000 --plain-recv --default-stack
+
+Linux only, it reads /proc/<pid>/status.
+"""
+
+import argparse
+import os
+import resource
+import signal
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server_new  # noqa: E402
+from net import FrameDecoder, Op, encode_frame, read_frames  # noqa: E402
+
+
+def memory(pid):
+    """(resident, virtual) bytes of a process."""
+    values = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmSize"):
+                values[key] = int(value.split()[0]) * 1024
+    return values["VmRSS"], values["VmSize"]
+
+
+def start_server(port, plain_recv, default_stack):
+    server_new.HOST = "127.0.0.1"
+    server_new.PORT = port
+    server_new.LISTENER_LIMIT = 512
+    server_new.METRICS_PORT = None
+    server_new.LOG_FILE = None
+    server_new.MAILBOX_FILE = None
+    server_new.STATE_DIR = None
+    server_new.DISCOVERY_BEACONS = False
+    server_new.PING_INTERVAL = 3600.0
+    if plain_recv:
+        server_new.RECV_SLAB_SIZE = None
+    if default_stack:
+        server_new.THREAD_STACK_SIZE = None
+    pid = os.fork()
+    if pid == 0:
+        import logging
+        logging.disable(logging.CRITICAL)
+        try:
+            server_new.main()
+        finally:
+            os._exit(0)
+    return pid
+
+
+def login(port, name):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(encode_frame(Op.HELLO, {"username": name, "caps": []}))
+    decoder = FrameDecoder()
+    while True:
+        frames = read_frames(sock, decoder)
+        if frames is None:
+            raise ConnectionError("server closed the connection")
+        if any(op == Op.WELCOME for op, _, _ in frames):
+            return sock
+
+
+def settle(pid, seconds=1.0):
+    time.sleep(seconds)
+    return memory(pid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50, help="connections opened before the baseline")
+    parser.add_argument("--port", type=int, default=50999)
+    parser.add_argument("--plain-recv", action="store_true", help="recv() per read instead of pooled slabs")
+    parser.add_argument("--default-stack", action="store_true", help="OS default thread stack size")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * (args.clients + args.warmup) + 64
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    pid = start_server(args.port, args.plain_recv, args.default_stack)
+    try:
+        time.sleep(0.5)
+        # Thread machinery, logging and caches are paid for once, not per client
+        clients = [login(args.port, f"warm{i}") for i in range(args.warmup)]
+        rss_before, vms_before = settle(pid)
+        started = time.monotonic()
+        clients += [login(args.port, f"idle{i}") for i in range(args.clients)]
+        elapsed = time.monotonic() - started
+        rss_after, vms_after = settle(pid, 2.0)
+
+        print(f"recv:            {'plain recv()' if args.plain_recv else 'pooled recv_into slabs'}")
+        print(f"thread stack:    {'OS default' if args.default_stack else server_new.THREAD_STACK_SIZE}")
+        print(f"idle clients:    {args.clients} (logged in in {elapsed:.1f} s)")
+        print(f"server RSS:      {rss_before / 2**20:.1f} -> {rss_after / 2**20:.1f} MiB")
+        print(f"RSS per client:  {(rss_after - rss_before) / args.clients:,.0f} bytes")
+        print(f"VM per client:   {(vms_after - vms_before) / args.clients:,.0f} bytes")
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+What server plugins add to message routing on server_new.
+
+  - overhead: microseconds a message spends in Pipeline.inbound and
+    outbound with `--plugins` quick INLINE plugins, in this process
+  - chat latency: one client sends, another receives, p50 and p99,
+    with no plugins, one quick INLINE plugin, and one that takes
+    `--slow` ms per message, declared POOL, ASYNC, or INLINE; the last
+    overruns its budget and is moved to the pool after STRIKES messages
+
+Offloading takes the waiting off the routing path, not the CPU work:
+pool and loop threads share the GIL with the server's reader and writer
+threads, so what a plugin computes per message still shows up, a little,
+in every message's latency. The slow plugins here mostly sleep.
+
+    python benchmarks/plugin_pipeline.py
+    python benchmarks/plugin_pipeline.py --slow 50 --messages 500
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server_new  # noqa: E402
+from net import (  # noqa: E402
+    ASYNC, INLINE, POOL, FrameDecoder, Message, Op, Pipeline, Plugin, RateLimits, encode_frame, read_frames,
+)
+from net.plugins import DEFAULT_BUDGET, INBOUND  # noqa: E402
+
+
+class WordFilter(Plugin):
+    """Quick: what a moderation plugin does on the routing path."""
+
+    def inbound(self, message, actions):
+        if "spam" in message.text:
+            message.refuse("no spam")
+
+
+class SlowLookup(Plugin):
+    """Takes `delay` seconds per message, like an HTTP lookup."""
+
+    def __init__(self, mode, delay):
+        self.mode = mode
+        self.delay = delay
+        # Declared INLINE it keeps the default budget and overruns it
+        self.budget = DEFAULT_BUDGET if mode == INLINE else 10 * delay
+
+    def inbound(self, message, actions):
+        time.sleep(self.delay)
+
+
+class SlowAsyncLookup(SlowLookup):
+    async def inbound(self, message, actions):
+        await asyncio.sleep(self.delay)
+
+
+def start_server(port, workdir, plugins):
+    server_new.HOST = "127.0.0.1"
+    server_new.PORT = port
+    server_new.METRICS_PORT = None
+    server_new.LOG_FILE = None
+    server_new.MAILBOX_FILE = None
+    server_new.STATE_DIR = None
+    server_new.DISCOVERY_BEACONS = False
+    server_new.RECV_DIR = os.path.join(workdir, "received")
+    server_new.RATE_LIMITS = RateLimits(1e9, 1e9, 1e12, 1e12, 1e12, 1e12)
+    server_new.COMPRESSION_CODECS = ()
+    # Routing cost only, no batching delay
+    server_new.WRITE_FLUSH_WINDOW = 0
+    server_new.PLUGINS = plugins
+    pid = os.fork()
+    if pid == 0:
+        logging.disable(logging.CRITICAL)
+        try:
+            server_new.main()
+        finally:
+            os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+
+class NativeClient:
+    def __init__(self, port, name):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.decoder = FrameDecoder()
+        self.backlog = []
+        self.sock.sendall(encode_frame(Op.HELLO, {"username": name, "caps": []}))
+        self.wait(Op.ROSTER_SNAPSHOT)
+
+    def send_chat(self, text):
+        self.sock.sendall(encode_frame(Op.CHAT, {"text": text}))
+
+    def wait(self, op):
+        while True:
+            while self.backlog:
+                if self.backlog.pop()[0] == op:
+                    return
+            frames = read_frames(self.sock, self.decoder, 65536)
+            if frames is None:
+                raise ConnectionError("server closed the connection")
+            self.backlog.extend(reversed(frames))
+
+
+def overhead(args):
+    """Microseconds per message through the INLINE hooks."""
+    pipeline = Pipeline([WordFilter() for _ in range(args.plugins)], lambda *a: None, lambda *a: None)
+    count = 20000
+    started = time.perf_counter()
+    for _ in range(count):
+        message = pipeline.outbound(pipeline.inbound(Message(Op.CHAT, "alice", None, "hello there")))
+        pipeline.dispatch(message, INBOUND)
+    per_message = (time.perf_counter() - started) / count * 1e6
+    pipeline.close()
+    return per_message
+
+
+def latency(port, args):
+    sender, receiver = NativeClient(port, "sender"), NativeClient(port, "receiver")
+    samples = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        sender.send_chat(f"message {i}")
+        receiver.wait(Op.CHAT)
+        samples.append(time.perf_counter() - started)
+    sender.sock.close()
+    receiver.sock.close()
+    head, samples = samples[:10], sorted(samples)
+    return 1e6 * samples[len(samples) // 2], 1e6 * samples[int(len(samples) * 0.99)], 1e6 * max(head)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=50994)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--plugins", type=int, default=5)
+    parser.add_argument("--slow", type=float, default=20.0, help="ms the slow plugin takes")
+    args = parser.parse_args()
+    # A scheduling hiccup may put a quick plugin over budget, not worth a warning here
+    logging.disable(logging.WARNING)
+
+    setups = [
+        ("no plugins", []),
+        ("quick INLINE", [WordFilter()]),
+        ("slow POOL", [SlowLookup(POOL, args.slow / 1e3)]),
+        ("slow ASYNC", [SlowAsyncLookup(ASYNC, args.slow / 1e3)]),
+        ("slow INLINE", [SlowLookup(INLINE, args.slow / 1e3)]),
+    ]
+    results = []
+    workdir = tempfile.mkdtemp(prefix="plugin-bench-")
+    try:
+        for i, (label, plugins) in enumerate(setups):
+            pid = start_server(args.port + i, workdir, plugins)
+            try:
+                results.append((label, latency(args.port + i, args)))
+            finally:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'pipeline overhead':26}{overhead(args):>10.2f}us   ({args.plugins} quick INLINE plugins)")
+    print()
+    print(f"{'chat latency':26}{'p50':>10}{'p99':>10}{'first 10, max':>16}")
+    for label, (p50, p99, first) in results:
+        print(f"{label:26}{p50:>8.0f}us{p99:>8.0f}us{first:>14.0f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+How fast server_new serves again after a restart, with net/persistence.py.
+
+Fills a HistoryStore with `--messages` messages over `--rooms` private
+rooms plus the general room, lets a StateStore write its full snapshot,
+logs a `--tail` of messages after it, then stops without a final
+snapshot, as a crash would. A fresh StateStore then loads the directory:
+
+  - snapshot: size on disk and how long writing it took
+  - load: time until the history is back and the server could serve,
+    the snapshot index plus the replayed log tail
+  - first read: a resuming client's replay of one room, which decodes
+    that room's block on first use
+
+    python benchmarks/state_recovery.py
+    python benchmarks/state_recovery.py --messages 5000000 --rooms 5000
+"""
+
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from net import GENERAL, HistoryStore, Op, RoomSequencer, dm_room  # noqa: E402
+from net.persistence import StateStore  # noqa: E402
+
+
+def payload(sender, seq, size):
+    return b'{"from":"%s","text":"%s","seq":%d}' % (sender.encode(), b"x" * size, seq)
+
+
+def wait_for(condition):
+    while not condition():
+        time.sleep(0.01)
+
+
+def fill(args):
+    """A history of args.messages, up to args.per_room a room."""
+    history = HistoryStore(per_room=args.per_room, max_rooms=args.rooms + 1)
+    rooms = [GENERAL] + [dm_room(f"user{i}", f"user{i + 1}") for i in range(args.rooms)]
+    per_room, extra = divmod(args.messages, len(rooms))
+    for index, room in enumerate(rooms):
+        for seq in range(1, per_room + (index < extra) + 1):
+            history.append(room, seq, Op.PRIVATE, payload("user0", seq, args.size), journal=False)
+    return history, rooms
+
+
+def write_state(directory, history, rooms, args):
+    """Full snapshot of history, then args.tail messages logged after it."""
+    # The whole tail stays in the log, not in a second snapshot
+    store = StateStore(directory, history, RoomSequencer(), snapshot_records=args.tail + 1)
+    history.journal = store.record
+    started = time.perf_counter()
+    store.start()
+    wait_for(lambda: store._log is not None and any(full for _, full in store._snapshots()))
+    write_seconds = time.perf_counter() - started
+    for i in range(args.tail):
+        room = rooms[i % len(rooms)]
+        history.append(room, history.last(room) + 1, Op.PRIVATE, payload("user0", i, args.size))
+    wait_for(lambda: not store._queue)
+    store.close(snapshot=False)
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    return write_seconds, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--rooms", type=int, default=2000, help="private rooms besides the general one")
+    parser.add_argument("--per-room", type=int, default=1000, help="history kept per room, HISTORY_PER_ROOM")
+    parser.add_argument("--tail", type=int, default=20000, help="messages logged after the snapshot")
+    parser.add_argument("--size", type=int, default=60, help="text bytes per message")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="state-bench-")
+    try:
+        history, rooms = fill(args)
+        stored = sum(len(history.since(room, 0)[1]) for room in rooms)
+        write_seconds, size = write_state(directory, history, rooms, args)
+        # A restarted server starts with an empty heap, not with this
+        # history waiting for the collector in the middle of load()
+        history.journal = None
+        del history
+        gc.collect()
+
+        history, sequencer = HistoryStore(per_room=args.per_room, max_rooms=args.rooms + 1), RoomSequencer()
+        store = StateStore(directory, history, sequencer)
+        started = time.perf_counter()
+        store.load()
+        load_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        _, replay = history.since(rooms[len(rooms) // 2], 0)
+        first_read = time.perf_counter() - started
+        started = time.perf_counter()
+        history.since(rooms[len(rooms) // 2], 0)
+        second_read = time.perf_counter() - started
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{'messages in history':24}{stored:>12}   in {len(rooms)} rooms")
+    print(f"{'snapshot + log on disk':24}{size / 2**20:>10.1f}MB")
+    print(f"{'snapshot write':24}{write_seconds:>11.2f}s")
+    print(f"{'load':24}{load_seconds * 1e3:>10.1f}ms   ({store.stats['replayed']} replayed from the log)")
+    print(f"{'first read of a room':24}{first_read * 1e3:>10.2f}ms   ({len(replay)} messages, decodes its block)")
+    print(f"{'second read':24}{second_read * 1e3:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
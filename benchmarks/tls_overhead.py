@@ -0,0 +1,197 @@
+"""
+What TLS costs on server_new, against plaintext on the same machine.
+
+Runs the server twice in a child process, once plain and once with
+TLS, and measures for each:
+
+  - connect: TCP connect plus handshake until WELCOME, a fresh
+    handshake and one that resumes the previous session
+  - chat latency: one client sends, another receives, p50 and p99
+  - file throughput: a client uploads `--file-mb` MiB of FILE_CHUNKs
+    until the server announces FILE_RECEIVED
+
+    python benchmarks/tls_overhead.py
+    python benchmarks/tls_overhead.py --cert server.pem --key server.key --messages 5000
+
+Without --cert a throwaway self-signed certificate is made with the
+openssl command line tool.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server_new  # noqa: E402
+from net import (  # noqa: E402
+    FILE_CHUNK_SIZE, FrameDecoder, Op, RateLimits, TLSSessionCache, client_context,
+    decode_body, encode_frame, read_frames, send_raw_frame,
+)
+
+
+def self_signed(directory):
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+         "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+def start_server(port, workdir, cert=None, key=None):
+    server_new.HOST = "127.0.0.1"
+    server_new.PORT = port
+    server_new.METRICS_PORT = None
+    server_new.LOG_FILE = None
+    server_new.MAILBOX_FILE = None
+    server_new.STATE_DIR = None
+    server_new.DISCOVERY_BEACONS = False
+    server_new.RECV_DIR = os.path.join(workdir, "received")
+    server_new.RATE_LIMITS = RateLimits(1e6, 1e6, 1e12, 1e12, 1e12, 1e12)
+    server_new.COMPRESSION_CODECS = ()
+    # Transport cost only, no batching delay
+    server_new.WRITE_FLUSH_WINDOW = 0
+    server_new.TLS_CERT_FILE = cert
+    server_new.TLS_KEY_FILE = key
+    pid = os.fork()
+    if pid == 0:
+        import logging
+        logging.disable(logging.CRITICAL)
+        try:
+            server_new.main()
+        finally:
+            os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+
+class Client:
+    def __init__(self, port, name, context=None, sessions=None):
+        started = time.perf_counter()
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if context is not None:
+            sock = sessions.wrap(context, sock, "127.0.0.1", port)
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.pending = []
+        sock.sendall(encode_frame(Op.HELLO, {"username": name, "caps": []}))
+        self.wait(Op.WELCOME)
+        self.connect_seconds = time.perf_counter() - started
+        self.resumed = context is not None and sock.session_reused
+        if context is not None:
+            sessions.remember("127.0.0.1", port, sock)
+
+    def wait(self, op):
+        while True:
+            while self.pending:
+                frame_op, _, payload = self.pending.pop(0)
+                if frame_op == op:
+                    return decode_body(frame_op, payload)
+            frames = read_frames(self.sock, self.decoder)
+            if frames is None:
+                raise ConnectionError("server closed the connection")
+            self.pending.extend(frames)
+
+    def close(self):
+        self.sock.close()
+
+
+def measure(port, context, args):
+    sessions = TLSSessionCache()
+    first = Client(port, "connect", context, sessions)
+    first.close()
+    resumed = [Client(port, f"again{i}", context, sessions) for i in range(args.connects)]
+    for client in resumed:
+        client.close()
+    fresh_times = []
+    for i in range(args.connects):
+        client = Client(port, f"fresh{i}", context, TLSSessionCache())
+        fresh_times.append(client.connect_seconds)
+        client.close()
+
+    sender = Client(port, "sender", context, sessions)
+    receiver = Client(port, "receiver", context, sessions)
+    latencies = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        sender.sock.sendall(encode_frame(Op.CHAT, {"text": f"message {i}"}))
+        receiver.wait(Op.CHAT)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    chunk = bytearray(os.urandom(FILE_CHUNK_SIZE))
+    total = args.file_mb * 1024 * 1024
+    started = time.perf_counter()
+    sender.sock.sendall(encode_frame(Op.FILE_BEGIN, {"name": "bench.bin", "size": total}))
+    with memoryview(chunk) as view:
+        for offset in range(0, total, FILE_CHUNK_SIZE):
+            send_raw_frame(sender.sock, Op.FILE_CHUNK, view[:min(FILE_CHUNK_SIZE, total - offset)])
+    sender.sock.sendall(encode_frame(Op.FILE_END))
+    receiver.wait(Op.FILE_RECEIVED)
+    file_seconds = time.perf_counter() - started
+    sender.close()
+    receiver.close()
+
+    return {
+        "connect_fresh_ms": 1000 * statistics.median(fresh_times),
+        "connect_resumed_ms": 1000 * statistics.median(c.connect_seconds for c in resumed),
+        "resumed": sum(c.resumed for c in resumed),
+        "chat_p50_us": 1e6 * latencies[len(latencies) // 2],
+        "chat_p99_us": 1e6 * latencies[int(len(latencies) * 0.99)],
+        "file_mib_s": args.file_mb / file_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=50998)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--connects", type=int, default=50)
+    parser.add_argument("--file-mb", type=int, default=64)
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="tls-bench-")
+    try:
+        cert, key = (args.cert, args.key) if args.cert else self_signed(workdir)
+        results = {}
+        for mode in ("plain", "tls"):
+            tls = mode == "tls"
+            pid = start_server(args.port, workdir, cert if tls else None, key if tls else None)
+            try:
+                context = client_context(cert, verify=False) if tls else None
+                if context is not None:
+                    context.minimum_version = ssl.TLSVersion.TLSv1_3
+                results[mode] = measure(args.port, context, args)
+            finally:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            args.port += 1
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    plain, tls = results["plain"], results["tls"]
+    print(f"{'':22}{'plain':>12}{'tls':>12}")
+    print(f"{'connect, fresh':22}{plain['connect_fresh_ms']:>10.2f}ms{tls['connect_fresh_ms']:>10.2f}ms")
+    print(f"{'connect, resumed':22}{plain['connect_resumed_ms']:>10.2f}ms{tls['connect_resumed_ms']:>10.2f}ms"
+          f"   ({tls['resumed']}/{args.connects} resumed)")
+    print(f"{'chat latency p50':22}{plain['chat_p50_us']:>10.0f}us{tls['chat_p50_us']:>10.0f}us")
+    print(f"{'chat latency p99':22}{plain['chat_p99_us']:>10.0f}us{tls['chat_p99_us']:>10.0f}us")
+    print(f"{'file upload':22}{plain['file_mib_s']:>8.0f}MiB/s{tls['file_mib_s']:>8.0f}MiB/s")
+
+
+if __name__ == "__main__":
+    main()
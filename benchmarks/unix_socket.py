@@ -0,0 +1,172 @@
+"""
+Same-host clients over a Unix socket against TCP loopback.
+
+Runs server_new in a child process listening on a TCP port and on a
+Unix socket at the same time, and measures for each transport:
+
+  - connect: connect until WELCOME
+  - ping: PING to PONG round trip of one client, p50 and p99
+  - chat latency: one client sends, another receives, p50 and p99
+  - chat throughput: one client sends `--burst` messages as fast as it
+    can, until the other has received them all
+
+    python benchmarks/unix_socket.py
+    python benchmarks/unix_socket.py --messages 20000 --burst 200000
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server_new  # noqa: E402
+from net import FrameDecoder, Op, RateLimits, connect_unix, decode_body, encode_frame, read_frames  # noqa: E402
+
+
+def start_server(port, path, workdir):
+    server_new.HOST = "127.0.0.1"
+    server_new.PORT = port
+    server_new.UNIX_SOCKET_PATH = path
+    server_new.METRICS_PORT = None
+    server_new.LOG_FILE = None
+    server_new.MAILBOX_FILE = None
+    server_new.STATE_DIR = None
+    server_new.DISCOVERY_BEACONS = False
+    server_new.RECV_DIR = os.path.join(workdir, "received")
+    server_new.RATE_LIMITS = RateLimits(1e9, 1e9, 1e12, 1e12, 1e12, 1e12)
+    server_new.COMPRESSION_CODECS = ()
+    # Transport cost only, no batching delay
+    server_new.WRITE_FLUSH_WINDOW = 0
+    pid = os.fork()
+    if pid == 0:
+        import logging
+        logging.disable(logging.CRITICAL)
+        try:
+            server_new.main()
+        finally:
+            os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+
+class Client:
+    def __init__(self, connect, name):
+        started = time.perf_counter()
+        self.sock = connect()
+        self.decoder = FrameDecoder()
+        self.pending = []
+        self.sock.sendall(encode_frame(Op.HELLO, {"username": name, "caps": []}))
+        self.wait(Op.WELCOME)
+        self.connect_seconds = time.perf_counter() - started
+
+    def wait(self, op, count=1):
+        """Wait for count frames of op, returns the body of the last one."""
+        body = None
+        while count:
+            while self.pending and count:
+                frame_op, _, payload = self.pending.pop(0)
+                if frame_op == op:
+                    count -= 1
+                    body = payload
+            if count:
+                frames = read_frames(self.sock, self.decoder)
+                if frames is None:
+                    raise ConnectionError("server closed the connection")
+                self.pending.extend(frames)
+        return decode_body(op, body)
+
+    def close(self):
+        self.sock.close()
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def measure(connect, args, label):
+    connects = []
+    for i in range(args.connects):
+        client = Client(connect, f"{label}-c{i}")
+        connects.append(client.connect_seconds)
+        client.close()
+
+    sender = Client(connect, f"{label}-sender")
+    receiver = Client(connect, f"{label}-receiver")
+    pings = []
+    for _ in range(args.messages):
+        started = time.perf_counter()
+        sender.sock.sendall(encode_frame(Op.PING, {"t": started}))
+        sender.wait(Op.PONG)
+        pings.append(time.perf_counter() - started)
+    pings.sort()
+
+    latencies = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        sender.sock.sendall(encode_frame(Op.CHAT, {"text": f"message {i}"}))
+        receiver.wait(Op.CHAT)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    # The receiver reads on its own thread, a stalled reader would
+    # fill its queue on the server and get dropped
+    batch = encode_frame(Op.CHAT, {"text": "x" * args.size}) * 64
+    burst = args.burst // 64 * 64
+    reader = threading.Thread(target=receiver.wait, args=(Op.CHAT, burst))
+    started = time.perf_counter()
+    reader.start()
+    for _ in range(burst // 64):
+        sender.sock.sendall(batch)
+    reader.join()
+    burst_seconds = time.perf_counter() - started
+    sender.close()
+    receiver.close()
+
+    return {
+        "connect_us": 1e6 * statistics.median(connects),
+        "ping_p50_us": 1e6 * percentile(pings, 0.5),
+        "ping_p99_us": 1e6 * percentile(pings, 0.99),
+        "chat_p50_us": 1e6 * percentile(latencies, 0.5),
+        "chat_p99_us": 1e6 * percentile(latencies, 0.99),
+        "chat_per_s": burst / burst_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=50996)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--connects", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=50000)
+    parser.add_argument("--size", type=int, default=100)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="unix-bench-")
+    path = os.path.join(workdir, "chat.sock")
+    pid = start_server(args.port, path, workdir)
+    try:
+        tcp = measure(lambda: socket.create_connection(("127.0.0.1", args.port)), args, "tcp")
+        unix = measure(lambda: connect_unix(path), args, "unix")
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'':22}{'tcp':>12}{'unix':>12}")
+    for key, label, unit in (("connect_us", "connect", "us"),
+                             ("ping_p50_us", "ping p50", "us"), ("ping_p99_us", "ping p99", "us"),
+                             ("chat_p50_us", "chat latency p50", "us"), ("chat_p99_us", "chat latency p99", "us")):
+        print(f"{label:22}{tcp[key]:>10.0f}{unit}{unix[key]:>10.0f}{unit}")
+    print(f"{'chat throughput':22}{tcp['chat_per_s']:>9.0f}/s{unix['chat_per_s']:>9.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+What the WebSocket gateway costs on server_new, against native clients.
+
+  - conversion: turning one broadcast CHAT frame into a WebSocket
+    message (JSON, permessage-deflate), the first time and for every
+    further recipient, which finds it in the shared MessageCache
+  - chat latency: a native client sends, a native or a WebSocket client
+    receives, p50 and p99
+  - fan-out: a native client sends `--burst` messages to `--clients`
+    receivers, all native or all WebSocket, until every receiver has
+    every message
+
+The WebSocket clients here are minimal RFC 6455 clients of the
+proxichat.json subprotocol with permessage-deflate, nothing beyond the
+standard library. All clients run in this process, so the fan-out rate
+includes their own parsing (and inflating, for WebSocket) as well.
+
+    python benchmarks/websocket_gateway.py
+    python benchmarks/websocket_gateway.py --clients 200 --burst 2000
+"""
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server_new  # noqa: E402
+from net import (  # noqa: E402
+    FrameDecoder, MessageCache, Op, RateLimits, WebSocketFramer, encode_frame, read_frames,
+)
+
+
+def start_server(port, ws_port, workdir):
+    server_new.HOST = "127.0.0.1"
+    server_new.PORT = port
+    server_new.WS_PORT = ws_port
+    server_new.METRICS_PORT = None
+    server_new.LOG_FILE = None
+    server_new.MAILBOX_FILE = None
+    server_new.STATE_DIR = None
+    server_new.DISCOVERY_BEACONS = False
+    server_new.RECV_DIR = os.path.join(workdir, "received")
+    server_new.RATE_LIMITS = RateLimits(1e9, 1e9, 1e12, 1e12, 1e12, 1e12)
+    server_new.COMPRESSION_CODECS = ()
+    # Transport cost only, no batching delay
+    server_new.WRITE_FLUSH_WINDOW = 0
+    pid = os.fork()
+    if pid == 0:
+        import logging
+        logging.disable(logging.CRITICAL)
+        try:
+            server_new.main()
+        finally:
+            os._exit(0)
+    time.sleep(0.5)
+    return pid
+
+
+class NativeClient:
+    def __init__(self, port, name):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.decoder = FrameDecoder()
+        self.backlog = []
+        self.sock.sendall(encode_frame(Op.HELLO, {"username": name, "caps": []}))
+        self.wait(Op.ROSTER_SNAPSHOT)
+
+    def send_chat(self, text):
+        self.sock.sendall(encode_frame(Op.CHAT, {"text": text}))
+
+    def wait(self, op, count=1):
+        while count:
+            while self.backlog and count:
+                if self.backlog.pop()[0] == op:
+                    count -= 1
+            if count:
+                frames = read_frames(self.sock, self.decoder, 65536)
+                if frames is None:
+                    raise ConnectionError("server closed the connection")
+                self.backlog.extend(reversed(frames))
+
+
+class WebSocketClient:
+    """Just enough of a WebSocket client: proxichat.json with permessage-deflate."""
+
+    def __init__(self, port, name):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        self.sock.sendall((
+            "GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n"
+            "Sec-WebSocket-Protocol: proxichat.json\r\n"
+            "Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n").encode("ascii"))
+        # The server starts every message afresh, one inflater reads them all
+        self.inflater = zlib.decompressobj(-15)
+        self.buffer = b""
+        while b"\r\n\r\n" not in self.buffer:
+            self.buffer += self.sock.recv(4096)
+        head, _, self.buffer = self.buffer.partition(b"\r\n\r\n")
+        if b" 101 " not in head.split(b"\r\n")[0]:
+            raise ConnectionError(head.decode("latin-1"))
+        self.send({"op": "HELLO", "username": name})
+        self.wait(b"ROSTER_SNAPSHOT")
+
+    def send(self, message):
+        payload = json.dumps(message).encode("utf-8")
+        mask = os.urandom(4)
+        length = len(payload)
+        header = (bytes((0x81, 0x80 | length)) if length < 126
+                  else struct.pack("!BBH", 0x81, 0x80 | 126, length))
+        key = int.from_bytes((mask * (length // 4 + 1))[:length], "little")
+        masked = (int.from_bytes(payload, "little") ^ key).to_bytes(length, "little")
+        self.sock.sendall(header + mask + masked)
+
+    def send_chat(self, text):
+        self.send({"op": "CHAT", "text": text})
+
+    def wait(self, op_name, count=1):
+        tag = b'{"op":"' + op_name + b'"'
+        while count:
+            message = self.next_message()
+            if message is not None and message.startswith(tag):
+                count -= 1
+
+    def next_message(self):
+        while True:
+            buffer = self.buffer
+            if len(buffer) >= 2:
+                first, length = buffer[0], buffer[1] & 0x7F
+                start = 2
+                if length == 126:
+                    length, start = struct.unpack_from("!H", buffer, 2)[0], 4
+                elif length == 127:
+                    length, start = struct.unpack_from("!Q", buffer, 2)[0], 10
+                if len(buffer) >= start + length:
+                    payload = buffer[start:start + length]
+                    self.buffer = buffer[start + length:]
+                    if first & 0x0F == 0x9:
+                        return None  # heartbeat, not answered here
+                    if first & 0x40:
+                        payload = self.inflater.decompress(payload + b"\x00\x00\xff\xff")
+                    return payload
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.buffer += data
+
+
+def conversion(args):
+    """Microseconds to convert a CHAT frame, cold and from the cache."""
+    frame = encode_frame(Op.CHAT, {"from": "alice", "text": "x" * args.size, "seq": 1})
+    count = 20000
+    cache = MessageCache()
+    framer = WebSocketFramer(False, 15, cache)
+    started = time.perf_counter()
+    for _ in range(count):
+        framer._encode(frame)
+    cold = (time.perf_counter() - started) / count * 1e6
+    framer.convert(frame)
+    started = time.perf_counter()
+    for _ in range(count):
+        framer.convert(frame)
+    cached = (time.perf_counter() - started) / count * 1e6
+    return cold, cached
+
+
+def latency(sender, receiver, args, op):
+    samples = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        sender.send_chat(f"message {i}")
+        receiver.wait(op)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return 1e6 * samples[len(samples) // 2], 1e6 * samples[int(len(samples) * 0.99)]
+
+
+def fan_out(sender, receivers, args, op):
+    threads = [threading.Thread(target=r.wait, args=(op, args.burst)) for r in receivers]
+    text = "y" * args.size
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for _ in range(args.burst):
+        sender.send_chat(text)
+    for thread in threads:
+        thread.join()
+    return args.burst * len(receivers) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=50992)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=500)
+    parser.add_argument("--size", type=int, default=200)
+    args = parser.parse_args()
+
+    cold, cached = conversion(args)
+    workdir = tempfile.mkdtemp(prefix="ws-bench-")
+    pid = start_server(args.port, args.port + 1, workdir)
+    try:
+        sender = NativeClient(args.port, "sender")
+        native_latency = latency(sender, NativeClient(args.port, "native"), args, Op.CHAT)
+        ws_latency = latency(sender, WebSocketClient(args.port + 1, "browser"), args, b"CHAT")
+        natives = [NativeClient(args.port, f"n{i}") for i in range(args.clients)]
+        native_rate = fan_out(sender, natives, args, Op.CHAT)
+        for client in natives:
+            client.sock.close()
+        browsers = [WebSocketClient(args.port + 1, f"w{i}") for i in range(args.clients)]
+        ws_rate = fan_out(sender, browsers, args, b"CHAT")
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'conversion, first':26}{cold:>10.1f}us   (JSON + deflate, {args.size} B of text)")
+    print(f"{'conversion, cached':26}{cached:>10.1f}us   (every further recipient)")
+    print()
+    print(f"{'':26}{'native':>12}{'websocket':>12}")
+    print(f"{'chat latency p50':26}{native_latency[0]:>10.0f}us{ws_latency[0]:>10.0f}us")
+    print(f"{'chat latency p99':26}{native_latency[1]:>10.0f}us{ws_latency[1]:>10.0f}us")
+    print(f"{f'fan-out to {args.clients}':26}{native_rate:>8.0f}msg/s{ws_rate:>7.0f}msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Command line chat client, on the same client library as the app.
+
+    python cli.py alice 192.168.0.125
+    python cli.py alice --unix /tmp/proxichat.sock
+    echo "build finished" | python cli.py ci-bot 192.168.0.125
+
+Lines typed are sent to the room, "@user: text" to one user. Commands:
+
+    /file PATH   send a file
+    /users       who is online
+    /ping        round-trip time
+    /quit        leave
+
+At the end of standard input the client waits until the server has
+confirmed what it sent, then leaves, so it can be used from scripts.
+A lost connection is retried with backoff and the session resumed.
+"""
+
+import argparse
+import sys
+import time
+
+from net.client import CONNECT_TIMEOUT, DEFAULT_PORT, ChatClient
+from net.e2e import AVAILABLE as E2E_AVAILABLE, Identity
+from net.logs import configure_logging, shutdown_logging
+from net.local import connect_unix
+from net.reconnect import ReconnectScheduler, open_connection
+from net.tls import client_context
+
+FLUSH_TIMEOUT = 5.0  # seconds to wait for unconfirmed messages before leaving
+
+
+class ConsoleClient(ChatClient):
+    """Prints events, reconnects when the connection is lost."""
+
+    def __init__(self, args, identity=None):
+        super().__init__(identity)
+        self.args = args
+        self.tls = client_context(args.ca, not args.insecure) if args.tls else None
+        self.users = []
+        self.redirect = None
+        if args.unix:
+            # Same host, a restarted server takes over the socket path
+            connect = lambda host, port: connect_unix(args.unix, CONNECT_TIMEOUT)
+        else:
+            connect = open_connection
+        self.reconnector = ReconnectScheduler(self.reconnect_candidates, self.on_reconnected,
+                                              connect=connect, watch_network=not args.unix)
+
+    def login(self, sock=None, server=None):
+        host, port = server or (self.args.host, self.args.port)
+        self.connect(self.args.username, host, port, sock=sock, tls=self.tls,
+                     path=self.args.unix, timeout=CONNECT_TIMEOUT)
+
+    def reconnect_candidates(self):
+        servers = [(self.host, self.port)]
+        if self.redirect is not None:
+            servers.insert(0, self.redirect)
+        return servers
+
+    def on_reconnected(self, sock, server):
+        try:
+            self.login(sock, server)
+        except OSError as e:
+            print(f"* reconnect failed: {e}")
+            self.reconnector.start()
+
+    def on_welcome(self, resumed: bool):
+        print("* session resumed" if resumed else f"* connected as {self.username}")
+
+    def on_message(self, sender: str, text: str, private: bool, body: dict):
+        print(f"[{sender}] {text}" if private else f"<{sender}> {text}")
+
+    def on_roster(self, users):
+        self.users = users
+        print(f"* online: {', '.join(users)}")
+
+    def on_user_joined(self, username: str):
+        self.users.append(username)
+        print(f"* {username} joined")
+
+    def on_user_left(self, username: str):
+        if username in self.users:
+            self.users.remove(username)
+        print(f"* {username} left")
+
+    def on_status(self, message_id: str, status: str, tag):
+        if status == "queued":
+            print(f"* {tag} is offline, the message waits for them")
+
+    def on_file_received(self, body: dict):
+        print(f"* {body.get('from', '?')} sent {body.get('name', '')} ({body.get('size', 0)} bytes)")
+
+    def on_throttled(self, wait: float):
+        print(f"* sending too fast, paused for {wait:.1f}s")
+
+    def on_system(self, text: str, level: str):
+        print(f"* {text}")
+
+    def on_notice(self, text: str):
+        print(f"! {text}")
+
+    def on_disconnected(self, error):
+        print(f"* connection lost{f': {error}' if error else ''}, reconnecting")
+        hint, self.reconnect_hint = self.reconnect_hint, None
+        if hint is not None:
+            # A planned restart: come back when and where the server said
+            self.redirect, delay = hint
+            self.reconnector.start(delay)
+        else:
+            self.reconnector.start()
+
+    def command(self, line: str) -> bool:
+        """Handle one input line, False to leave."""
+        if line in ("/quit", "/exit"):
+            return False
+        if line == "/users":
+            print(f"* online: {', '.join(self.users)}")
+        elif line == "/ping":
+            print(f"* rtt {self.rtt_ms:.1f} ms" if self.rtt_ms is not None else "* no pong yet")
+            self.ping()
+        elif line.startswith("/file "):
+            try:
+                self.send_file(line[6:].strip())
+                print("* file sent")
+            except (OSError, ValueError) as e:
+                print(f"* file not sent: {e}")
+        elif line.startswith("/"):
+            print("* commands: /file PATH, /users, /ping, /quit")
+        else:
+            target = line[1:].split(":", 1)[0].strip() if line.startswith("@") else None
+            self.send_message(line, tag=target)
+        return True
+
+    def flush(self, timeout: float = FLUSH_TIMEOUT):
+        """Wait until the server confirmed everything we sent."""
+        deadline = time.monotonic() + timeout
+        while self.outbox and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("username")
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", metavar="PATH", help="connect to the server's Unix socket")
+    parser.add_argument("--tls", action="store_true", help="the server speaks TLS")
+    parser.add_argument("--ca", metavar="FILE", help="certificate of the server or its CA")
+    parser.add_argument("--insecure", action="store_true", help="do not verify the server certificate")
+    parser.add_argument("--identity", metavar="FILE", help="key file, turns on end-to-end encryption")
+    parser.add_argument("--log", metavar="FILE", help="write the client log to FILE")
+    args = parser.parse_args()
+
+    # Warnings go to the log file if there is one, not between the messages
+    configure_logging(args.log, console=args.log is None)
+    identity = None
+    if args.identity:
+        if not E2E_AVAILABLE:
+            sys.exit("end-to-end encryption needs the cryptography package")
+        identity = Identity.load_or_create(args.identity)
+
+    client = ConsoleClient(args, identity)
+    try:
+        client.login()
+    except OSError as e:
+        sys.exit(f"cannot connect: {e}")
+    if not client.wait_ready(CONNECT_TIMEOUT):
+        sys.exit("no answer from the server")
+
+    try:
+        for line in sys.stdin:
+            line = line.strip()
+            if line and not client.command(line):
+                break
+        client.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.reconnector.stop()
+        client.disconnect()
+        shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,12 @@ from kivymd.app import MDApp
 from kivymd.uix.screenmanager import MDScreenManager
 from kivy.core.window import Window
 from kivy.clock import Clock
+import logging
 import socket
 import threading
 import os
+import random
+import time
 from kivy.core.text import LabelBase
 import platform
 
@@ -26,6 +29,145 @@ from ui import (
     validate_ip_address,
     validate_message
 )
+from ui.constants import (
+    HEARTBEAT_INTERVAL,
+    DEFAULT_PORT,
+    CONNECTION_TIMEOUT,
+    DISCOVERED_CONNECT_TIMEOUT,
+    RECONNECT_BASE_DELAY,
+    RECONNECT_MAX_DELAY,
+    TLS_CA_FILE,
+    TLS_VERIFY,
+    E2E_KEY_FILE,
+    Debug,
+)
+
+# Import the shared wire protocol
+from net import (
+    Op,
+    FrameDecoder,
+    BufferPool,
+    ProtocolError,
+    Roster,
+    HeartbeatMonitor,
+    DEFAULT_PING_INTERVAL,
+    DEFAULT_PONG_TIMEOUT,
+    RateLimits,
+    RateLimiter,
+    ThrottleStats,
+    DEFAULT_RATE_LIMITS,
+    limits_for,
+    CoalescingWriter,
+    SUPPORTED_CODECS,
+    FrameCompressor,
+    FrameDecompressor,
+    negotiate,
+    inflate_frames,
+    ServerMetrics,
+    MetricsServer,
+    encode_frame,
+    decode_body,
+    read_frames,
+    op_name,
+    DiscoveryCache,
+    DiscoveryListener,
+    BeaconSender,
+    TypingRelay,
+    GENERAL,
+    dm_room,
+    RoomSequencer,
+    RecentMessages,
+    ReceiptBoard,
+)
+from net.client import MAX_FILE_SIZE, ChatClient
+from net.reconnect import Backoff, ReconnectScheduler
+from net.tls import accept_tls, client_context
+from net import e2e
+from net.e2e import Identity
+from net.delivery import RECEIPT_INTERVAL
+from net.logs import (
+    CLIENT,
+    SERVER,
+    TRAFFIC,
+    UI,
+    configure_logging,
+    get_logger,
+    shutdown_logging,
+)
+
+client_log = get_logger(CLIENT)
+server_log = get_logger(SERVER)
+traffic_log = get_logger(TRAFFIC)
+
+
+class AppClient(ChatClient):
+    """The app's connection. Events and timers run on the Kivy thread,
+    the same one the UI sends from."""
+    
+    def __init__(self, app):
+        super().__init__(
+            dispatch=lambda fn: Clock.schedule_once(lambda dt: fn(), 0),
+            call_later=lambda delay, fn: Clock.schedule_once(lambda dt: fn(), delay),
+            typing_indicators=Features.ENABLE_TYPING_INDICATORS,
+            heartbeat=HEARTBEAT_INTERVAL
+        )
+        self.app = app
+    
+    def on_message(self, sender: str, text: str, private: bool, body: dict):
+        self.app.chat_interface.display_message(sender, f"(private) {text}" if private else text)
+    
+    def on_roster(self, users):
+        self.app.on_roster_snapshot(users)
+    
+    def on_user_joined(self, username: str):
+        self.app.on_roster_add(username)
+    
+    def on_user_left(self, username: str):
+        self.app.on_roster_remove(username)
+    
+    def on_typing(self, users):
+        self.app.chat_interface.show_typing(users)
+    
+    def on_status(self, message_id: str, status: str, card):
+        if card is not None:
+            card.set_status(status)
+    
+    def on_file_received(self, body: dict):
+        self.app.chat_interface.add_enhanced_system_message(
+            SystemMessages.FILE_RECEIVED.format(filename=body.get("name", "")), 
+            "success"
+        )
+    
+    def on_latency(self, rtt_ms: float):
+        self.app.chat_interface.update_latency(rtt_ms)
+    
+    def on_throttled(self, wait: float):
+        self.app.chat_interface.add_enhanced_system_message(
+            SystemMessages.RATE_LIMITED, "warning"
+        )
+    
+    def on_system(self, text: str, level: str):
+        self.app.chat_interface.add_enhanced_system_message(text, level)
+    
+    def on_notice(self, text: str):
+        self.app.chat_interface.add_enhanced_system_message(text, "warning")
+    
+    def on_error(self, error: Exception):
+        self.app.chat_interface.add_enhanced_system_message(
+            "Error processing message", "error"
+        )
+    
+    def on_disconnected(self, error):
+        if isinstance(error, ConnectionResetError):
+            self.app.handle_connection_reset()
+        elif error is not None:
+            self.app.handle_receive_error(str(error))
+        else:
+            self.app.handle_disconnection()
+    
+    def is_reading(self) -> bool:
+        # What arrives while the window has focus is on screen, so read
+        return getattr(Window, "focus", True)
 
 
 class EnhancedChatApp(MDApp):
@@ -34,12 +176,17 @@ class EnhancedChatApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.title = "Chattr - Modern Desktop Chat"
-        self.socket = None
-        self.connected = False
-        self.username = None
-        self.host = None
-        self.receive_thread = None
+        self.client = AppClient(self)  # protocol state, kept across reconnects to resume
         self.active_users = []
+        self.tls_context = None
+        self.discovery = DiscoveryCache()
+        self.discovery_listener = None
+        self.reconnector = ReconnectScheduler(
+            self.reconnect_candidates,
+            lambda sock, server: Clock.schedule_once(lambda dt: self.on_reconnected(sock, server), 0),
+            backoff=Backoff(RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY)
+        )
+        self.redirect = None  # server to try first on the next reconnect
         
     def build(self):
         """Build the enhanced application."""
@@ -57,7 +204,8 @@ class EnhancedChatApp(MDApp):
         self.chat_interface.set_callbacks(
             send_message_callback=self.send_message,
             send_file_callback=self.send_file,
-            connect_callback=self.connect_to_server
+            connect_callback=self.connect_to_server,
+            typing_callback=self.on_input_changed if Features.ENABLE_TYPING_INDICATORS else None
         )
         
         self.screen_manager.add_widget(self.chat_interface)
@@ -142,9 +290,20 @@ class EnhancedChatApp(MDApp):
         
         # Bind window events
         Window.bind(on_request_close=self.on_window_close)
+        if hasattr(Window, "focus"):
+            # Messages count as read once the window has focus again
+            Window.bind(focus=lambda window, focused: focused and self.client.schedule_ack())
     
-    def connect_to_server(self, username: str, host: str) -> bool:
-        """Enhanced connection with validation and feedback."""
+    def connect_to_server(self, username: str, host: str, sock: socket.socket = None,
+                          port: int = None) -> bool:
+        """Enhanced connection with validation and feedback.
+        
+        `sock` is an already connected socket from the reconnect scheduler.
+        """
+        # A login by hand replaces any pending automatic reconnect
+        if sock is None:
+            self.reconnector.stop()
+        
         # Validate inputs
         username_valid, username_error = validate_username(username)
         if not username_valid:
@@ -156,25 +315,25 @@ class EnhancedChatApp(MDApp):
             self.chat_interface.add_enhanced_system_message(ip_error, "error")
             return False
         
+        # A server heard on the LAN tells us its port and is known to be up
+        discovered = self.discovery.get(host, port)
+        if port is None:
+            port = discovered.port if discovered else DEFAULT_PORT
+        
         # Attempt connection
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10.0)  # 10 second timeout
+            tls = None
+            if Features.ENABLE_MESSAGE_ENCRYPTION:
+                if self.tls_context is None:
+                    self.tls_context = client_context(TLS_CA_FILE, TLS_VERIFY)
+                tls = self.tls_context
             
-            # Connect to server
-            self.socket.connect((host, 1234))
-            
-            # Send username
-            self.socket.send(username.encode('utf-8'))
-            
-            # Store connection info
-            self.username = username
-            self.host = host
-            self.connected = True
-            
-            # Start receiving thread
-            self.start_receive_thread()
+            if self.client.e2e is None and Features.ENABLE_END_TO_END_ENCRYPTION:
+                self.setup_end_to_end()
             
+            # Sends HELLO, resuming the session when reconnecting
+            timeout = DISCOVERED_CONNECT_TIMEOUT if discovered and sock is None else CONNECTION_TIMEOUT
+            self.client.connect(username, host, port, sock=sock, tls=tls, timeout=timeout)
             return True
             
         except socket.timeout:
@@ -198,83 +357,36 @@ class EnhancedChatApp(MDApp):
             self.cleanup_connection()
             return False
     
-    def start_receive_thread(self):
-        """Start enhanced message receiving thread."""
-        if self.receive_thread and self.receive_thread.is_alive():
+    def setup_end_to_end(self):
+        """Load or create our identity key, without `cryptography` we stay on plain text."""
+        if not e2e.AVAILABLE:
+            client_log.warning("end-to-end encryption needs the cryptography package")
             return
-        
-        self.receive_thread = threading.Thread(
-            target=self.receive_messages,
-            daemon=True
-        )
-        self.receive_thread.start()
+        self.client.enable_end_to_end(Identity.load_or_create(E2E_KEY_FILE))
     
-    def receive_messages(self):
-        """Enhanced message receiving with better error handling."""
-        while self.connected and self.socket:
-            try:
-                # Receive message
-                message = self.socket.recv(2048).decode('utf-8')
-                
-                if not message:
-                    # Server closed connectionx
-                    Clock.schedule_once(lambda dt: self.handle_disconnection(), 0)
-                    break
-                
-                # Handle different message types
-                Clock.schedule_once(
-                    lambda dt, msg=message: self.process_received_message(msg), 
-                    0
-                )
-                
-            except socket.timeout:
-                continue
-                
-            except ConnectionResetError:
-                Clock.schedule_once(lambda dt: self.handle_connection_reset(), 0)
-                break
-                
-            except Exception as e:
-                print(f"Receive error: {e}")
-                Clock.schedule_once(lambda dt: self.handle_receive_error(str(e)), 0)
-                break
+    def on_roster_snapshot(self, users):
+        """Full roster received, replace the user list."""
+        self.active_users = users
+        self.chat_interface.set_active_users(users)
     
-    def process_received_message(self, message: str):
-        """Process received message with enhanced parsing."""
-        try:
-            if message.startswith("USER_JOINED:"):
-                username = message.split(":", 1)[1]
-                self.chat_interface.user_joined(username)
-                
-            elif message.startswith("USER_LEFT:"):
-                username = message.split(":", 1)[1]
-                self.chat_interface.user_left(username)
-                
-            elif message.startswith("FILE_RECEIVED:"):
-                filename = message.split(":", 1)[1]
-                self.chat_interface.add_enhanced_system_message(
-                    SystemMessages.FILE_RECEIVED.format(filename=filename), 
-                    "success"
-                )
-                
-            elif ":" in message:
-                # Regular chat message
-                username, content = message.split(":", 1)
-                self.chat_interface.display_message(username, content)
-                
-            else:
-                # System message
-                self.chat_interface.add_enhanced_system_message(message, "info")
-                
-        except Exception as e:
-            print(f"Message processing error: {e}")
-            self.chat_interface.add_enhanced_system_message(
-                "Error processing message", "error"
-            )
+    def on_roster_add(self, username: str):
+        """Roster delta: a user joined."""
+        self.active_users.append(username)
+        self.chat_interface.user_joined(username)
+    
+    def on_roster_remove(self, username: str):
+        """Roster delta: a user left."""
+        if username in self.active_users:
+            self.active_users.remove(username)
+        self.chat_interface.user_left(username)
+    
+    def on_input_changed(self, text: str):
+        """Message input edited, the client debounces typing indicators."""
+        self.client.input_changed(text)
     
     def send_message(self, message: str):
         """Enhanced message sending with validation."""
-        if not self.connected or not self.socket:
+        if not self.client.connected:
             self.chat_interface.add_enhanced_system_message(
                 ErrorMessages.NOT_CONNECTED, "error"
             )
@@ -287,14 +399,13 @@ class EnhancedChatApp(MDApp):
             return 
         
         try:
-            # Send message
-            self.socket.send(message.encode('utf-8'))
-            
-            # Display own message immediately
-            self.chat_interface.display_message(self.username, message)
+            # Display own message immediately, the card follows the
+            # message from queued to sent to seen
+            card = self.chat_interface.display_message(self.client.username, message)
+            self.client.send_message(message, tag=card)
             
         except Exception as e:
-            print(f"Send error: {e}")
+            client_log.warning("send error", extra={"error": str(e)})
             self.chat_interface.add_enhanced_system_message(
                 ErrorMessages.SEND_FAILED, "error"
             )
@@ -302,7 +413,7 @@ class EnhancedChatApp(MDApp):
     
     def send_file(self, file_path: str):
         """Enhanced file sending with progress feedback."""
-        if not self.connected or not self.socket:
+        if not self.client.connected:
             self.chat_interface.add_enhanced_system_message(
                 ErrorMessages.NOT_CONNECTED, "error"
             )
@@ -319,9 +430,9 @@ class EnhancedChatApp(MDApp):
             file_size = os.path.getsize(file_path)
             
             # Check file size (50MB limit)
-            if file_size > 50 * 1024 * 1024:
+            if file_size > MAX_FILE_SIZE:
                 self.chat_interface.add_enhanced_system_message(
-                    ErrorMessages.FILE_TOO_LARGE.format(max_size=50), "error"
+                    ErrorMessages.FILE_TOO_LARGE.format(max_size=MAX_FILE_SIZE // (1024 * 1024)), "error"
                 )
                 return
             
@@ -330,22 +441,7 @@ class EnhancedChatApp(MDApp):
                 SystemMessages.FILE_SENDING.format(filename=filename), "info"
             )
             
-            # Send file signal
-            self.socket.send("sending_file".encode('utf-8'))
-            
-            # Send filename
-            self.socket.send(filename.encode('utf-8'))
-            
-            # Send file content
-            with open(file_path, 'rb') as file:
-                while True:
-                    data = file.read(4096)
-                    if not data:
-                        break
-                    self.socket.send(data)
-            
-            # Send end marker
-            self.socket.send(b"<END>")
+            self.client.send_file(file_path)
             
             # Success message
             self.chat_interface.add_enhanced_system_message(
@@ -361,14 +457,13 @@ class EnhancedChatApp(MDApp):
                 ErrorMessages.FILE_PERMISSION_ERROR, "error"
             )
         except Exception as e:
-            print(f"File send error: {e}")
+            client_log.warning("file send error", extra={"error": str(e)})
             self.chat_interface.add_enhanced_system_message(
                 ErrorMessages.FILE_SEND_FAILED, "error"
             )
     
     def handle_disconnection(self):
         """Handle server disconnection with enhanced feedback."""
-        self.connected = False
         self.cleanup_connection()
         self.chat_interface.disconnect_cleanup()
         
@@ -391,67 +486,74 @@ class EnhancedChatApp(MDApp):
     
     def handle_send_error(self):
         """Handle send error and attempt recovery."""
-        if self.connected:
+        if self.client.connected:
             self.chat_interface.add_enhanced_system_message(
                 "Message failed to send - connection may be unstable", "warning"
             )
     
     def schedule_reconnection(self):
-        """Schedule automatic reconnection attempt."""
-        if not Features.ENABLE_AUTO_RECONNECT:
+        """Start the reconnect scheduler, it retries with randomized backoff."""
+        if not Features.ENABLE_AUTO_RECONNECT or not (self.client.username and self.client.host):
+            return
+        if self.reconnector.running:
             return
         
-        self.chat_interface.add_enhanced_system_message(
-            "Attempting to reconnect in 3 seconds...", "info"
-        )
+        hint, self.client.reconnect_hint = self.client.reconnect_hint, None
+        if hint is not None:
+            # A planned restart: wait the time the server picked for us,
+            # so its clients do not all come back at once
+            self.redirect, delay = hint
+            self.chat_interface.add_enhanced_system_message(
+                SystemMessages.SERVER_MAINTENANCE, "info"
+            )
+            self.reconnector.start(delay)
+            return
         
-        Clock.schedule_once(
-            lambda dt: self.attempt_reconnection(), 
-            3.0
+        self.chat_interface.add_enhanced_system_message(
+            SystemMessages.CONNECTION_LOST, "info"
         )
+        self.reconnector.start()
     
-    def attempt_reconnection(self):
-        """Attempt to reconnect to server."""
-        if self.username and self.host:
-            self.chat_interface.add_enhanced_system_message(
-                "Reconnecting...", "info"
-            )
-            
-            success = self.connect_to_server(self.username, self.host)
+    def reconnect_candidates(self):
+        """Servers to try, the one we were on and any heard on the LAN.
+        Runs on the scheduler thread."""
+        servers = [(self.client.host, self.client.port or DEFAULT_PORT)]
+        servers.extend(server.address for server in self.discovery.servers())
+        if self.redirect is not None:
+            servers.insert(0, self.redirect)
+        return servers
+    
+    def on_reconnected(self, sock, server):
+        """The scheduler got a connection, log in over it."""
+        if self.client.connected:
+            sock.close()
+            return
+        self.redirect = None
+        self.attempt_reconnection(sock, server)
+    
+    def attempt_reconnection(self, sock=None, server=None):
+        """Log in again, resuming the session if the server still knows it."""
+        if self.client.username and self.client.host:
+            host, port = server or (self.client.host, self.client.port)
+            success = self.connect_to_server(self.client.username, host, sock=sock, port=port)
             if success:
                 self.chat_interface.add_enhanced_system_message(
                     SystemMessages.RECONNECTED, "success"
                 )
             else:
-                # Schedule another attempt
-                Clock.schedule_once(
-                    lambda dt: self.schedule_reconnection(), 
-                    2.0
-                )
+                # Back to the scheduler, it keeps backing off
+                self.schedule_reconnection()
     
     def cleanup_connection(self):
         """Enhanced connection cleanup."""
-        if self.socket:
-            try:
-                self.socket.close()
-            except:
-                pass
-            self.socket = None
-        
-        self.connected = False
-        
-        # Wait for receive thread to finish
-        if self.receive_thread and self.receive_thread.is_alive():
-            self.receive_thread.join(timeout=1.0)
+        # The roster and receive windows are kept for resuming the session
+        self.client.close()
     
     def on_window_close(self, *args):
         """Handle window close with proper cleanup."""
         # Send disconnect message if connected
-        if self.connected and self.socket:
-            try:
-                self.socket.send("DISCONNECT".encode('utf-8'))
-            except:
-                pass
+        if self.client.connected:
+            self.client.disconnect()
         
         # Clean up connection
         self.cleanup_connection()
@@ -466,8 +568,8 @@ class EnhancedChatApp(MDApp):
         try:
             import json
             preferences = {
-                "last_username": self.username or "",
-                "last_host": self.host or "192.168.0.125",
+                "last_username": self.client.username or "",
+                "last_host": self.client.host or "192.168.0.125",
                 "theme": "dark",
                 "features": {
                     "animations": Features.ENABLE_ANIMATIONS,
@@ -479,7 +581,7 @@ class EnhancedChatApp(MDApp):
                 json.dump(preferences, f, indent=2)
                 
         except Exception as e:
-            print(f"Failed to save preferences: {e}")
+            client_log.warning("failed to save preferences", extra={"error": str(e)})
     
     def load_user_preferences(self) -> dict:
         """Load user preferences from previous session."""
@@ -495,8 +597,27 @@ class EnhancedChatApp(MDApp):
                 "features": {}
             }
     
+    def start_discovery(self):
+        """Listen for server beacons on the LAN."""
+        if not Features.ENABLE_SERVER_DISCOVERY:
+            return
+        self.discovery_listener = DiscoveryListener(
+            self.discovery,
+            on_change=lambda cache: Clock.schedule_once(lambda dt: self.on_servers_discovered(), 0)
+        )
+        self.discovery_listener.start()
+    
+    def on_servers_discovered(self):
+        """Offer the live servers to the login dialog, least loaded first."""
+        self.chat_interface.login_manager.offer_servers(self.discovery.servers())
+        # A server (re)appeared, maybe ours after a restart
+        if self.reconnector.running:
+            self.reconnector.network_changed()
+    
     def on_start(self):
         """Enhanced startup with preference loading."""
+        self.start_discovery()
+        
         # Load preferences
         prefs = self.load_user_preferences()
         
@@ -512,6 +633,9 @@ class EnhancedChatApp(MDApp):
     
     def on_stop(self):
         """Enhanced cleanup on app stop."""
+        self.reconnector.stop()
+        if self.discovery_listener is not None:
+            self.discovery_listener.stop()
         self.cleanup_connection()
 
 
@@ -522,11 +646,48 @@ class EnhancedChatApp(MDApp):
 class EnhancedChatServer:
     """Enhanced chat server with modern features."""
     
-    def __init__(self, host: str = "192.168.0.125", port: int = 1234):
+    def __init__(self, host: str = "192.168.0.125", port: int = 1234,
+                 ping_interval: float = DEFAULT_PING_INTERVAL,
+                 pong_timeout: float = DEFAULT_PONG_TIMEOUT,
+                 rate_limits: RateLimits = DEFAULT_RATE_LIMITS,
+                 user_rate_limits: dict = None,
+                 compression_codecs=SUPPORTED_CODECS,
+                 metrics_port: int = None,
+                 name: str = None,
+                 announce: bool = True,
+                 drain_window: float = 10.0,
+                 tls_context=None):
         self.host = host
+        self.tls_context = tls_context  # from net.tls.server_context(), None serves plain TCP
+        self.drain_window = drain_window  # clients reconnect at random within this after a shutdown
+        self.draining = False
+        self.name = name or f"{host}:{port}"
+        self.announce = announce
+        self.beacon = None
         self.port = port
+        self.compression_codecs = compression_codecs
+        self.rate_limits = rate_limits
+        self.user_rate_limits = user_rate_limits or {}
+        self.throttle_stats = ThrottleStats()
         self.socket = None
         self.clients = {}
+        self.writers = {}  # client socket -> CoalescingWriter
+        self.buffers = BufferPool()  # recv_into slabs shared by all client threads
+        self.roster = Roster()
+        self.typing = TypingRelay()
+        self.sequencer = RoomSequencer()
+        self.recent_messages = RecentMessages()
+        self.receipts = ReceiptBoard()
+        self.heartbeats = HeartbeatMonitor(
+            self.send_ping, self.evict_client, ping_interval, pong_timeout
+        )
+        self.metrics = ServerMetrics(
+            active_connections=lambda: len(self.clients),
+            queue_depths=lambda: [w.queued_bytes for w in list(self.writers.values())],
+            throttle_stats=self.throttle_stats
+        )
+        self.metrics_port = metrics_port
+        self.metrics_server = None
         self.running = False
     
     def start_server(self):
@@ -538,12 +699,22 @@ class EnhancedChatServer:
             self.socket.listen(10)
             
             self.running = True
-            print(f"🚀 Enhanced Chat Server started on {self.host}:{self.port}")
+            self.heartbeats.start()
+            self.heartbeats.wheel.schedule("receipts", RECEIPT_INTERVAL, self.flush_receipts)
+            if self.metrics_port is not None:
+                # Local Prometheus endpoint, never exposed on the chat interface
+                self.metrics_server = MetricsServer(self.metrics.registry, "127.0.0.1", self.metrics_port)
+                self.metrics_server.start()
+            if self.announce:
+                # Let clients on the LAN find us without typing an address
+                self.beacon = BeaconSender(self.name, self.port, lambda: len(self.clients), self.host)
+                self.beacon.start()
+            server_log.info("server started", extra={"host": self.host, "port": self.port})
             
             while self.running:
                 try:
                     client_socket, address = self.socket.accept()
-                    print(f"👤 New connection from {address}")
+                    server_log.info("connection accepted", extra={"addr": f"{address[0]}:{address[1]}"})
                     
                     # Handle client in separate thread
                     client_thread = threading.Thread(
@@ -555,166 +726,377 @@ class EnhancedChatServer:
                     
                 except socket.error:
                     if self.running:
-                        print("Server socket error")
+                        server_log.error("server socket error")
                     break
                     
-        except Exception as e:
-            print(f"Server error: {e}")
+        except Exception:
+            server_log.exception("server error")
         finally:
             self.cleanup_server()
     
     def handle_client(self, client_socket, address):
         """Enhanced client handling with modern features."""
         username = None
+        decoder = FrameDecoder()
         
         try:
+            if self.tls_context is not None:
+                client_socket = accept_tls(self.tls_context, client_socket)
             # Receive username
-            username = client_socket.recv(1024).decode('utf-8')
-            if not username:
-                return
+            hello = {}
+            pending = []
+            while username is None:
+                frames = read_frames(client_socket, decoder, pool=self.buffers)
+                if frames is None:
+                    return
+                for i, (op, _, payload) in enumerate(frames):
+                    if op == Op.HELLO:
+                        hello = decode_body(op, payload)
+                        username = hello.get("username") or None
+                        pending = frames[i + 1:]
+                        break
+            
+            # Negotiate compression
+            codec = negotiate(hello.get("caps"), self.compression_codecs)
+            decompressor = FrameDecompressor(codec) if codec else None
             
-            # Store client
-            self.clients[username] = client_socket
+            # Store client, its writer batches everything we send it
+            self.writers[client_socket] = CoalescingWriter(
+                client_socket,
+                on_error=lambda error: self.writer_failed(client_socket, error),
+                name=f"writer-{username}",
+                compressor=FrameCompressor(codec) if codec else None,
+                on_flush=self.metrics.record_flush
+            )
+            def register(seq):
+                # Under the room lock, the client sees every message after seq
+                self.send_frame(client_socket, encode_frame(Op.WELCOME, {"codec": codec, "seq": {GENERAL: seq}}))
+                self.clients[username] = client_socket
+            self.sequencer.enter(GENERAL, register)
+            self.metrics.connections.inc()
+            self.heartbeats.watch((username, client_socket))
             
-            # Notify all clients of new user
-            self.broadcast_message(f"USER_JOINED:{username}", exclude=username)
+            # Full roster for the new client, delta for everyone else
+            version = self.roster.add(username)
+            self.send_roster_snapshot(client_socket)
+            if version is not None:
+                self.broadcast_frame(
+                    encode_frame(Op.ROSTER_ADD, {"v": version, "user": username}),
+                    exclude=username
+                )
             
-            print(f"✅ {username} joined from {address}")
+            server_log.info("client joined", extra={"user": username, "addr": f"{address[0]}:{address[1]}", "codec": codec})
             
             # Handle messages from this client
+            transfer = None
+            limiter = RateLimiter(
+                limits_for(username, self.user_rate_limits, self.rate_limits),
+                self.throttle_stats
+            )
+            throttled = False
             while self.running:
                 try:
-                    message = client_socket.recv(1024).decode('utf-8')
+                    frames = pending or read_frames(client_socket, decoder, pool=self.buffers)
+                    pending = None
                     
-                    if not message:
+                    if frames is None:
                         break
                     
-                    if message == "DISCONNECT":
-                        break
-                    elif message == "sending_file":
-                        self.handle_file_transfer(client_socket, username)
-                    else:
-                        # Broadcast regular message
-                        full_message = f"{username}:{message}"
-                        self.broadcast_message(full_message, exclude=username)
-                        print(f"💬 {username}: {message}")
+                    self.heartbeats.touch((username, client_socket))
+                    frames = inflate_frames(frames, decompressor)
+                    for op, _, payload in frames:
+                        limiter.charge(op, len(payload))
+                        self.metrics.record_frame_in(op, len(payload))
+                        if traffic_log.isEnabledFor(logging.DEBUG):
+                            traffic_log.debug("frame in", extra={"user": username, "op": op_name(op), "size": len(payload)})
+                        body = decode_body(op, payload)
+                        if op == Op.DISCONNECT:
+                            return
+                        elif op in (Op.FILE_BEGIN, Op.FILE_CHUNK, Op.FILE_END):
+                            transfer = self.handle_file_transfer(transfer, username, op, body)
+                        elif op == Op.ROSTER_SYNC:
+                            self.send_roster_snapshot(client_socket)
+                        elif op == Op.PING:
+                            self.send_frame(client_socket, encode_frame(Op.PONG, body))
+                        elif op == Op.TYPING:
+                            self.relay_typing(username, body)
+                        elif op == Op.ACK:
+                            self.record_acks(username, body)
+                        elif op == Op.CHAT:
+                            # Broadcast regular message
+                            self.typing.forget(username)
+                            self.handle_chat(client_socket, username, body)
+                        elif op == Op.PRIVATE:
+                            self.typing.forget(username)
+                            self.refuse_private(client_socket, username, body)
+                    
+                    # Flooding client: pause reading instead of disconnecting
+                    delay = limiter.pending()
+                    if delay and not throttled:
+                        self.send_frame(client_socket, encode_frame(Op.THROTTLE, {"wait": round(delay, 3)}))
+                    throttled = bool(limiter.wait())
                 
                 except socket.timeout:
                     continue
                 except ConnectionResetError:
-                    print(f"🔌 {username} disconnected unexpectedly")
+                    server_log.info("client disconnected unexpectedly", extra={"user": username})
                     break
                 except Exception as e:
-                    print(f"Client handling error: {e}")
+                    server_log.warning("client error", extra={"user": username, "error": str(e)})
+                    self.metrics.errors.labels("protocol" if isinstance(e, ProtocolError) else "read").inc()
                     break
         
         except Exception as e:
-            print(f"Client setup error: {e}")
+            server_log.warning("client setup error", extra={"addr": f"{address[0]}:{address[1]}", "error": str(e)})
         
         finally:
             # Clean up client
             if username:
                 self.cleanup_client(username, client_socket)
     
-    def handle_file_transfer(self, client_socket, sender_username):
-        """Enhanced file transfer handling."""
+    def send_ping(self, key):
+        """Ping an idle client."""
+        self.send_frame(key[1], encode_frame(Op.PING, {"t": time.monotonic()}))
+    
+    def evict_client(self, key):
+        """Drop a client that stopped answering pings."""
+        username, client_socket = key
+        server_log.info("client timed out", extra={"user": username})
+        self.metrics.errors.labels("timeout").inc()
         try:
-            # Receive filename
-            filename = client_socket.recv(1024).decode('utf-8')
-            print(f"📁 Receiving file '{filename}' from {sender_username}")
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.cleanup_client(username, client_socket)
+    
+    def send_roster_snapshot(self, client_socket):
+        """Send the full versioned roster to one client."""
+        version, users = self.roster.snapshot()
+        self.send_frame(client_socket, encode_frame(Op.ROSTER_SNAPSHOT, {"v": version, "users": users}))
+    
+    def send_frame(self, client_socket, frame: bytes, droppable: bool = False):
+        """Queue a frame on the client's writer."""
+        writer = self.writers.get(client_socket)
+        if writer is not None:
+            writer.send(frame, droppable)
+    
+    def handle_chat(self, client_socket, username: str, body: dict):
+        """Number a chat message, fan it out and confirm it to the sender."""
+        message_id = body.get("id")
+        known = self.recent_messages.lookup(username, message_id) if message_id else None
+        if known is None:
+            text = body.get("text", "")
+            seq = self.sequencer.assign(GENERAL, lambda seq: self.broadcast_frame(
+                encode_frame(Op.CHAT, {"from": username, "text": text, "seq": seq}), exclude=username
+            ))
+            known = (GENERAL, seq)
+            if message_id:
+                self.recent_messages.remember(username, message_id, GENERAL, seq)
+        confirmation = {"room": known[0], "seq": known[1]}
+        if message_id:
+            confirmation["id"] = message_id
+        self.send_frame(client_socket, encode_frame(Op.ACCEPTED, confirmation))
+    
+    def refuse_private(self, client_socket, username: str, body: dict):
+        """This server has no private rooms: confirm the message as refused,
+        so the client does not send it again after every reconnect, and say why."""
+        confirmation = {"room": dm_room(username, str(body.get("to", ""))), "seq": None, "refused": True}
+        if body.get("id"):
+            confirmation["id"] = body["id"]
+        self.send_frame(client_socket, encode_frame(Op.ACCEPTED, confirmation))
+        self.send_frame(client_socket, encode_frame(Op.SYSTEM, {
+            "text": "Private messages are not supported on this server.", "level": "warning"
+        }))
+    
+    def record_acks(self, username: str, body: dict):
+        """Cumulative delivered/read positions from a client, this
+        server only has the general room."""
+        for room, seq in (body.get("recv") or {}).items():
+            if room == GENERAL:
+                self.receipts.delivered(username, room, int(seq))
+        for room, seq in (body.get("read") or {}).items():
+            if room == GENERAL:
+                self.receipts.read(username, room, int(seq))
+    
+    def flush_receipts(self):
+        """Fan out read positions that moved, one frame per room."""
+        try:
+            for room, positions in self.receipts.take_changes().items():
+                self.broadcast_frame(encode_frame(Op.RECEIPTS, {"room": room, "read": positions}))
+        finally:
+            if self.running:
+                self.heartbeats.wheel.schedule("receipts", RECEIPT_INTERVAL, self.flush_receipts)
+    
+    def relay_typing(self, username: str, body: dict):
+        """Coalesced typing indicator, to the DM peer or everyone else."""
+        on = bool(body.get("on"))
+        to = body.get("to") or None
+        if not self.typing.should_forward(username, on, to):
+            return
+        indicator = {"from": username, "on": on}
+        if to:
+            indicator["to"] = to
+        frame = encode_frame(Op.TYPING, indicator)
+        if to is None:
+            self.broadcast_frame(frame, exclude=username, droppable=True)
+        elif to in self.clients:
+            self.send_frame(self.clients[to], frame, droppable=True)
+    
+    def writer_failed(self, client_socket, error: Exception):
+        """Writer could not deliver, wake the reader so it cleans up."""
+        server_log.warning("write failed", extra={"error": str(error)})
+        self.metrics.errors.labels("slow_consumer" if isinstance(error, BufferError) else "write").inc()
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def handle_file_transfer(self, transfer, sender_username, op, body):
+        """Enhanced file transfer handling, one frame at a time."""
+        try:
+            if op == Op.FILE_BEGIN:
+                filename = os.path.basename(body.get("name", "file"))
+                server_log.info("receiving file", extra={"user": sender_username, "file": filename})
+                
+                # Create received files directory
+                recv_dir = "received_files"
+                os.makedirs(recv_dir, exist_ok=True)
+                
+                # Save file
+                file_path = os.path.join(recv_dir, f"{sender_username}_{filename}")
+                return {"name": filename, "file": open(file_path, 'wb'), "size": 0,
+                        "started": time.monotonic()}
             
-            # Create received files directory
-            recv_dir = "received_files"
-            os.makedirs(recv_dir, exist_ok=True)
+            if transfer is None:
+                return None
             
-            # Save file
-            file_path = os.path.join(recv_dir, f"{sender_username}_{filename}")
+            if op == Op.FILE_CHUNK:
+                transfer["file"].write(body)
+                transfer["size"] += len(body)
+                self.metrics.file_bytes.inc(len(body))
+                return transfer
             
-            with open(file_path, 'wb') as file:
-                while True:
-                    data = client_socket.recv(4096)
-                    if data.endswith(b"<END>"):
-                        file.write(data[:-5])  # Remove <END> marker
-                        break
-                    file.write(data)
+            transfer["file"].close()
+            self.metrics.file_seconds.observe(time.monotonic() - transfer["started"])
             
             # Notify all clients
-            file_message = f"FILE_RECEIVED:{filename}"
-            self.broadcast_message(file_message)
+            self.sequencer.assign(GENERAL, lambda seq: self.broadcast_frame(encode_frame(Op.FILE_RECEIVED, {
+                "name": transfer["name"], "from": sender_username, "size": transfer["size"], "seq": seq
+            })))
             
-            print(f"✅ File '{filename}' saved successfully")
+            server_log.info("file saved", extra={"user": sender_username, "file": transfer["name"], "size": transfer["size"]})
+            return None
             
         except Exception as e:
-            print(f"File transfer error: {e}")
+            server_log.warning("file transfer error", extra={"user": sender_username, "error": str(e)})
+            self.metrics.errors.labels("file").inc()
+            if transfer is not None:
+                transfer["file"].close()
+            return None
     
-    def broadcast_message(self, message: str, exclude: str = None):
-        """Enhanced message broadcasting."""
-        disconnected_clients = []
-        
-        for username, client_socket in self.clients.items():
-            if exclude and username == exclude:
-                continue
-            
-            try:
-                client_socket.send(message.encode('utf-8'))
-            except:
-                disconnected_clients.append(username)
-        
-        # Clean up disconnected clients
-        for username in disconnected_clients:
-            if username in self.clients:
-                self.cleanup_client(username, self.clients[username])
+    def broadcast_frame(self, frame: bytes, exclude: str = None, droppable: bool = False):
+        """Enhanced frame broadcasting, only queues on each writer."""
+        with self.metrics.fanout_seconds.time():
+            for username, client_socket in list(self.clients.items()):
+                if exclude and username == exclude:
+                    continue
+                self.send_frame(client_socket, frame, droppable)
     
     def cleanup_client(self, username: str, client_socket):
         """Enhanced client cleanup."""
+        self.heartbeats.unwatch((username, client_socket))
+        self.typing.forget(username)
+        writer = self.writers.pop(client_socket, None)
+        if writer is not None:
+            writer.close(flush=False)
         try:
             client_socket.close()
         except:
             pass
         
-        if username in self.clients:
+        if self.clients.get(username) is client_socket:
             del self.clients[username]
         
-        # Notify remaining clients
-        self.broadcast_message(f"USER_LEFT:{username}")
-        print(f"🚪 {username} left the chat")
+        # Notify remaining clients with a roster delta
+        version = self.roster.remove(username)
+        if version is not None:
+            if not self.draining:
+                self.broadcast_frame(encode_frame(Op.ROSTER_REMOVE, {"v": version, "user": username}))
+            server_log.info("client left", extra={"user": username})
     
-    def cleanup_server(self):
-        """Enhanced server cleanup."""
+    def cleanup_server(self, drain_timeout: float = 5.0):
+        """Enhanced server cleanup, drains clients instead of dropping them."""
         self.running = False
+        self.heartbeats.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.beacon is not None:
+            self.beacon.stop()
+            self.beacon = None
         
-        # Close all client connections
-        for username, client_socket in list(self.clients.items()):
-            self.cleanup_client(username, client_socket)
-        
-        # Close server socket
+        # Stop accepting first
         if self.socket:
             try:
                 self.socket.close()
             except:
                 pass
         
-        print("🛑 Chat server stopped")
+        # Tell every client when to come back, spread over the drain
+        # window, and let the writers flush before the sockets close
+        self.draining = True
+        leaving = list(self.clients.items())
+        for username, client_socket in leaving:
+            writer = self.writers.get(client_socket)
+            if writer is not None:
+                after = round(random.uniform(0, self.drain_window), 3)
+                writer.send(encode_frame(Op.RECONNECT, {"after": after}))
+                writer.close(timeout=0)
+        deadline = time.monotonic() + drain_timeout
+        for username, client_socket in leaving:
+            writer = self.writers.get(client_socket)
+            if writer is not None:
+                writer.join(max(0.0, deadline - time.monotonic()))
+            self.cleanup_client(username, client_socket)
+        
+        server_log.info("server stopped", extra={"drained": len(leaving)})
 
 
 # ============================================================================
 # APPLICATION LAUNCHER
 # ============================================================================
 
+def setup_logging(path: str = None):
+    """Background logging driven by the Debug flags in ui.constants."""
+    configure_logging(
+        path,
+        verbose=Debug.ENABLE_VERBOSE_LOGGING,
+        network_traffic=Debug.LOG_NETWORK_TRAFFIC,
+        levels={UI: logging.DEBUG} if Debug.LOG_UI_EVENTS else None
+    )
+
+
 def run_chat_app():
     """Launch the enhanced chat application."""
+    setup_logging("chat_client.log")
     app = EnhancedChatApp()
-    app.run()
+    try:
+        app.run()
+    finally:
+        shutdown_logging()
 
 
 def run_chat_server():
     """Launch the enhanced chat server."""
+    setup_logging("chat_server.log")
     server = EnhancedChatServer()
     try:
         server.start_server()
     except KeyboardInterrupt:
-        print("\n🛑 Server shutdown requested")
+        server_log.info("server shutdown requested")
         server.cleanup_server()
+    finally:
+        shutdown_logging()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,359 @@
+"""
+Networking layer shared by the chat servers and the client.
+Nothing in this package imports Kivy, so servers can run headless.
+"""
+
+from .protocol import (
+    PROTOCOL_VERSION,
+    HEADER,
+    HEADER_SIZE,
+    MAX_PAYLOAD_SIZE,
+    FILE_CHUNK_SIZE,
+    Op,
+    Flags,
+    ProtocolError,
+    FrameDecoder,
+    encode_frame,
+    send_raw_frame,
+    decode_body,
+    read_frames,
+    op_name,
+)
+
+from .roster import (
+    Roster,
+    RosterReplica,
+)
+
+from .timers import TimerWheel
+
+from .heartbeat import (
+    HeartbeatMonitor,
+    DEFAULT_PING_INTERVAL,
+    DEFAULT_PONG_TIMEOUT,
+)
+
+from .ratelimit import (
+    RateLimits,
+    RateLimiter,
+    TokenBucket,
+    ThrottleStats,
+    DEFAULT_RATE_LIMITS,
+    limits_for,
+)
+
+from .buffers import (
+    BufferPool,
+    DEFAULT_SLAB_SIZE,
+)
+
+from .writer import (
+    CoalescingWriter,
+    WriterStats,
+    DEFAULT_FLUSH_WINDOW,
+    DEFAULT_MAX_BATCH_BYTES,
+    DEFAULT_MAX_QUEUE_BYTES,
+)
+
+from .sessions import (
+    Session,
+    SessionRegistry,
+)
+
+from .compression import (
+    CODEC_STREAM,
+    CODEC_ZLIB,
+    SUPPORTED_CODECS,
+    CompressionStats,
+    FrameCompressor,
+    FrameDecompressor,
+    negotiate,
+    inflate_frames,
+)
+
+from .bus import (
+    BusOp,
+    WorkerBus,
+    create_mesh,
+    close_foreign_links,
+)
+
+from .federation import (
+    Federation,
+    PeerLink,
+)
+
+from .discovery import (
+    ServerInfo,
+    DiscoveryCache,
+    DiscoveryListener,
+    BeaconSender,
+)
+
+from .indicators import (
+    TypingDebouncer,
+    TypingTracker,
+    TypingRelay,
+)
+
+from .delivery import (
+    GENERAL,
+    dm_room,
+    RoomSequencer,
+    SharedRoomSequencer,
+    RecentMessages,
+    ReceiveWindow,
+    ReceiptBoard,
+)
+
+from .history import (
+    HistoryStore,
+    ResumeTokens,
+    history_frame,
+)
+from .persistence import (
+    StateStore,
+)
+from .mailbox import (
+    OfflineMailbox,
+)
+
+from .handoff import (
+    Acceptor,
+    HandoffServer,
+    take_listener,
+    confirm_takeover,
+)
+
+from .tls import (
+    server_context,
+    client_context,
+    accept_tls,
+    is_tls,
+    TLSSessionCache,
+)
+
+from .local import (
+    listen_unix,
+    close_unix,
+    connect_unix,
+    is_local,
+    peer_credentials,
+)
+
+from .websocket import (
+    SUBPROTOCOL_JSON,
+    SUBPROTOCOL_BINARY,
+    MessageCache,
+    WebSocketDecoder,
+    WebSocketFramer,
+    accept_websocket,
+)
+
+from .e2e import (
+    DecryptionError,
+    EndToEnd,
+    Identity,
+)
+
+from .plugins import (
+    INLINE,
+    POOL,
+    ASYNC,
+    Message,
+    Plugin,
+    PluginActions,
+    Pipeline,
+)
+
+from .client import (
+    ClientSession,
+    ChatClient,
+    AsyncChatClient,
+)
+
+from .reconnect import (
+    Backoff,
+    HealthTracker,
+    ReconnectScheduler,
+)
+
+from .logs import (
+    configure_logging,
+    shutdown_logging,
+    get_logger,
+    JsonFormatter,
+    SamplingFilter,
+)
+
+from .metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+    MetricsServer,
+    ServerMetrics,
+)
+
+__all__ = [
+    # Protocol
+    'PROTOCOL_VERSION',
+    'HEADER',
+    'HEADER_SIZE',
+    'MAX_PAYLOAD_SIZE',
+    'FILE_CHUNK_SIZE',
+    'Op',
+    'Flags',
+    'ProtocolError',
+    'FrameDecoder',
+    'encode_frame',
+    'send_raw_frame',
+    'decode_body',
+    'read_frames',
+    'op_name',
+
+    # Presence
+    'Roster',
+    'RosterReplica',
+
+    # Timers and liveness
+    'TimerWheel',
+    'HeartbeatMonitor',
+    'DEFAULT_PING_INTERVAL',
+    'DEFAULT_PONG_TIMEOUT',
+
+    # Flood protection
+    'RateLimits',
+    'RateLimiter',
+    'TokenBucket',
+    'ThrottleStats',
+    'DEFAULT_RATE_LIMITS',
+    'limits_for',
+
+    # Receive buffers
+    'BufferPool',
+    'DEFAULT_SLAB_SIZE',
+
+    # Outbound batching
+    'CoalescingWriter',
+    'WriterStats',
+    'DEFAULT_FLUSH_WINDOW',
+    'DEFAULT_MAX_BATCH_BYTES',
+    'DEFAULT_MAX_QUEUE_BYTES',
+
+    # Sessions
+    'Session',
+    'SessionRegistry',
+
+    # Compression
+    'CODEC_STREAM',
+    'CODEC_ZLIB',
+    'SUPPORTED_CODECS',
+    'CompressionStats',
+    'FrameCompressor',
+    'FrameDecompressor',
+    'negotiate',
+    'inflate_frames',
+
+    # Worker processes
+    'BusOp',
+    'WorkerBus',
+    'create_mesh',
+    'close_foreign_links',
+
+    # Federation
+    'Federation',
+    'PeerLink',
+
+    # Discovery
+    'ServerInfo',
+    'DiscoveryCache',
+    'DiscoveryListener',
+    'BeaconSender',
+
+    # TLS
+    'server_context',
+    'client_context',
+    'accept_tls',
+    'is_tls',
+    'TLSSessionCache',
+
+    # Same-host clients
+    'listen_unix',
+    'close_unix',
+    'connect_unix',
+    'is_local',
+    'peer_credentials',
+
+    # WebSocket gateway
+    'SUBPROTOCOL_JSON',
+    'SUBPROTOCOL_BINARY',
+    'MessageCache',
+    'WebSocketDecoder',
+    'WebSocketFramer',
+    'accept_websocket',
+
+    # End-to-end encryption
+    'DecryptionError',
+    'EndToEnd',
+    'Identity',
+
+    # Restarts
+    'Acceptor',
+    'HandoffServer',
+    'take_listener',
+    'confirm_takeover',
+    'StateStore',
+
+    # Plugins
+    'INLINE',
+    'POOL',
+    'ASYNC',
+    'Message',
+    'Plugin',
+    'PluginActions',
+    'Pipeline',
+
+    # Client
+    'ClientSession',
+    'ChatClient',
+    'AsyncChatClient',
+
+    # Reconnects
+    'Backoff',
+    'HealthTracker',
+    'ReconnectScheduler',
+
+    # Typing indicators
+    'TypingDebouncer',
+    'TypingTracker',
+    'TypingRelay',
+
+    # Delivery
+    'GENERAL',
+    'dm_room',
+    'RoomSequencer',
+    'SharedRoomSequencer',
+    'RecentMessages',
+    'ReceiveWindow',
+    'ReceiptBoard',
+    'HistoryStore',
+    'ResumeTokens',
+    'history_frame',
+    'OfflineMailbox',
+
+    # Logging
+    'configure_logging',
+    'shutdown_logging',
+    'get_logger',
+    'JsonFormatter',
+    'SamplingFilter',
+
+    # Metrics
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'MetricsRegistry',
+    'MetricsServer',
+    'ServerMetrics',
+]
@@ -0,0 +1,76 @@
+"""
+Pooled receive buffers.
+
+sock.recv(2048) allocates a new bytes object on every call, before it
+even blocks, so every idle connection pins one, and every read leaves
+one behind for the garbage collector.
+
+BufferPool hands out fixed-size bytearray slabs for recv_into() and
+takes them back as soon as the bytes are decoded. A reader waits for
+data without holding a slab (a 1-byte MSG_PEEK), so an idle connection
+holds none at all, and the number of slabs in existence follows the
+number of reads in flight, not the number of connections.
+
+A TLS socket cannot peek, what is on the wire is ciphertext. It waits
+in select() instead, unless OpenSSL already has decrypted bytes.
+"""
+
+import select
+import socket
+import ssl
+from collections import deque
+
+DEFAULT_SLAB_SIZE = 16 * 1024
+DEFAULT_MAX_FREE = 256        # slabs kept for reuse, more are left to the GC
+
+# Target of the MSG_PEEK wait. Shared, nobody reads what lands in it
+_PEEK = bytearray(1)
+
+
+class BufferPool:
+    """Fixed-size bytearray slabs, thread-safe.
+
+    deque append and pop are atomic, the counters are only statistics.
+    """
+
+    __slots__ = ("slab_size", "max_free", "created", "reused", "_free")
+
+    def __init__(self, slab_size: int = DEFAULT_SLAB_SIZE, max_free: int = DEFAULT_MAX_FREE):
+        self.slab_size = slab_size
+        self.max_free = max_free
+        self.created = 0
+        self.reused = 0
+        self._free = deque()
+
+    def acquire(self) -> bytearray:
+        try:
+            slab = self._free.pop()
+        except IndexError:
+            self.created += 1
+            return bytearray(self.slab_size)
+        self.reused += 1
+        return slab
+
+    def release(self, slab: bytearray):
+        if len(slab) == self.slab_size and len(self._free) < self.max_free:
+            self._free.append(slab)
+
+    @property
+    def free(self) -> int:
+        return len(self._free)
+
+
+def wait_readable(sock: socket.socket) -> bool:
+    """Block until sock has data or was closed, without a buffer.
+
+    Returns False once the peer closed the connection. A TLS socket
+    cannot tell, its next read returns nothing instead.
+    """
+    if isinstance(sock, ssl.SSLSocket):
+        if sock.pending():
+            return True
+        timeout = sock.gettimeout()
+        if not select.select([sock], [], [], timeout)[0]:
+            raise socket.timeout("timed out")
+        return True
+    return sock.recv_into(_PEEK, 1, socket.MSG_PEEK) > 0
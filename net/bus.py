@@ -0,0 +1,189 @@
+"""
+Message bus between the worker processes of one server.
+
+In multi-worker mode every worker accepts clients on the same port
+(SO_REUSEPORT lets the kernel spread connections across them), so the
+clients of one chat are split over several processes. The bus joins
+them back together: before forking, the supervisor creates a full mesh
+of Unix domain socketpairs, one per pair of workers. Each worker keeps
+the ends that belong to it.
+
+Links carry the usual framing with their own opcodes (BusOp):
+
+    FORWARD   raw client frame to deliver to every local client
+    DELIVER   raw, !H name length + username + client frame, for one user
+    JOIN      {"user", "pk"}   a user logged in on the sending worker, with its public key
+    LEAVE     {"user"}   and left again
+    RECORD    raw, like DELIVER, a private message to keep in the history only
+
+Outbound frames go through a CoalescingWriter per link with no flush
+window: the bus never waits for more frames, it only batches whatever
+piled up while the previous sendmsg() was in progress. Client writers
+already linger, lingering again here would double the added latency.
+"""
+
+import socket
+import struct
+import threading
+from typing import Callable, Dict, List, Optional
+
+from .logs import NET, get_logger
+from .protocol import HEADER, HEADER_SIZE, MAX_PAYLOAD_SIZE, FrameDecoder, ProtocolError, encode_frame, read_frames
+from .writer import CoalescingWriter
+
+log = get_logger(NET)
+
+_NAME_LEN = struct.Struct("!H")
+
+# A bus frame wraps a whole client frame plus a little routing data
+MAX_BUS_PAYLOAD = MAX_PAYLOAD_SIZE + HEADER_SIZE + 1024
+BUS_QUEUE_BYTES = 64 * 1024 * 1024  # peers are local, only a hung worker fills this
+BUS_FLUSH_WINDOW = 0.0
+
+
+class BusOp:
+    """Opcodes used between workers, never seen by clients."""
+
+    FORWARD = 1
+    DELIVER = 2
+    JOIN = 3
+    LEAVE = 4
+    RECORD = 5
+
+
+BINARY_BUS_OPS = frozenset({BusOp.FORWARD, BusOp.DELIVER, BusOp.RECORD})
+
+
+def create_mesh(workers: int) -> List[Dict[int, socket.socket]]:
+    """Socketpairs for every pair of workers, call before forking.
+
+    Returns one {peer id: socket} dict per worker.
+    """
+    links: List[Dict[int, socket.socket]] = [{} for _ in range(workers)]
+    for a in range(workers):
+        for b in range(a + 1, workers):
+            sock_a, sock_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            links[a][b] = sock_a
+            links[b][a] = sock_b
+    return links
+
+
+def close_foreign_links(mesh: List[Dict[int, socket.socket]], worker_id: int):
+    """In a freshly forked worker, close every socket that is not its own."""
+    for owner, links in enumerate(mesh):
+        if owner == worker_id:
+            continue
+        for sock in links.values():
+            sock.close()
+
+
+def pack_delivery(username: str, frame: bytes) -> bytes:
+    name = username.encode("utf-8")
+    return _NAME_LEN.pack(len(name)) + name + frame
+
+
+def unpack_delivery(payload: bytes):
+    """Return (username, client frame) from a DELIVER payload."""
+    if len(payload) < _NAME_LEN.size:
+        raise ProtocolError("Truncated DELIVER frame")
+    (length,) = _NAME_LEN.unpack_from(payload)
+    end = _NAME_LEN.size + length
+    return payload[_NAME_LEN.size:end].decode("utf-8"), payload[end:]
+
+
+class WorkerBus:
+    """This worker's links to all the others.
+
+    `on_frame(peer, op, payload)` runs on the link's reader thread;
+    `on_peer_lost(peer)` runs once when a peer's link closes.
+    """
+
+    def __init__(self, worker_id: int, links: Dict[int, socket.socket],
+                 on_frame: Callable[[int, int, bytes], None],
+                 on_peer_lost: Optional[Callable[[int], None]] = None):
+        self.worker_id = worker_id
+        self.links = dict(links)
+        self.on_frame = on_frame
+        self.on_peer_lost = on_peer_lost
+        self._writers: Dict[int, CoalescingWriter] = {}
+
+    @property
+    def peers(self) -> List[int]:
+        return list(self._writers)
+
+    def start(self):
+        for peer, sock in self.links.items():
+            self._writers[peer] = CoalescingWriter(
+                sock, flush_window=BUS_FLUSH_WINDOW, max_queue_bytes=BUS_QUEUE_BYTES,
+                on_error=lambda error, peer=peer: self._link_failed(peer, error),
+                name=f"bus-w{self.worker_id}-w{peer}"
+            )
+            threading.Thread(
+                target=self._read_link, args=(peer, sock),
+                name=f"bus-r{self.worker_id}-w{peer}", daemon=True
+            ).start()
+
+    def stop(self):
+        for writer in list(self._writers.values()):
+            writer.close()
+        for sock in self.links.values():
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def publish(self, op: int, body=None):
+        """Send one bus frame to every peer."""
+        if not self._writers:
+            return
+        frame = encode_bus_frame(op, body)
+        for writer in list(self._writers.values()):
+            writer.send(frame)
+
+    def send_to(self, peer: int, op: int, body=None) -> bool:
+        """Send one bus frame to a single peer."""
+        writer = self._writers.get(peer)
+        if writer is None:
+            return False
+        return writer.send(encode_bus_frame(op, body))
+
+    def _read_link(self, peer: int, sock: socket.socket):
+        decoder = FrameDecoder(MAX_BUS_PAYLOAD)
+        try:
+            while True:
+                frames = read_frames(sock, decoder, 64 * 1024)
+                if frames is None:
+                    break
+                for op, _, payload in frames:
+                    try:
+                        self.on_frame(peer, op, payload)
+                    except Exception:
+                        log.exception("bus frame handler failed", extra={"peer": peer, "op": op})
+        except (OSError, ProtocolError) as e:
+            log.warning("bus link error", extra={"peer": peer, "error": str(e)})
+        self._drop(peer)
+
+    def _link_failed(self, peer: int, error: Exception):
+        log.warning("bus link write failed", extra={"peer": peer, "error": str(error)})
+        try:
+            self.links[peer].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _drop(self, peer: int):
+        writer = self._writers.pop(peer, None)
+        if writer is None:
+            return
+        writer.close(flush=False)
+        log.warning("bus peer lost", extra={"peer": peer})
+        if self.on_peer_lost is not None:
+            self.on_peer_lost(peer)
+
+
+def encode_bus_frame(op: int, body=None) -> bytes:
+    """Like encode_frame(), but raw payloads may wrap a full client frame."""
+    if not isinstance(body, (bytes, bytearray)):
+        return encode_frame(op, body)
+    if len(body) > MAX_BUS_PAYLOAD:
+        raise ProtocolError(f"Bus payload too large ({len(body)} bytes)")
+    return HEADER.pack(op, 0, len(body)) + bytes(body)
@@ -0,0 +1,958 @@
+"""
+Headless chat client.
+
+Everything a client does on the wire, without any UI: the HELLO and
+resume handshake, compression, the roster replica, receive windows and
+acks, the outbox of messages the server has not confirmed yet, typing
+indicators, heartbeats and end-to-end encryption. The Kivy app, the
+command line client (cli.py), bots and benchmarks all build on it.
+
+ClientSession holds that state and turns frames into events, it does no
+I/O of its own. Two transports drive it:
+
+    ChatClient       a blocking socket and a receive thread, for scripts
+                     and the Kivy app
+    AsyncChatClient  an asyncio.Protocol, no thread per client, so a
+                     load test runs thousands of them in one process
+
+Most of a client's memory is its deflate stream, about 260 KB once the
+server agrees on compression. Clients in bulk pass codecs=() and take
+about 25 KB each.
+
+Events are the on_* methods, override them in a subclass. They run
+where the transport processes frames: on the receive thread of a
+ChatClient (or whatever thread its `dispatch` hands work to, the Kivy
+app uses the UI thread) and on the event loop of an AsyncChatClient.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import e2e
+from .compression import SUPPORTED_CODECS, FrameCompressor, FrameDecompressor, inflate_frames
+from .delivery import ACK_INTERVAL, GENERAL, ReceiveWindow, dm_room, new_message_id_prefix
+from .e2e import DecryptionError, EndToEnd, Identity
+from .indicators import TypingDebouncer, TypingTracker
+from .local import connect_unix
+from .logs import CLIENT, TRAFFIC, get_logger
+from .protocol import (
+    FILE_CHUNK_SIZE, FrameDecoder, Op, ProtocolError, decode_body, encode_frame, op_name,
+    read_frames, send_raw_frame,
+)
+from .roster import RosterReplica
+from .timers import TimerWheel
+from .tls import TLSSessionCache
+
+log = get_logger(CLIENT)
+traffic_log = get_logger(TRAFFIC)
+
+DEFAULT_PORT = 1234
+CONNECT_TIMEOUT = 10.0
+HEARTBEAT_INTERVAL = 30.0   # PING this often, the PONG gives the round-trip time
+MAX_FILE_SIZE = 50 * 1024 * 1024
+TRACKED_MESSAGES = 200      # own messages per room waiting for a receipt, and queued DMs
+
+Frame = Tuple[int, int, bytes]
+
+
+class ClientSession:
+    """Protocol state of one user, independent of the transport.
+
+    A transport implements write(), write_file_chunk() and call_later(),
+    feeds received frames to inflate() on its reading thread and
+    process() on the thread the events should run on, and calls
+    stopped() when the connection is gone. Everything that touches the
+    state holds `lock`, so the user's thread can send while frames are
+    being processed.
+    """
+
+    def __init__(self, identity: Optional[Identity] = None,
+                 typing_indicators: bool = True,
+                 heartbeat: float = HEARTBEAT_INTERVAL,
+                 codecs=SUPPORTED_CODECS):
+        self.username: Optional[str] = None
+        self.host: Optional[str] = None
+        self.port: Optional[int] = None
+        self.connected = False
+        self.rtt_ms: Optional[float] = None
+        self.lock = threading.RLock()
+        self.send_lock = threading.Lock()
+        self.codecs = list(codecs)
+        self.compressor: Optional[FrameCompressor] = None
+        self.decompressor: Optional[FrameDecompressor] = None
+        self.heartbeat = heartbeat
+        self.typing_indicators = typing_indicators
+        self.e2e: Optional[EndToEnd] = None
+        if identity is not None:
+            self.enable_end_to_end(identity)
+        self.roster = RosterReplica(
+            on_snapshot=self._roster_snapshot,
+            on_add=self._roster_add,
+            on_remove=self._roster_remove,
+            request_sync=lambda: self.send_frame(Op.ROSTER_SYNC)
+        )
+        self.typing = TypingDebouncer(self._send_typing)
+        self.typing_peers = TypingTracker()
+        self.windows: Dict[str, ReceiveWindow] = {}
+        self.acked: Dict[Tuple[str, str], int] = {}  # ("recv" or "read", room) -> position last reported
+        self.message_id_prefix = new_message_id_prefix()
+        self.message_counter = itertools.count(1)
+        self.outbox = OrderedDict()  # message id -> (op, body, tag) not yet ACCEPTED
+        self.own_messages: Dict[str, OrderedDict] = {}  # room -> seq -> (id, tag) waiting for a read receipt
+        self.queued = OrderedDict()  # message id -> tag of a DM waiting in an offline mailbox
+        self.resume_token = None  # lets a reconnect pick up where this session stopped
+        self.roster_id = None
+        self.reconnect_hint = None  # ((host, port), delay) from a server that is going away
+        self._timers: Dict[str, object] = {}
+
+    def enable_end_to_end(self, identity: Identity):
+        """Seal messages with identity from the next login on."""
+        self.e2e = EndToEnd(identity, self.send_frame, self._show, self.on_notice)
+
+    # ------------------------------------------------------------------
+    # Events, override in a subclass
+    # ------------------------------------------------------------------
+
+    def on_welcome(self, resumed: bool):
+        """Logged in, `resumed` when the server picked up our old session."""
+
+    def on_message(self, sender: str, text: str, private: bool, body: dict):
+        """A chat or private message from someone else, decrypted."""
+
+    def on_roster(self, users: List[str]):
+        """Full list of online users."""
+
+    def on_user_joined(self, username: str):
+        pass
+
+    def on_user_left(self, username: str):
+        pass
+
+    def on_typing(self, users: List[str]):
+        """Who is typing now."""
+
+    def on_status(self, message_id: str, status: str, tag):
+        """One of our messages is "queued", "sent", "seen" or "refused"
+        (by a server plugin, a SYSTEM message says why). `tag` is whatever
+        was passed when sending it."""
+
+    def on_file_received(self, body: dict):
+        """The server stored a file someone sent: {"name", "from", "size"}."""
+
+    def on_latency(self, rtt_ms: float):
+        """Smoothed round-trip time, after every PONG."""
+
+    def on_throttled(self, wait: float):
+        """The server paused reading from us for sending too fast."""
+
+    def on_system(self, text: str, level: str):
+        """A notice from the server."""
+
+    def on_notice(self, text: str):
+        """A warning from end-to-end encryption, e.g. a changed key."""
+
+    def on_error(self, error: Exception):
+        """A frame could not be handled."""
+
+    def on_disconnected(self, error: Optional[Exception]):
+        """The connection was lost, not closed by us. error is None when
+        the server closed it."""
+
+    def is_reading(self) -> bool:
+        """Whether what arrives now is seen by the user, acks report
+        "read" instead of "recv" then."""
+        return True
+
+    # ------------------------------------------------------------------
+    # Transport
+    # ------------------------------------------------------------------
+
+    def write(self, data: bytes):
+        raise NotImplementedError
+
+    def write_file_chunk(self, payload):
+        """Write a FILE_CHUNK frame, caller holds send_lock."""
+        self.write(encode_frame(Op.FILE_CHUNK, payload))
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        """Run callback after delay, returns a handle with cancel()."""
+        raise NotImplementedError
+
+    def hello(self, username: str, host: Optional[str], port: Optional[int]) -> bytes:
+        """Start a connection, returns the HELLO frame to send first."""
+        with self.lock:
+            # Unconfirmed messages of another user must not be retried as ours
+            if username != self.username:
+                self.outbox.clear()
+            body = {"username": username, "caps": self.codecs}
+            if self.e2e is not None:
+                body.update(self.e2e.hello())
+            if self.resume_token and username == self.username and host == self.host:
+                body["resume"] = self.resume_state()
+            self.compressor = None
+            self.decompressor = None
+            self.username = username
+            self.host = host
+            self.port = port
+            self.rtt_ms = None
+            return encode_frame(Op.HELLO, body)
+
+    def started(self):
+        """HELLO is out, start the heartbeat."""
+        with self.lock:
+            self.connected = True
+            self._schedule("heartbeat", self.heartbeat, self._heartbeat)
+
+    def stopped(self):
+        """The connection is gone. The roster and receive windows are kept
+        for resuming the session."""
+        with self.lock:
+            self.connected = False
+            for name in list(self._timers):
+                self._cancel(name)
+            self.typing.reset()
+            for username in self.typing_peers.users():
+                self.clear_typing(username)
+
+    def inflate(self, frames: List[Frame]) -> List[Frame]:
+        """Decompress frames on the reading thread.
+
+        WELCOME switches compression on and may arrive in the same read
+        as the first compressed frames, so it is handled right here.
+        """
+        inflated = []
+        for frame in frames:
+            if frame[0] == Op.WELCOME:
+                self.negotiated(decode_body(Op.WELCOME, frame[2]).get("codec"))
+            inflated.extend(inflate_frames([frame], self.decompressor))
+        if traffic_log.isEnabledFor(logging.DEBUG):
+            for op, _, payload in inflated:
+                traffic_log.debug("frame in", extra={"op": op_name(op), "size": len(payload)})
+        return inflated
+
+    def negotiated(self, codec: Optional[str]):
+        """WELCOME seen on the wire, with the codec the server picked."""
+        if codec:
+            self.compressor = FrameCompressor(codec)
+            self.decompressor = FrameDecompressor(codec)
+
+    def process(self, frames: List[Frame]):
+        """Handle a batch of inflated frames."""
+        with self.lock:
+            for op, _, payload in frames:
+                try:
+                    body = decode_body(op, payload)
+                except ProtocolError as e:
+                    log.warning("malformed frame", extra={"error": str(e)})
+                    continue
+                self.process_message(op, body)
+
+    def _schedule(self, name: str, delay: float, callback: Callable[[], None]):
+        self._cancel(name)
+        self._timers[name] = self.call_later(delay, lambda: self._fire(name, callback))
+
+    def _fire(self, name: str, callback: Callable[[], None]):
+        self._timers.pop(name, None)
+        callback()
+
+    def _cancel(self, name: str):
+        handle = self._timers.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+
+    # ------------------------------------------------------------------
+    # Sending
+    # ------------------------------------------------------------------
+
+    def send_frame(self, op: int, body=None):
+        """Send a single frame, serialized against other senders."""
+        frame = encode_frame(op, body)
+        with self.send_lock:
+            if self.compressor is not None:
+                frame = self.compressor.compress_frame(frame)
+            self.write(frame)
+
+    def transmit(self, op: int, body: dict):
+        """Send a CHAT or PRIVATE, sealed when end-to-end encryption is on.
+        The outbox keeps the plain body, a retry is sealed anew."""
+        if self.e2e is None:
+            self.send_frame(op, body)
+        elif op == Op.PRIVATE:
+            self.e2e.send_private(body["to"], body)
+        else:
+            self.e2e.send_chat(body)
+
+    def send_chat(self, text: str, tag=None) -> str:
+        """Send to the room, returns the message id."""
+        return self._send(Op.CHAT, {"text": text}, tag)
+
+    def send_private(self, to: str, text: str, tag=None) -> str:
+        """Send to one user, returns the message id."""
+        return self._send(Op.PRIVATE, {"to": to, "text": text}, tag)
+
+    def send_message(self, message: str, tag=None) -> str:
+        """Send what a user typed, "@user: text" is a private message."""
+        if message.startswith("@") and ":" in message:
+            target, text = message[1:].split(":", 1)
+            return self.send_private(target.strip(), text.strip(), tag)
+        return self.send_chat(message, tag)
+
+    def _send(self, op: int, body: dict, tag) -> str:
+        with self.lock:
+            # The message itself ends our typing indicator
+            self.typing.reset()
+            message_id = f"{self.message_id_prefix}:{next(self.message_counter)}"
+            body["id"] = message_id
+            # It stays in the outbox until the server confirms it and is
+            # retried after a reconnect
+            self.outbox[message_id] = (op, body, tag)
+            self.transmit(op, body)
+            return message_id
+
+    def file_header(self, path: str) -> dict:
+        """FILE_BEGIN body for path, raises OSError or ValueError."""
+        size = os.path.getsize(path)
+        if size > MAX_FILE_SIZE:
+            raise ValueError(f"File is larger than {MAX_FILE_SIZE // (1024 * 1024)}MB")
+        return {"name": os.path.basename(path), "size": size}
+
+    def ping(self):
+        """PING the server, the PONG updates rtt_ms."""
+        self.send_frame(Op.PING, {"t": time.monotonic()})
+
+    def _heartbeat(self):
+        # Heartbeats keep the server from evicting us and measure RTT
+        try:
+            self.ping()
+        except OSError:
+            pass
+        if self.connected:
+            self._schedule("heartbeat", self.heartbeat, self._heartbeat)
+
+    def input_changed(self, text: str):
+        """Message input edited, feed the typing debouncer."""
+        with self.lock:
+            if not self.connected:
+                return
+            if not text.strip():
+                self.typing.stop()
+                return
+            # "@user: ..." is a private message, only that user sees us typing
+            target = None
+            if text.startswith("@") and ":" in text:
+                target = text[1:].split(":", 1)[0].strip() or None
+            self.typing.keystroke(target)
+            if "typing" not in self._timers:
+                self._schedule("typing", self.typing.idle, self._poll_typing)
+
+    def _poll_typing(self):
+        """Send "stopped typing" once the input has been idle long enough."""
+        remaining = self.typing.poll()
+        if remaining is not None:
+            self._schedule("typing", remaining, self._poll_typing)
+
+    def _send_typing(self, on: bool, to: str = None):
+        """Debouncer transition, one small frame."""
+        body = {"on": on}
+        if to:
+            body["to"] = to
+        try:
+            self.send_frame(Op.TYPING, body)
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------------
+    # Receiving
+    # ------------------------------------------------------------------
+
+    def process_message(self, op: int, body: dict):
+        """Handle one decoded frame."""
+        try:
+            if op == Op.ROSTER_SNAPSHOT:
+                self.roster.apply_snapshot(body["v"], body["users"])
+
+            elif op == Op.ROSTER_ADD:
+                self.roster.apply_add(body["v"], body["user"])
+
+            elif op == Op.ROSTER_REMOVE:
+                self.roster.apply_remove(body["v"], body["user"])
+
+            elif op == Op.WELCOME:
+                self._welcome(body)
+
+            elif op == Op.RECONNECT:
+                self._reconnect_hint(body)
+
+            elif op == Op.FILE_RECEIVED:
+                if self.received(GENERAL, body.get("seq")):
+                    self.on_file_received(body)
+
+            elif op == Op.CHAT:
+                self.clear_typing(body["from"])
+                if self.received(GENERAL, body.get("seq")):
+                    self._show(op, body)
+
+            elif op == Op.PRIVATE:
+                self.clear_typing(body["from"])
+                if self.received(dm_room(body["from"], self.username), body.get("seq")):
+                    self._show(op, body)
+
+            elif op in (Op.KEYS, Op.SENDER_KEY):
+                if self.e2e is not None:
+                    self.e2e.handle(op, body)
+
+            elif op == Op.ACCEPTED:
+                self._accepted(body)
+
+            elif op == Op.HISTORY:
+                self._history(body)
+
+            elif op == Op.RECEIPTS:
+                self._receipts(body)
+
+            elif op == Op.TYPING:
+                self._typing(body)
+
+            elif op == Op.PING:
+                self.send_frame(Op.PONG, body)
+
+            elif op == Op.PONG:
+                self._pong(body)
+
+            elif op == Op.THROTTLE:
+                self.on_throttled(float(body.get("wait", 0)))
+
+            elif op == Op.SYSTEM:
+                self.on_system(body.get("text", ""), body.get("level", "info"))
+
+        except Exception as e:
+            log.exception("message processing error")
+            self.on_error(e)
+
+    def _show(self, op: int, body: dict):
+        """Hand on a CHAT or PRIVATE, decrypted first if it is sealed."""
+        if self.e2e is not None:
+            try:
+                body = self.e2e.open(op, body)
+            except DecryptionError:
+                body = dict(body, text="(message could not be decrypted)")
+            if body is None:
+                return  # Handed on once its key arrives
+        elif e2e.is_sealed(body.get("text")):
+            body = dict(body, text="(encrypted message)")
+        self.on_message(body["from"], body["text"], op == Op.PRIVATE, body)
+
+    def _roster_snapshot(self, users: List[str]):
+        if self.e2e is not None:
+            self.e2e.set_members(users)
+        self.on_roster(users)
+
+    def _roster_add(self, username: str):
+        if username == self.username:
+            return  # Our own reconnect, replayed after a resume
+        if self.e2e is not None:
+            self.e2e.member_joined(username)
+        self.on_user_joined(username)
+
+    def _roster_remove(self, username: str):
+        if username == self.username:
+            return
+        if self.e2e is not None:
+            self.e2e.member_left(username)
+        self.clear_typing(username)
+        self.on_user_left(username)
+
+    def _pong(self, body: dict):
+        """Update the smoothed RTT from a PONG echoing our ping."""
+        sent_at = body.get("t")
+        if sent_at is None:
+            return
+        rtt_ms = (time.monotonic() - sent_at) * 1000
+        self.rtt_ms = rtt_ms if self.rtt_ms is None else 0.8 * self.rtt_ms + 0.2 * rtt_ms
+        self.on_latency(self.rtt_ms)
+
+    def resume_state(self) -> dict:
+        """Resume block for HELLO: our token and how far we got."""
+        state = {
+            "token": self.resume_token,
+            "seq": {room: window.contiguous for room, window in self.windows.items()},
+        }
+        if self.roster.in_sync and self.roster_id:
+            state["roster"] = [self.roster_id, self.roster.version]
+        return state
+
+    def _reconnect_hint(self, body: dict):
+        """The server is restarting or draining, it says when and where to come back."""
+        host = body.get("host") or self.host
+        port = body.get("port") or self.port or DEFAULT_PORT
+        self.reconnect_hint = ((host, port), max(0.0, float(body.get("after", 0))))
+
+    def _welcome(self, body: dict):
+        """Session established. A fresh one starts the receive windows where
+        the server's rooms are now, a resumed one keeps ours."""
+        self.resume_token = body.get("token")
+        self.roster_id = body.get("roster")
+        if not body.get("resumed"):
+            self.windows = {room: ReceiveWindow(seq) for room, seq in (body.get("seq") or {}).items()}
+            self.roster.reset()
+        self.acked.clear()
+        if self.e2e is not None:
+            self.e2e.start(self.username)
+        # Anything the server never confirmed is sent again with the same
+        # id, the server drops the ones it already delivered
+        for op, message, _ in list(self.outbox.values()):
+            try:
+                self.transmit(op, message)
+            except OSError:
+                break
+        self.on_welcome(bool(body.get("resumed")))
+
+    def _history(self, body: dict):
+        """Messages we missed while disconnected, in sequence order."""
+        room = body.get("room")
+        start = body.get("start")
+        if start is not None:
+            # Older messages are gone from the server, skip past them
+            window = self.windows.get(room)
+            if window is None or window.contiguous < start:
+                self.windows[room] = ReceiveWindow(start)
+        for op, message in body.get("items", []):
+            if message.get("from") == self.username:
+                # Already shown since we sent it
+                self.received(room, message.get("seq"))
+            else:
+                self.process_message(op, message)
+
+    def received(self, room: str, seq) -> bool:
+        """Record a sequenced message, False if it was already handled."""
+        if seq is None:
+            return True
+        window = self.windows.get(room)
+        if window is None:
+            window = self.windows[room] = ReceiveWindow(seq - 1)
+        if not window.add(seq):
+            return False
+        self.schedule_ack()
+        return True
+
+    def schedule_ack(self):
+        """Batch acks, at most one ACK frame per ACK_INTERVAL."""
+        with self.lock:
+            if "ack" not in self._timers and self.connected:
+                self._schedule("ack", ACK_INTERVAL, self.send_acks)
+
+    def send_acks(self):
+        """One cumulative ACK for every room that moved since the last one."""
+        if not self.connected:
+            return
+        kind = "read" if self.is_reading() else "recv"
+        positions = {
+            room: window.contiguous for room, window in self.windows.items()
+            if window.contiguous > max(self.acked.get(("read", room), 0),
+                                       self.acked.get((kind, room), 0))
+        }
+        if not positions:
+            return
+        try:
+            self.send_frame(Op.ACK, {kind: positions})
+        except OSError:
+            return
+        for room, seq in positions.items():
+            self.acked[(kind, room)] = seq
+
+    def _accepted(self, body: dict):
+        """The server numbered one of our messages."""
+        room, seq, message_id = body.get("room", GENERAL), body.get("seq"), body.get("id")
+        # Our own message takes its place in the room's sequence
+        self.received(room, seq)
+        if message_id in self.outbox:
+            tag = self.outbox.pop(message_id)[2]
+        elif message_id in self.queued:
+            tag = self.queued.pop(message_id)
+        else:
+            return
+        if body.get("refused"):
+            self.on_status(message_id, "refused", tag)
+            return
+        if body.get("queued"):
+            # The recipient is offline, a second ACCEPTED follows on delivery
+            self.queued[message_id] = tag
+            while len(self.queued) > TRACKED_MESSAGES:
+                self.queued.popitem(last=False)
+            self.on_status(message_id, "queued", tag)
+            return
+        waiting = self.own_messages.setdefault(room, OrderedDict())
+        waiting[seq] = (message_id, tag)
+        while len(waiting) > TRACKED_MESSAGES:
+            waiting.popitem(last=False)
+        self.on_status(message_id, "sent", tag)
+
+    def _receipts(self, body: dict):
+        """Read positions moved, report our messages someone has seen."""
+        waiting = self.own_messages.get(body.get("room"))
+        if not waiting:
+            return
+        seen = max((seq for user, seq in (body.get("read") or {}).items() if user != self.username), default=0)
+        while waiting and next(iter(waiting)) <= seen:
+            _, (message_id, tag) = waiting.popitem(last=False)
+            self.on_status(message_id, "seen", tag)
+
+    def _typing(self, body: dict):
+        """Someone started or stopped typing."""
+        if not self.typing_indicators:
+            return
+        sender = body.get("from")
+        if not sender or sender == self.username:
+            return
+        if self.typing_peers.update(sender, bool(body.get("on"))):
+            self.on_typing(self.typing_peers.users())
+        self._schedule_typing_expiry()
+
+    def clear_typing(self, username: str):
+        """A message or a departure ends that user's indicator."""
+        if self.typing_peers.clear(username):
+            self.on_typing(self.typing_peers.users())
+
+    def _schedule_typing_expiry(self):
+        """Wake up when the oldest indicator runs out."""
+        self._cancel("typing_expiry")
+        delay = self.typing_peers.next_expiry()
+        if delay is not None and self.connected:
+            self._schedule("typing_expiry", delay + 0.05, self._expire_typing)
+
+    def _expire_typing(self):
+        """Drop indicators whose sender went quiet without an "off"."""
+        if self.typing_peers.expire():
+            self.on_typing(self.typing_peers.users())
+        self._schedule_typing_expiry()
+
+
+# ============================================================================
+# BLOCKING SOCKET
+# ============================================================================
+
+_wheel: Optional[TimerWheel] = None
+_wheel_lock = threading.Lock()
+
+
+def _shared_wheel() -> TimerWheel:
+    """One timer thread for every ChatClient in the process."""
+    global _wheel
+    with _wheel_lock:
+        if _wheel is None:
+            _wheel = TimerWheel(tick=0.1)
+            _wheel.start()
+        return _wheel
+
+
+class _WheelTimer:
+    __slots__ = ("wheel",)
+
+    def __init__(self, wheel: TimerWheel):
+        self.wheel = wheel
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class ChatClient(ClientSession):
+    """Client over a blocking socket, frames are read on a thread of its own.
+
+    `dispatch(fn)` decides where events run, by default right on the
+    receive thread. `call_later(delay, fn)` replaces the shared timer
+    thread; a UI passes its own scheduler for both, so events and timers
+    run on the UI thread.
+    """
+
+    def __init__(self, identity: Optional[Identity] = None,
+                 dispatch: Callable[[Callable[[], None]], None] = None,
+                 call_later: Callable[[float, Callable[[], None]], object] = None,
+                 **options):
+        super().__init__(identity, **options)
+        self.sock = None
+        self.dispatch = dispatch or (lambda fn: fn())
+        self.scheduler = call_later
+        self.tls_sessions = TLSSessionCache()  # reconnects resume the TLS session
+        self.receive_thread: Optional[threading.Thread] = None
+        self.ready = threading.Event()  # set by WELCOME
+
+    def connect(self, username: str, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+                sock: socket.socket = None, tls=None, path: Optional[str] = None,
+                timeout: float = CONNECT_TIMEOUT):
+        """Connect and log in, returns once HELLO is sent. wait_ready()
+        waits for WELCOME.
+
+        `sock` is an already connected socket, e.g. from the reconnect
+        scheduler. `path` connects to the server's Unix socket instead
+        of host and port. `tls` is a client SSLContext.
+        """
+        if sock is None:
+            if path:
+                sock = connect_unix(path, timeout)
+            else:
+                sock = socket.create_connection((host, port), timeout=timeout)
+        else:
+            sock.settimeout(timeout)
+        try:
+            if tls is not None:
+                sock = self.tls_sessions.wrap(tls, sock, host, port)
+            frame = self.hello(username, host, port)
+            self.ready.clear()
+            sock.sendall(frame)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+        self.started()
+        self.receive_thread = threading.Thread(
+            target=self._receive, args=(sock,), name=f"client-{username}", daemon=True
+        )
+        self.receive_thread.start()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until the server welcomed us."""
+        return self.ready.wait(timeout)
+
+    def send_file(self, path: str):
+        """Send a file, blocks until it is written.
+        Raises OSError, or ValueError when it is too large."""
+        header = self.file_header(path)
+        self.send_frame(Op.FILE_BEGIN, header)
+        # Chunks go from one reused buffer straight to the socket unless
+        # they get compressed
+        chunk = bytearray(FILE_CHUNK_SIZE)
+        with open(path, "rb") as file, memoryview(chunk) as view:
+            while True:
+                size = file.readinto(chunk)
+                if not size:
+                    break
+                if self.compressor is not None:
+                    self.send_frame(Op.FILE_CHUNK, view[:size])
+                    continue
+                with self.send_lock:
+                    self.write_file_chunk(view[:size])
+        self.send_frame(Op.FILE_END)
+
+    def disconnect(self):
+        """Say goodbye to the server and close."""
+        try:
+            self.send_frame(Op.DISCONNECT)
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        """Drop the connection without on_disconnected."""
+        with self.lock:
+            sock, self.sock = self.sock, None
+            self.stopped()
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        thread = self.receive_thread
+        if thread and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=1.0)
+
+    def write(self, data: bytes):
+        sock = self.sock
+        if sock is not None:
+            sock.sendall(data)
+
+    def write_file_chunk(self, payload):
+        sock = self.sock
+        if sock is not None:
+            send_raw_frame(sock, Op.FILE_CHUNK, payload)
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        run = lambda: self._locked(callback)
+        if self.scheduler is not None:
+            return self.scheduler(delay, run)
+        wheel = _shared_wheel()
+        timer = _WheelTimer(wheel)
+        wheel.schedule(timer, delay, lambda: self.dispatch(run))
+        return timer
+
+    def negotiated(self, codec: Optional[str]):
+        super().negotiated(codec)
+        # The TLS 1.3 ticket has arrived by now, keep it for the reconnect
+        if self.sock is not None and self.host is not None:
+            self.tls_sessions.remember(self.host, self.port, self.sock)
+
+    def _welcome(self, body: dict):
+        super()._welcome(body)
+        self.ready.set()
+
+    def _locked(self, callback: Callable, *args):
+        with self.lock:
+            callback(*args)
+
+    def _receive(self, sock):
+        decoder = FrameDecoder()
+        error = None
+        while self.sock is sock:
+            try:
+                frames = read_frames(sock, decoder)
+                if frames is None:
+                    break
+                frames = self.inflate(frames)
+            except socket.timeout:
+                continue
+            except Exception as e:
+                error = e
+                break
+            # The whole batch goes in one dispatch
+            self.dispatch(lambda batch=frames: self.process(batch))
+        if self.sock is sock:
+            if error is not None and not isinstance(error, ConnectionResetError):
+                log.warning("receive error", extra={"error": str(error)})
+            self.dispatch(lambda: self._lost(sock, error))
+
+    def _lost(self, sock, error: Optional[Exception]):
+        with self.lock:
+            if self.sock is not sock:
+                return  # Closed or replaced meanwhile
+            self.close()
+        self.on_disconnected(error)
+
+
+# ============================================================================
+# ASYNCIO
+# ============================================================================
+
+class AsyncChatClient(ClientSession, asyncio.Protocol):
+    """Client as an asyncio protocol: events run on the loop, writes never block.
+
+        client = MyClient()
+        await client.connect("alice", "192.168.0.125")
+        client.send_chat("hello")
+        await client.wait_closed()
+    """
+
+    def __init__(self, identity: Optional[Identity] = None, **options):
+        super().__init__(identity, **options)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.transport: Optional[asyncio.Transport] = None
+        self._decoder = FrameDecoder()
+        self._ready: Optional[asyncio.Future] = None
+        self._closed: Optional[asyncio.Future] = None
+        self._writable = asyncio.Event()
+        self._closing = False
+        self._error: Optional[Exception] = None
+
+    async def connect(self, username: str, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+                      tls=None, path: Optional[str] = None, timeout: float = CONNECT_TIMEOUT):
+        """Connect, log in and wait for WELCOME."""
+        self.loop = asyncio.get_running_loop()
+        self._ready = self.loop.create_future()
+        self._closed = self.loop.create_future()
+        self._closing = False
+        self._error = None
+        frame = self.hello(username, host, port)
+        try:
+            if path:
+                await asyncio.wait_for(self.loop.create_unix_connection(lambda: self, path), timeout)
+            else:
+                await asyncio.wait_for(self.loop.create_connection(
+                    lambda: self, host, port, ssl=tls,
+                    server_hostname=host if tls is not None and tls.check_hostname else None
+                ), timeout)
+            self.transport.write(frame)
+            self.started()
+            await asyncio.wait_for(asyncio.shield(self._ready), timeout)
+        except BaseException:
+            self.close()
+            raise
+
+    async def wait_closed(self):
+        """Until the connection is gone, for any reason."""
+        if self._closed is not None:
+            await asyncio.shield(self._closed)
+
+    async def drain(self):
+        """Wait while the transport's write buffer is full."""
+        await self._writable.wait()
+
+    async def send_file(self, path: str):
+        """Send a file, pausing whenever the socket falls behind.
+        Raises OSError, or ValueError when it is too large."""
+        header = self.file_header(path)
+        self.send_frame(Op.FILE_BEGIN, header)
+        chunk = bytearray(FILE_CHUNK_SIZE)
+        with open(path, "rb") as file, memoryview(chunk) as view:
+            while True:
+                size = file.readinto(chunk)
+                if not size:
+                    break
+                self.send_frame(Op.FILE_CHUNK, view[:size])
+                await self.drain()
+        self.send_frame(Op.FILE_END)
+
+    def disconnect(self):
+        """Say goodbye to the server and close."""
+        self.send_frame(Op.DISCONNECT)
+        self.close()
+
+    def close(self):
+        """Drop the connection without on_disconnected."""
+        self._closing = True
+        if self._ready is not None and not self._ready.done():
+            self._ready.cancel()
+        self.stopped()
+        if self.transport is not None:
+            self.transport.close()
+
+    def write(self, data: bytes):
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        return self.loop.call_later(delay, callback)
+
+    def _welcome(self, body: dict):
+        super()._welcome(body)
+        if not self._ready.done():
+            self._ready.set_result(None)
+
+    # asyncio.Protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._decoder = FrameDecoder()
+        self._writable.set()
+
+    def data_received(self, data: bytes):
+        try:
+            frames = self._decoder.feed(data)
+            if frames:
+                self.process(self.inflate(frames))
+        except ProtocolError as e:
+            self._error = e
+            self.transport.close()
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.transport = None
+        self._writable.set()
+        error = exc or self._error
+        self.stopped()
+        if not self._ready.done():
+            self._ready.set_exception(error or ConnectionError("server closed the connection"))
+        if not self._closed.done():
+            self._closed.set_result(None)
+        if not self._closing:
+            self.on_disconnected(error)
@@ -0,0 +1,166 @@
+"""
+Negotiated per-connection compression.
+
+The client lists the codecs it supports in HELLO ("caps"), the server
+picks the best one it also supports and confirms it in WELCOME. From
+then on either side may set Flags.COMPRESSED on a frame whose payload
+it compressed.
+
+Two codecs are available:
+
+    deflate-stream  one raw deflate context per direction for the whole
+                    connection, flushed with Z_SYNC_FLUSH after every
+                    frame. Later frames reuse the dictionary built by
+                    earlier ones, which is what makes short chat lines
+                    compress at all.
+    zlib            independent zlib.compress() per frame.
+
+Frames smaller than `threshold` are sent as they are. Batches that are
+replays of older data (ALWAYS_COMPRESS_OPS) are compressed regardless of
+size, binary file chunks never are.
+"""
+
+import time
+import zlib
+from typing import Iterable, List, Optional
+
+from .protocol import HEADER, HEADER_SIZE, MAX_PAYLOAD_SIZE, Flags, Op, ProtocolError
+
+CODEC_STREAM = "deflate-stream"
+CODEC_ZLIB = "zlib"
+
+# Preference order used during negotiation
+SUPPORTED_CODECS = (CODEC_STREAM, CODEC_ZLIB)
+
+DEFAULT_THRESHOLD = 64    # bytes of payload below which compression is skipped
+DEFAULT_LEVEL = 6
+
+ALWAYS_COMPRESS_OPS = frozenset({Op.ROSTER_SNAPSHOT, Op.HISTORY})
+NEVER_COMPRESS_OPS = frozenset({Op.HELLO, Op.WELCOME, Op.FILE_CHUNK, Op.PEER_HELLO})
+
+
+def negotiate(offered: Iterable[str], supported: Iterable[str] = SUPPORTED_CODECS) -> Optional[str]:
+    """Pick the first codec in our preference order that the peer offered."""
+    offered = set(offered or ())
+    for codec in supported:
+        if codec in offered:
+            return codec
+    return None
+
+
+class CompressionStats:
+    """Per-connection compression counters."""
+
+    __slots__ = ("frames_in", "frames_compressed", "raw_bytes", "compressed_bytes", "cpu_seconds")
+
+    def __init__(self):
+        self.frames_in = 0
+        self.frames_compressed = 0
+        self.raw_bytes = 0          # payload bytes before compression (compressed frames only)
+        self.compressed_bytes = 0   # payload bytes after compression
+        self.cpu_seconds = 0.0
+
+    @property
+    def ratio(self) -> float:
+        """Compressed / raw size of the frames that were compressed."""
+        if not self.raw_bytes:
+            return 1.0
+        return self.compressed_bytes / self.raw_bytes
+
+    def as_dict(self) -> dict:
+        return {
+            "frames_in": self.frames_in,
+            "frames_compressed": self.frames_compressed,
+            "raw_bytes": self.raw_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "ratio": round(self.ratio, 4),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+        }
+
+
+class FrameCompressor:
+    """Compresses outbound frames of one connection.
+
+    Not thread-safe on purpose: it is only used from the connection's
+    writer thread, which also guarantees stream order.
+    """
+
+    def __init__(self, codec: str, threshold: int = DEFAULT_THRESHOLD, level: int = DEFAULT_LEVEL):
+        if codec not in SUPPORTED_CODECS:
+            raise ValueError(f"Unknown codec {codec}")
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.stats = CompressionStats()
+        self._stream = zlib.compressobj(level, zlib.DEFLATED, -15) if codec == CODEC_STREAM else None
+
+    def compress_frame(self, frame: bytes) -> bytes:
+        """Return the frame, compressed if it is worth it."""
+        op, flags, length = HEADER.unpack_from(frame)
+        self.stats.frames_in += 1
+
+        if op in NEVER_COMPRESS_OPS or flags & Flags.COMPRESSED:
+            return frame
+        if length < self.threshold and op not in ALWAYS_COMPRESS_OPS:
+            return frame
+
+        payload = memoryview(frame)[HEADER_SIZE:]
+        started = time.perf_counter()
+        if self._stream is not None:
+            compressed = self._stream.compress(payload) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            compressed = zlib.compress(payload, self.level)
+            if len(compressed) >= length:
+                # Independent frames can fall back to raw, a stream cannot
+                self.stats.cpu_seconds += time.perf_counter() - started
+                return frame
+        self.stats.cpu_seconds += time.perf_counter() - started
+
+        self.stats.frames_compressed += 1
+        self.stats.raw_bytes += length
+        self.stats.compressed_bytes += len(compressed)
+        return HEADER.pack(op, flags | Flags.COMPRESSED, len(compressed)) + compressed
+
+    def compress_batch(self, frames: List[bytes]) -> List[bytes]:
+        return [self.compress_frame(frame) for frame in frames]
+
+
+class FrameDecompressor:
+    """Inflates inbound frames flagged as compressed."""
+
+    def __init__(self, codec: str):
+        if codec not in SUPPORTED_CODECS:
+            raise ValueError(f"Unknown codec {codec}")
+        self.codec = codec
+        self._stream = zlib.decompressobj(-15) if codec == CODEC_STREAM else None
+
+    def decompress(self, payload: bytes) -> bytes:
+        """Inflate one payload, refusing anything that expands past MAX_PAYLOAD_SIZE."""
+        try:
+            if self._stream is not None:
+                data = self._stream.decompress(payload, MAX_PAYLOAD_SIZE)
+                if self._stream.unconsumed_tail:
+                    raise ProtocolError("Compressed frame expands past the size limit")
+                return data
+
+            inflater = zlib.decompressobj()
+            data = inflater.decompress(payload, MAX_PAYLOAD_SIZE)
+            if inflater.unconsumed_tail:
+                raise ProtocolError("Compressed frame expands past the size limit")
+            return data
+        except zlib.error as e:
+            raise ProtocolError(f"Corrupt compressed frame: {e}")
+
+
+def inflate_frames(frames, decompressor: Optional[FrameDecompressor]):
+    """Decompress flagged frames in a batch returned by FrameDecoder.feed()."""
+    if decompressor is None:
+        for op, flags, payload in frames:
+            if flags & Flags.COMPRESSED:
+                raise ProtocolError("Compressed frame received but compression was not negotiated")
+        return frames
+    return [
+        (op, flags & ~Flags.COMPRESSED, decompressor.decompress(payload))
+        if flags & Flags.COMPRESSED else (op, flags, payload)
+        for op, flags, payload in frames
+    ]
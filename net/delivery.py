@@ -0,0 +1,278 @@
+"""
+Message sequencing, delivery acks and read receipts.
+
+Every message that enters a room gets the next sequence number of that
+room from the server (RoomSequencer). The public chat is the room
+GENERAL; a private conversation is its own room, named by dm_room().
+Numbers are assigned and the frame is queued for local clients under
+one per-room lock, so every client of a worker sees a room in order.
+
+Clients tag what they send with an id of their own. The server
+remembers the last few ids per user (RecentMessages). A retry of an id
+it has already seen, for example after a reconnect, is answered with
+the original sequence number instead of being delivered twice.
+
+Acknowledgements are cumulative: a client reports, per room, the
+highest sequence number up to which it has received (and, separately,
+read) everything, and it does so at most every ACK_INTERVAL seconds,
+not per message (ReceiveWindow). Read positions are kept per user and
+room, and changes are fanned out as one RECEIPTS frame per room and
+interval (ReceiptBoard), so a busy room costs one small frame a second
+for receipts, not one per message and reader.
+
+Sequence numbers are local to a server. With several worker processes
+the counters live in shared memory (SharedRoomSequencer), so workers
+agree on them. Frames from different workers can still reach a client
+slightly out of order, which ReceiveWindow tolerates.
+"""
+
+import ctypes
+import hashlib
+import multiprocessing
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+GENERAL = "#general"
+ACK_INTERVAL = 0.5        # clients batch acks for this long
+RECEIPT_INTERVAL = 1.0    # servers batch read receipts for this long
+RECENT_IDS_PER_USER = 256
+MAX_REORDER = 512         # out-of-order seqs a client holds before skipping a gap
+
+
+def dm_room(a: str, b: str) -> str:
+    """Room name of the private conversation between two users."""
+    first, second = sorted((a, b))
+    return f"@{first}|{second}"
+
+
+def dm_members(room: str) -> Optional[Tuple[str, str]]:
+    """The two users of a private room, None for any other room."""
+    if not room.startswith("@") or "|" not in room:
+        return None
+    first, second = room[1:].split("|", 1)
+    return first, second
+
+
+def is_member(user: str, room: str) -> bool:
+    """Whether user may ack or read in room."""
+    members = dm_members(room)
+    return room == GENERAL if members is None else user in members
+
+
+class RoomSequencer:
+    """Monotonic sequence numbers per room, for one process."""
+
+    LOCK_STRIPES = 64
+
+    def __init__(self):
+        self._last: Dict[str, int] = {}
+        self._counter_lock = threading.Lock()
+        self._room_locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def assign(self, room: str, deliver: Callable[[int], None]) -> int:
+        """Take the next number for room and call deliver(seq).
+
+        deliver runs under the room's lock, so whatever it queues is
+        queued in sequence order. It must not block.
+        """
+        with self._room_lock(room):
+            seq = self._allocate(room)
+            deliver(seq)
+        return seq
+
+    def enter(self, room: str, register: Callable[[int], None]):
+        """Call register(current) under the room's lock.
+
+        A client registered there gets every number assigned after
+        `current` and none before it, so its window can start there.
+        """
+        with self._room_lock(room):
+            register(self.current(room))
+
+    def _room_lock(self, room: str) -> threading.Lock:
+        return self._room_locks[zlib.crc32(room.encode("utf-8")) % self.LOCK_STRIPES]
+
+    def current(self, room: str) -> int:
+        """Last number handed out for room, 0 if none."""
+        with self._counter_lock:
+            return self._last.get(room, 0)
+
+    def advance(self, room: str, seq: int):
+        """Make sure the next number for room is above seq, e.g. after a restart."""
+        with self._counter_lock:
+            if self._last.get(room, 0) < seq:
+                self._last[room] = seq
+
+    def _allocate(self, room: str) -> int:
+        with self._counter_lock:
+            seq = self._last.get(room, 0) + 1
+            self._last[room] = seq
+            return seq
+
+
+class SharedRoomSequencer(RoomSequencer):
+    """RoomSequencer whose counters are shared by forked workers.
+
+    Create it before forking. Counters sit in an open-addressed table in
+    shared memory, keyed by a 64-bit hash of the room name.
+    """
+
+    def __init__(self, slots: int = 1 << 16):
+        super().__init__()
+        self._slots = slots
+        # [hash, last seq] pairs, hash 0 marks a free slot
+        self._table = multiprocessing.RawArray(ctypes.c_uint64, 2 * slots)
+        self._shared_lock = multiprocessing.Lock()
+
+    def current(self, room: str) -> int:
+        with self._shared_lock:
+            index = self._find(room, insert=False)
+            return 0 if index is None else self._table[index + 1]
+
+    def advance(self, room: str, seq: int):
+        with self._shared_lock:
+            index = self._find(room, insert=True)
+            if self._table[index + 1] < seq:
+                self._table[index + 1] = seq
+
+    def _allocate(self, room: str) -> int:
+        with self._shared_lock:
+            index = self._find(room, insert=True)
+            self._table[index + 1] += 1
+            return self._table[index + 1]
+
+    def _find(self, room: str, insert: bool) -> Optional[int]:
+        key = _room_hash(room)
+        position = key % self._slots
+        for _ in range(self._slots):
+            index = 2 * position
+            if self._table[index] == key:
+                return index
+            if self._table[index] == 0:
+                if not insert:
+                    return None
+                self._table[index] = key
+                return index
+            position = (position + 1) % self._slots
+        raise MemoryError("Room sequence table is full")
+
+
+def _room_hash(room: str) -> int:
+    digest = hashlib.blake2b(room.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") or 1
+
+
+class RecentMessages:
+    """Client message ids seen recently, per user, for idempotent retries."""
+
+    def __init__(self, per_user: int = RECENT_IDS_PER_USER, max_users: int = 10000):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users: "OrderedDict[str, OrderedDict[str, Tuple[str, int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, user: str, message_id: str) -> Optional[Tuple[str, int]]:
+        """(room, seq) the id was given before, None if it is new."""
+        with self._lock:
+            ids = self._users.get(user)
+            return None if ids is None else ids.get(message_id)
+
+    def remember(self, user: str, message_id: str, room: str, seq: int):
+        with self._lock:
+            ids = self._users.get(user)
+            if ids is None:
+                ids = self._users[user] = OrderedDict()
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user)
+            ids[message_id] = (room, seq)
+            if len(ids) > self.per_user:
+                ids.popitem(last=False)
+
+
+class ReceiveWindow:
+    """Client side, the cumulative receive position of one room.
+
+    add() returns False for a sequence number that was already seen, so
+    retried or replayed messages are shown once. Numbers that arrive
+    ahead of a gap are held until the gap fills; the ack only covers
+    everything up to the first gap.
+    """
+
+    __slots__ = ("contiguous", "_ahead")
+
+    def __init__(self, start: int = 0):
+        self.contiguous = start
+        self._ahead = set()
+
+    def add(self, seq: int) -> bool:
+        if seq <= self.contiguous or seq in self._ahead:
+            return False
+        if seq == self.contiguous + 1:
+            self.contiguous = seq
+            while self.contiguous + 1 in self._ahead:
+                self.contiguous += 1
+                self._ahead.discard(self.contiguous)
+        else:
+            self._ahead.add(seq)
+            if len(self._ahead) > MAX_REORDER:
+                # The gap is not going to fill, stop waiting for it
+                self.contiguous = min(self._ahead)
+                self._ahead.discard(self.contiguous)
+                while self.contiguous + 1 in self._ahead:
+                    self.contiguous += 1
+                    self._ahead.discard(self.contiguous)
+        return True
+
+
+class ReceiptBoard:
+    """Server side, delivered and read positions per user and room.
+
+    Only read positions are fanned out, and only the ones that moved
+    since the last take_changes().
+    """
+
+    def __init__(self):
+        self._delivered: Dict[Tuple[str, str], int] = {}
+        self._read: Dict[Tuple[str, str], int] = {}
+        self._changed: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def delivered(self, user: str, room: str, seq: int):
+        with self._lock:
+            if seq > self._delivered.get((user, room), 0):
+                self._delivered[(user, room)] = seq
+
+    def read(self, user: str, room: str, seq: int) -> bool:
+        """Record a read position, True if it moved forward."""
+        with self._lock:
+            if seq <= self._read.get((user, room), 0):
+                return False
+            self._read[(user, room)] = seq
+            self._changed.setdefault(room, {})[user] = seq
+            if seq > self._delivered.get((user, room), 0):
+                self._delivered[(user, room)] = seq
+            return True
+
+    def delivered_position(self, user: str, room: str) -> int:
+        with self._lock:
+            return self._delivered.get((user, room), 0)
+
+    def read_position(self, user: str, room: str) -> int:
+        with self._lock:
+            return self._read.get((user, room), 0)
+
+    def take_changes(self) -> Dict[str, Dict[str, int]]:
+        """{room: {user: seq}} of read positions that moved, then forget them."""
+        with self._lock:
+            changed, self._changed = self._changed, {}
+        return changed
+
+
+def new_message_id_prefix() -> str:
+    """Per-client prefix, so ids stay unique across restarts of the app."""
+    return os.urandom(4).hex()
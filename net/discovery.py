@@ -0,0 +1,248 @@
+"""
+LAN server discovery over UDP multicast.
+
+Servers send a small beacon to a multicast group every few seconds:
+
+    {"app": "proxichat", "v": 1, "name": ..., "host": ..., "port": ...,
+     "load": ..., "t": ...}
+
+Clients listen on the group and keep a DiscoveryCache of everything
+heard recently. A server that stops beaconing drops out of the cache
+after `ttl` seconds, so whatever is in the cache is both alive and
+reachable on the local network, and the login dialog can pick the least
+loaded one instead of making the user type an address (and wait for a
+connect timeout when it is wrong).
+
+Beacons are sent with IP_MULTICAST_LOOP on and, when the server is bound
+to a specific address, out of that interface. A server bound to
+127.0.0.1 is therefore discoverable by clients on the same machine,
+which is how this is tested.
+"""
+
+import json
+import random
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .logs import NET, get_logger
+from .protocol import PROTOCOL_VERSION
+
+log = get_logger(NET)
+
+MULTICAST_GROUP = "239.255.77.77"   # organisation-local scope
+DISCOVERY_PORT = 41234
+BEACON_INTERVAL = 2.0
+DEFAULT_TTL = 3 * BEACON_INTERVAL    # forget a server after three missed beacons
+MULTICAST_HOPS = 1                   # never leave the local segment
+APP_ID = "proxichat"
+MAX_BEACON_SIZE = 1024
+
+
+class ServerInfo:
+    """One discovered server."""
+
+    __slots__ = ("name", "host", "port", "load", "version", "last_seen")
+
+    def __init__(self, name: str, host: str, port: int, load: float, version: int, last_seen: float):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.load = load
+        self.version = version
+        self.last_seen = last_seen
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.host, self.port
+
+    def __repr__(self):
+        return f"ServerInfo({self.name!r}, {self.host}:{self.port}, load={self.load})"
+
+
+def encode_beacon(name: str, port: int, load: float, host: Optional[str] = None) -> bytes:
+    beacon = {"app": APP_ID, "v": PROTOCOL_VERSION, "name": name, "port": port, "load": load, "t": time.time()}
+    if host:
+        beacon["host"] = host
+    return json.dumps(beacon, separators=(",", ":")).encode("utf-8")
+
+
+def parse_beacon(data: bytes, sender: Tuple[str, int], now: Optional[float] = None) -> Optional[ServerInfo]:
+    """ServerInfo from a datagram, None if it is not a usable beacon."""
+    try:
+        beacon = json.loads(data.decode("utf-8"))
+        if beacon.get("app") != APP_ID:
+            return None
+        return ServerInfo(
+            name=str(beacon.get("name") or sender[0]),
+            # A server bound to all interfaces does not know which of its
+            # addresses we can reach, the datagram's source does
+            host=str(beacon.get("host") or sender[0]),
+            port=int(beacon["port"]),
+            load=float(beacon.get("load", 0)),
+            version=int(beacon.get("v", 0)),
+            last_seen=time.monotonic() if now is None else now,
+        )
+    except (UnicodeDecodeError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+class DiscoveryCache:
+    """Servers heard from recently, safe to use from any thread."""
+
+    def __init__(self, ttl: float = DEFAULT_TTL, version: int = PROTOCOL_VERSION):
+        self.ttl = ttl
+        self.version = version
+        self._servers: Dict[Tuple[str, int], ServerInfo] = {}
+        self._lock = threading.Lock()
+
+    def update(self, info: ServerInfo) -> bool:
+        """Record a beacon, True if the server is new to the cache."""
+        with self._lock:
+            self._expire(info.last_seen)
+            is_new = info.address not in self._servers
+            self._servers[info.address] = info
+        return is_new
+
+    def servers(self) -> List[ServerInfo]:
+        """Live, compatible servers, least loaded first."""
+        with self._lock:
+            self._expire(time.monotonic())
+            servers = [s for s in self._servers.values() if s.version == self.version]
+        return sorted(servers, key=lambda s: (s.load, s.name))
+
+    def best(self) -> Optional[ServerInfo]:
+        servers = self.servers()
+        return servers[0] if servers else None
+
+    def get(self, host: str, port: Optional[int] = None) -> Optional[ServerInfo]:
+        """Live entry for a host, any port unless one is given."""
+        for server in self.servers():
+            if server.host == host and (port is None or server.port == port):
+                return server
+        return None
+
+    def _expire(self, now: float):
+        stale = [address for address, s in self._servers.items() if now - s.last_seen > self.ttl]
+        for address in stale:
+            del self._servers[address]
+
+
+class BeaconSender:
+    """Announces one server on the multicast group."""
+
+    def __init__(self, name: str, port: int, load: Callable[[], float],
+                 host: Optional[str] = None,
+                 group: str = MULTICAST_GROUP,
+                 discovery_port: int = DISCOVERY_PORT,
+                 interval: float = BEACON_INTERVAL):
+        self.name = name
+        self.port = port
+        self.load = load
+        # Only advertise a host that clients can actually dial
+        self.host = host if host and host not in ("0.0.0.0", "") else None
+        self.destination = (group, discovery_port)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._sock = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_HOPS)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.host:
+            try:
+                self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.host))
+            except OSError:
+                pass  # Not an IPv4 literal, use the default route
+        threading.Thread(target=self._run, name="discovery-beacon", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def send_now(self):
+        try:
+            load = float(self.load())
+        except Exception:
+            load = 0.0
+        try:
+            self._sock.sendto(encode_beacon(self.name, self.port, load, self.host), self.destination)
+        except OSError as e:
+            log.debug("beacon not sent", extra={"error": str(e)})
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.send_now()
+            # Jitter keeps servers started together from beaconing in lockstep
+            self._stop.wait(self.interval * random.uniform(0.9, 1.1))
+        self._sock.close()
+
+
+class DiscoveryListener:
+    """Fills a DiscoveryCache from beacons heard on the group.
+
+    `on_change(cache)` is called from the listener thread whenever a
+    server appears, so a UI can prefill its fields without polling.
+    """
+
+    def __init__(self, cache: DiscoveryCache,
+                 on_change: Optional[Callable[[DiscoveryCache], None]] = None,
+                 group: str = MULTICAST_GROUP,
+                 discovery_port: int = DISCOVERY_PORT):
+        self.cache = cache
+        self.on_change = on_change
+        self.group = group
+        self.discovery_port = discovery_port
+        self._running = False
+        self._sock = None
+
+    def start(self) -> bool:
+        """Join the group, False if multicast is not available here."""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(("", self.discovery_port))
+        except OSError as e:
+            log.warning("discovery unavailable", extra={"error": str(e)})
+            return False
+
+        joined = False
+        # Default interface for the LAN, loopback for servers on this machine
+        for interface in ("0.0.0.0", "127.0.0.1"):
+            try:
+                membership = socket.inet_aton(self.group) + socket.inet_aton(interface)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                joined = True
+            except OSError:
+                pass
+        if not joined:
+            sock.close()
+            log.warning("discovery unavailable", extra={"error": "cannot join multicast group"})
+            return False
+
+        sock.settimeout(1.0)
+        self._sock = sock
+        self._running = True
+        threading.Thread(target=self._run, name="discovery-listen", daemon=True).start()
+        return True
+
+    def stop(self):
+        self._running = False
+
+    def _run(self):
+        while self._running:
+            try:
+                data, sender = self._sock.recvfrom(MAX_BEACON_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            info = parse_beacon(data, sender)
+            if info is None:
+                continue
+            if self.cache.update(info) and self.on_change is not None:
+                self.on_change(self.cache)
+        self._sock.close()
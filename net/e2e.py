@@ -0,0 +1,457 @@
+"""
+End-to-end encryption of chat text.
+
+The server only relays what it is given, so encryption is entirely up to
+the clients. Encrypted text travels in the usual "text" field as an
+envelope: history, offline mailboxes, the worker bus and federation keep
+and forward it unchanged, and a room message is still encoded once and
+fanned out to every member as before.
+
+  - Private messages: every user has an X25519 identity key, the public
+    half is sent in HELLO and the server hands it out on KEY_REQUEST. Two
+    users derive a pairwise key once (X25519, then HKDF-SHA256 bound to
+    the DM room) and cache it, after that every message is one
+    ChaCha20-Poly1305 seal with a random nonce.
+  - Rooms: every sender has a sender key of its own, a random 256 bit
+    key with a short id, sent to each member once in a SENDER_KEY box
+    sealed with the pairwise key. A room message is sealed once with it,
+    whoever receives it. When a member leaves, the next message rotates
+    to a new key that the one who left never sees.
+
+The envelope, "e2e1:" then the base64 of nonce and ciphertext, has the
+sender key id in front for rooms:
+
+    e2e1:<nonce+ciphertext>          private
+    e2e1:<kid>:<nonce+ciphertext>    room
+
+The associated data binds a message to its room and its sender, so the
+server cannot pass one user's message off as another's, or move it to a
+different room.
+
+Public keys are trusted on first use: a key that changes later is
+reported through on_notice and then used, the way most messengers do it.
+
+Needs the `cryptography` package. Without it AVAILABLE is False and the
+client keeps sending plain text.
+"""
+
+import base64
+import json
+import os
+import secrets
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .delivery import GENERAL, dm_members, dm_room
+from .protocol import Op
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+PREFIX = "e2e1:"
+NONCE_SIZE = 12
+KEY_SIZE = 32
+MAX_SENDER_KEYS = 4096   # sender keys of other users kept, least recently used go first
+OWN_KEYS_KEPT = 8        # our previous sender keys, still handed out for older messages
+MAX_HELD = 1000          # received messages waiting for a key
+MAX_REQUEST_USERS = 256  # users per KEY_REQUEST, the server answers no more
+
+
+class DecryptionError(Exception):
+    """A sealed message that does not open: wrong key, or tampered with."""
+
+
+def is_sealed(text) -> bool:
+    return isinstance(text, str) and text.startswith(PREFIX)
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def seal(aead, plaintext: str, aad: bytes, kid: Optional[str] = None) -> str:
+    """Encrypt plaintext into an envelope."""
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = _b64(nonce + aead.encrypt(nonce, plaintext.encode("utf-8"), aad))
+    return PREFIX + sealed if kid is None else f"{PREFIX}{kid}:{sealed}"
+
+
+def parse(text: str) -> Tuple[Optional[str], bytes]:
+    """Split an envelope into (sender key id or None, nonce + ciphertext)."""
+    body = text[len(PREFIX):]
+    kid, _, sealed = body.rpartition(":")
+    try:
+        return kid or None, _unb64(sealed)
+    except ValueError:
+        raise DecryptionError("malformed envelope") from None
+
+
+def unseal(aead, data: bytes, aad: bytes) -> str:
+    try:
+        return aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], aad).decode("utf-8")
+    except (InvalidTag, ValueError):
+        raise DecryptionError("message does not open") from None
+
+
+def dm_aad(room: str, sender: str) -> bytes:
+    return f"dm|{room}|{sender}".encode("utf-8")
+
+
+def room_aad(room: str, sender: str, kid: str) -> bytes:
+    return f"room|{room}|{sender}|{kid}".encode("utf-8")
+
+
+def box_aad(room: str, sender: str) -> bytes:
+    return f"sk|{room}|{sender}".encode("utf-8")
+
+
+class Identity:
+    """Our long-term X25519 key pair."""
+
+    def __init__(self, private_key=None):
+        self._private = private_key or X25519PrivateKey.generate()
+        raw = self._private.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        self.public_key = _b64(raw)
+
+    @classmethod
+    def load_or_create(cls, path: Optional[str]) -> "Identity":
+        """The key in path, or a new one written there (owner-only)."""
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                return cls(X25519PrivateKey.from_private_bytes(f.read()))
+        identity = cls()
+        if path:
+            raw = identity._private.private_bytes(
+                serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                serialization.NoEncryption())
+            descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(raw)
+        return identity
+
+    def pairwise(self, room: str, peer_public: str):
+        """The AEAD shared with the owner of peer_public for a DM room."""
+        peer = X25519PublicKey.from_public_bytes(_unb64(peer_public))
+        secret = self._private.exchange(peer)
+        key = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=None,
+                   info=b"proxichat dm " + room.encode("utf-8")).derive(secret)
+        return ChaCha20Poly1305(key)
+
+
+class EndToEnd:
+    """Client side of end-to-end encryption, without any UI.
+
+    `send(op, body)` writes a frame to the server, `deliver(op, body)`
+    gets a received message that could only be opened once its key
+    arrived, and `on_notice(text)` gets anything worth telling the user.
+    Not thread safe: call it from the thread that handles frames.
+    """
+
+    def __init__(self, identity: Identity, send: Callable[[int, dict], None],
+                 deliver: Callable[[int, dict], None],
+                 on_notice: Optional[Callable[[str], None]] = None,
+                 room: str = GENERAL, plaintext_fallback: bool = True):
+        self.identity = identity
+        self.send = send
+        self.deliver = deliver
+        self.on_notice = on_notice or (lambda text: None)
+        self.room = room
+        self.plaintext_fallback = plaintext_fallback
+        self.username = None
+        self._reset()
+
+    def _reset(self):
+        self.members = set()
+        self._public: Dict[str, Optional[str]] = {}  # user -> public key, None: has none
+        self._pairwise: Dict[str, object] = {}  # peer -> AEAD
+        self._requested = set()  # users whose key is on its way
+        self._outgoing: Dict[str, List[Tuple[int, dict]]] = {}  # peer -> frames waiting for their key
+        self._boxes: Dict[str, List[str]] = {}  # peer -> sender key boxes waiting for their key
+        self._asked: Dict[str, set] = {}  # peer -> ids of our sender keys they asked for
+        self._own: Optional[Tuple[str, bytes, object]] = None  # (kid, key, AEAD)
+        self._own_old: "OrderedDict[str, bytes]" = OrderedDict()
+        self._shared_with = set()  # members that have our current sender key
+        self._rotate = False
+        self._sender_keys: "OrderedDict[Tuple[str, str], object]" = OrderedDict()
+        self._held: Dict[Tuple[str, ...], List[Tuple[int, dict, Optional[str]]]] = {}
+        self._held_count = 0
+        self._wanted = set()
+
+    # -- session -----------------------------------------------------------
+
+    def start(self, username: str):
+        """Call on WELCOME. A different user starts over, a reconnect keeps
+        the keys and asks again for whatever was lost with the connection."""
+        if username != self.username:
+            self._reset()
+            self.username = username
+        # Whoever missed our sender key while we were away gets it with the next message
+        self._shared_with.clear()
+        self._requested.clear()
+        self._wanted.clear()
+        self._request(list(self._outgoing) + list(self._boxes) + list(self._asked)
+                      + [key[1] for key in self._held if key[0] == "dm"])
+        for key in list(self._held):
+            if key[0] == "room":
+                self._want(key[1], key[2])
+
+    def hello(self) -> dict:
+        """What goes into HELLO."""
+        return {"pk": self.identity.public_key}
+
+    # -- membership --------------------------------------------------------
+
+    def set_members(self, users: Iterable[str]):
+        users = set(users) - {self.username}
+        if self.members - users:
+            self._rotate = True
+        self.members = users
+        self._shared_with &= users
+
+    def member_joined(self, user: str):
+        if user == self.username:
+            return
+        self.members.add(user)
+        if user in self._public and self._public[user] is None:
+            # Had no key last time, maybe this client has one
+            del self._public[user]
+        if self._own is not None and not self._rotate:
+            self._share(user)
+
+    def member_left(self, user: str):
+        if user in self.members:
+            self.members.discard(user)
+            self._shared_with.discard(user)
+            # The next message goes out under a key they never get
+            self._rotate = True
+
+    # -- sending -----------------------------------------------------------
+
+    def send_private(self, peer: str, body: dict):
+        """Seal body["text"] for peer and send it, once we know their key."""
+        aead = self._pairwise.get(peer)
+        if aead is not None:
+            self.send(Op.PRIVATE, self._seal_private(peer, aead, body))
+            return
+        if peer in self._public and self._public[peer] is None:
+            self._send_unsealed(peer, body)
+            return
+        self._outgoing.setdefault(peer, []).append((Op.PRIVATE, body))
+        self._request([peer])
+
+    def send_chat(self, body: dict):
+        """Seal body["text"] with our sender key and send it to the room."""
+        if self._own is None or self._rotate:
+            self._new_sender_key()
+        kid, _, aead = self._own
+        missing = self.members - self._shared_with
+        if missing:
+            self._share_all(missing)
+        sealed = dict(body, text=seal(aead, body.get("text", ""), room_aad(self.room, self.username, kid), kid))
+        self.send(Op.CHAT, sealed)
+
+    def _seal_private(self, peer: str, aead, body: dict) -> dict:
+        room = dm_room(self.username, peer)
+        return dict(body, text=seal(aead, body.get("text", ""), dm_aad(room, self.username)))
+
+    def _send_unsealed(self, peer: str, body: dict):
+        if self.plaintext_fallback:
+            self.on_notice(f"{peer} has no encryption key, message sent unencrypted.")
+            self.send(Op.PRIVATE, body)
+        else:
+            self.on_notice(f"{peer} has no encryption key, message not sent.")
+
+    def _new_sender_key(self):
+        if self._own is not None:
+            self._own_old[self._own[0]] = self._own[1]
+            while len(self._own_old) > OWN_KEYS_KEPT:
+                self._own_old.popitem(last=False)
+        key = ChaCha20Poly1305.generate_key()
+        self._own = (secrets.token_hex(4), key, ChaCha20Poly1305(key))
+        self._shared_with.clear()
+        self._rotate = False
+
+    def _share_all(self, users):
+        known = [user for user in users if user in self._pairwise]
+        for user in known:
+            self._share(user)
+        unknown = [user for user in users if user not in self._pairwise and user not in self._public]
+        if unknown:
+            self._request(unknown)
+
+    def _share(self, user: str, kid: Optional[str] = None):
+        """Send user our sender key, the current one or an older one by id."""
+        aead = self._pairwise.get(user)
+        if aead is None:
+            if kid is not None:
+                self._asked.setdefault(user, set()).add(kid)
+                self._request([user])
+            return
+        if kid is None or (self._own is not None and kid == self._own[0]):
+            kid, key = self._own[0], self._own[1]
+            self._shared_with.add(user)
+        else:
+            key = self._own_old.get(kid)
+            if key is None:
+                return
+        box = seal(aead, json.dumps({"kid": kid, "key": _b64(key)}),
+                   box_aad(dm_room(self.username, user), self.username))
+        self.send(Op.SENDER_KEY, {"to": user, "box": box})
+
+    def _request(self, users):
+        wanted = [user for user in users if user not in self._requested]
+        self._requested.update(wanted)
+        for i in range(0, len(wanted), MAX_REQUEST_USERS):
+            self.send(Op.KEY_REQUEST, {"users": wanted[i:i + MAX_REQUEST_USERS]})
+
+    # -- receiving ---------------------------------------------------------
+
+    def open(self, op: int, body: dict, room: Optional[str] = None) -> Optional[dict]:
+        """The message with its text decrypted, or None if it is held until
+        its key arrives (then it goes to deliver()). room is only needed
+        for our own private messages coming back in a HISTORY frame.
+        Raises DecryptionError for a message that can never be opened."""
+        text = body.get("text")
+        if not is_sealed(text):
+            return body
+        sender = body.get("from")
+        kid, data = parse(text)
+        if op == Op.PRIVATE and kid is None:
+            room = room or dm_room(sender, self.username)
+            peer = self._peer_of(room)
+            aead = self._pairwise.get(peer)
+            if aead is None:
+                self._hold(("dm", peer), op, body, room)
+                self._request([peer])
+                return None
+            return dict(body, text=unseal(aead, data, dm_aad(room, sender)))
+        if kid is None:
+            raise DecryptionError("room message without a sender key id")
+        if sender == self.username:
+            aead = self._own_aead(kid)
+        else:
+            aead = self._sender_keys.get((sender, kid))
+            if aead is not None:
+                self._sender_keys.move_to_end((sender, kid))
+        if aead is None:
+            self._hold(("room", sender, kid), op, body, None)
+            self._want(sender, kid)
+            return None
+        return dict(body, text=unseal(aead, data, room_aad(self.room, sender, kid)))
+
+    def handle(self, op: int, body: dict) -> bool:
+        """Take KEYS and SENDER_KEY frames, False for any other op."""
+        if op == Op.KEYS:
+            for user, public in (body.get("keys") or {}).items():
+                self._learn(user, public)
+            return True
+        if op == Op.SENDER_KEY:
+            sender = body.get("from")
+            if body.get("want"):
+                self._share(sender, body["want"])
+            elif body.get("box"):
+                self._open_box(sender, body["box"])
+            return True
+        return False
+
+    def _peer_of(self, room: str) -> str:
+        first, second = dm_members(room)
+        return second if first == self.username else first
+
+    def _own_aead(self, kid: str):
+        if self._own is not None and self._own[0] == kid:
+            return self._own[2]
+        key = self._own_old.get(kid)
+        return ChaCha20Poly1305(key) if key is not None else None
+
+    def _learn(self, user: str, public: Optional[str]):
+        self._requested.discard(user)
+        known = self._public.get(user)
+        if user in self._public and known != public and known is not None:
+            self.on_notice(f"The encryption key of {user} changed.")
+        self._public[user] = public
+        if public is None:
+            self._pairwise.pop(user, None)
+        elif known != public or user not in self._pairwise:
+            try:
+                self._pairwise[user] = self.identity.pairwise(dm_room(self.username, user), public)
+            except ValueError:
+                self._public[user] = None
+                self._pairwise.pop(user, None)
+        aead = self._pairwise.get(user)
+
+        for op, body in self._outgoing.pop(user, ()):
+            if aead is None:
+                self._send_unsealed(user, body)
+            else:
+                self.send(op, self._seal_private(user, aead, body))
+        if aead is not None:
+            if user in self.members and self._own is not None and user not in self._shared_with:
+                self._share(user)
+            for kid in self._asked.pop(user, ()):
+                self._share(user, kid)
+            for box in self._boxes.pop(user, ()):
+                self._open_box(user, box)
+            self._release(("dm", user))
+        else:
+            self._asked.pop(user, None)
+            self._boxes.pop(user, None)
+
+    def _open_box(self, sender: str, box: str):
+        aead = self._pairwise.get(sender)
+        if aead is None:
+            # Opened once their public key is here
+            self._boxes.setdefault(sender, []).append(box)
+            self._request([sender])
+            return
+        try:
+            _, data = parse(box)
+            content = json.loads(unseal(aead, data, box_aad(dm_room(self.username, sender), sender)))
+            kid, key = content["kid"], _unb64(content["key"])
+        except (DecryptionError, ValueError, KeyError, TypeError):
+            self.on_notice(f"Could not open the sender key of {sender}.")
+            return
+        self._sender_keys[(sender, kid)] = ChaCha20Poly1305(key)
+        while len(self._sender_keys) > MAX_SENDER_KEYS:
+            self._sender_keys.popitem(last=False)
+        self._wanted.discard((sender, kid))
+        self._release(("room", sender, kid))
+
+    def _want(self, sender: str, kid: str):
+        if (sender, kid) in self._wanted:
+            return
+        self._wanted.add((sender, kid))
+        if sender not in self._pairwise:
+            self._request([sender])
+        self.send(Op.SENDER_KEY, {"to": sender, "want": kid})
+
+    def _hold(self, key, op, body, room):
+        if self._held_count >= MAX_HELD:
+            self.on_notice("Too many messages waiting for encryption keys, dropping one.")
+            return
+        self._held.setdefault(key, []).append((op, body, room))
+        self._held_count += 1
+
+    def _release(self, key):
+        held = self._held.pop(key, ())
+        self._held_count -= len(held)
+        for op, body, room in held:
+            try:
+                opened = self.open(op, body, room)
+            except DecryptionError:
+                self.on_notice(f"A message from {body.get('from')} could not be decrypted.")
+                continue
+            if opened is not None:
+                self.deliver(op, opened)
@@ -0,0 +1,449 @@
+"""
+Federation: server-to-server links between ProxiChat servers.
+
+Each server runs its own chat for the clients near it and links to a
+few peer servers. Links use the client port: a peer opens a normal
+connection and sends PEER_HELLO instead of HELLO. Both sides exchange
+their name, the shared key, compression caps, the users they can reach
+and their own direct peers.
+
+Everything that happens on a server (chat lines, file notices, joins,
+leaves) becomes an event {"t": type, "o": origin, "b": boot id,
+"s": seq, "p": path, ...} and is replicated to the peers:
+
+  * Loop prevention. Every event is remembered by (origin, boot, seq)
+    and dropped when seen again; a server never sends an event to a
+    peer already on its path.
+  * Minimal hops. The previous hop has already sent the event to all
+    of its own peers, so a server only forwards to peers that are not
+    neighbours of the server it got the event from. In a full mesh
+    nothing is forwarded at all.
+  * Direct messages are not flooded. Presence events teach every
+    server which link leads to a user, and DMs follow that link.
+  * Per-link queues. Each link has its own outbound event queue and a
+    batching thread packing up to MAX_BATCH_EVENTS events per
+    PEER_EVENTS frame. Frames go through a CoalescingWriter with the
+    negotiated compression, so a busy link sends few, well compressed
+    frames and a slow peer only ever delays itself.
+
+When a link drops, the users learned over it are removed; they come back
+with the PEER_HELLO of the next connection.
+"""
+
+import hmac
+import itertools
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .compression import SUPPORTED_CODECS, FrameCompressor, FrameDecompressor, inflate_frames, negotiate
+from .logs import NET, get_logger
+from .protocol import Op, ProtocolError, FrameDecoder, decode_body, encode_frame, read_frames
+from .writer import CoalescingWriter
+
+log = get_logger(NET)
+
+BATCH_WINDOW = 0.01          # seconds a link waits to fill a batch
+MAX_BATCH_EVENTS = 256       # events per PEER_EVENTS frame
+MAX_LINK_EVENTS = 20000      # queued events before a peer counts as stuck
+SEEN_LIMIT = 50000           # remembered event ids for duplicate detection
+RECONNECT_DELAY = 5.0        # seconds between dial attempts
+HANDSHAKE_TIMEOUT = 10.0
+
+# Event types
+CHAT = "chat"
+FILE = "file"
+JOIN = "join"     # {"user", "origin"?}, origin when a relay floods a user it learned, "o" is then the relay
+LEAVE = "leave"
+DM = "dm"
+PEERS = "peers"   # link-local, tells a neighbour our current peers
+
+
+class PeerLink:
+    """One established link to a peer server."""
+
+    def __init__(self, federation: "Federation", sock: socket.socket, server: str,
+                 codec: Optional[str], peers: Iterable[str], dialed: bool):
+        self.federation = federation
+        self.sock = sock
+        self.server = server
+        self.codec = codec
+        self.peers = set(peers)
+        self.dialed = dialed
+        self.events_sent = 0
+        self.batches_sent = 0
+        self._events: List[dict] = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self.writer = CoalescingWriter(
+            sock, on_error=lambda error: self.close(f"write failed: {error}"),
+            name=f"peer-{server}",
+            compressor=FrameCompressor(codec) if codec else None
+        )
+
+    def start(self, decoder: FrameDecoder, pending=None):
+        threading.Thread(target=self._batch_loop, name=f"peer-batch-{self.server}", daemon=True).start()
+        threading.Thread(
+            target=self._read_loop, args=(decoder, pending),
+            name=f"peer-read-{self.server}", daemon=True
+        ).start()
+
+    def queue(self, event: dict) -> bool:
+        """Add an event to this link's outbound queue."""
+        with self._cond:
+            if self._closed:
+                return False
+            if len(self._events) >= MAX_LINK_EVENTS:
+                overflow = True
+            else:
+                overflow = False
+                self._events.append(event)
+                if len(self._events) == 1 or len(self._events) >= MAX_BATCH_EVENTS:
+                    self._cond.notify()
+        if overflow:
+            self.close("outbound queue full")
+            return False
+        return True
+
+    def close(self, reason: str = ""):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._events.clear()
+            self._cond.notify()
+        self.writer.close(flush=False)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        log.info("peer link closed", extra={"peer": self.server, "reason": reason})
+        self.federation._link_closed(self)
+
+    def _batch_loop(self):
+        while True:
+            with self._cond:
+                while not self._events and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Give a burst a moment to fill the batch
+                deadline = time.monotonic() + BATCH_WINDOW
+                while len(self._events) < MAX_BATCH_EVENTS and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._events[:MAX_BATCH_EVENTS]
+                del self._events[:MAX_BATCH_EVENTS]
+            try:
+                frame = encode_frame(Op.PEER_EVENTS, {"events": batch})
+            except ProtocolError:
+                # Too big for one frame, split it
+                half = len(batch) // 2 or 1
+                frames = [encode_frame(Op.PEER_EVENTS, {"events": batch[i:i + half]})
+                          for i in range(0, len(batch), half)]
+            else:
+                frames = [frame]
+            for frame in frames:
+                self.writer.send(frame)
+            self.events_sent += len(batch)
+            self.batches_sent += len(frames)
+
+    def _read_loop(self, decoder: FrameDecoder, pending):
+        decompressor = FrameDecompressor(self.codec) if self.codec else None
+        reason = "peer closed the link"
+        try:
+            while True:
+                frames = pending or read_frames(self.sock, decoder, 64 * 1024)
+                pending = None
+                if frames is None:
+                    break
+                for op, _, payload in inflate_frames(frames, decompressor):
+                    if op == Op.PEER_EVENTS:
+                        for event in decode_body(op, payload).get("events", []):
+                            self.federation._receive(self, event)
+        except (OSError, ProtocolError) as e:
+            reason = str(e)
+        self.close(reason)
+
+
+class Federation:
+    """All peer links of one server.
+
+    `on_event(event)` delivers a remote event to the local chat. It runs
+    on a link reader thread. `local_users()` returns the usernames of
+    the server's own clients.
+    """
+
+    def __init__(self, name: str,
+                 on_event: Callable[[dict], None],
+                 local_users: Callable[[], Iterable[str]],
+                 secret: Optional[str] = None,
+                 codecs: Iterable[str] = SUPPORTED_CODECS):
+        self.name = name
+        self.on_event = on_event
+        self.local_users = local_users
+        self.secret = secret or ""
+        self.codecs = tuple(codecs)
+        self.boot = int.from_bytes(os.urandom(4), "big")
+        self._seq = itertools.count(1)
+        self._lock = threading.RLock()
+        self._links: Dict[str, PeerLink] = {}
+        self._remote_users: Dict[str, Tuple[str, PeerLink]] = {}   # user -> (origin, link)
+        self._seen: "OrderedDict[tuple, None]" = OrderedDict()
+        self._dialers: Dict[Tuple[str, int], Optional[str]] = {}  # address -> server name once known
+        self._running = True
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    @property
+    def links(self) -> Dict[str, PeerLink]:
+        return dict(self._links)
+
+    def connect(self, host: str, port: int):
+        """Keep a link to the server at host:port, redialing when it drops."""
+        self._dialers[(host, port)] = None
+        threading.Thread(target=self._dial_loop, args=(host, port), name=f"peer-dial-{host}:{port}", daemon=True).start()
+
+    def accept(self, sock: socket.socket, hello: dict, decoder: FrameDecoder, pending=None) -> bool:
+        """Take over a client connection that opened with PEER_HELLO."""
+        if not self._check_hello(hello):
+            try:
+                sock.close()
+            except OSError:
+                pass
+            return False
+        try:
+            sock.sendall(self._hello_frame(exclude=hello.get("server")))
+        except OSError:
+            return False
+        self._establish(sock, hello, decoder, pending, dialed=False)
+        return True
+
+    def publish(self, kind: str, **fields):
+        """Replicate an event that happened on this server."""
+        event = self._new_event(kind, fields)
+        with self._lock:
+            links = list(self._links.values())
+        for link in links:
+            link.queue(event)
+
+    def send_direct(self, to: str, **fields) -> bool:
+        """Route a direct message towards the server that has user `to`."""
+        with self._lock:
+            entry = self._remote_users.get(to)
+        if entry is None:
+            return False
+        return entry[1].queue(self._new_event(DM, dict(fields, to=to)))
+
+    def locate(self, user: str) -> Optional[str]:
+        """Origin server of a remote user, None if unknown."""
+        entry = self._remote_users.get(user)
+        return entry[0] if entry else None
+
+    def remote_users(self) -> List[str]:
+        return list(self._remote_users)
+
+    def stop(self):
+        self._running = False
+        for link in list(self._links.values()):
+            link.close("shutting down")
+
+    # ------------------------------------------------------------------
+    # Handshake
+    # ------------------------------------------------------------------
+
+    def _hello_frame(self, exclude: Optional[str] = None) -> bytes:
+        with self._lock:
+            users = [[user, self.name] for user in self.local_users()]
+            # Split horizon: do not advertise users back to where they came from
+            users += [[user, origin] for user, (origin, link) in self._remote_users.items()
+                      if link.server != exclude]
+            peers = [server for server in self._links if server != exclude]
+        return encode_frame(Op.PEER_HELLO, {
+            "server": self.name, "key": self.secret, "caps": list(self.codecs),
+            "users": users, "peers": peers,
+        })
+
+    def _check_hello(self, hello: dict) -> bool:
+        server = hello.get("server")
+        if not server or server == self.name:
+            log.warning("peer hello rejected", extra={"peer": server, "reason": "bad name"})
+            return False
+        if not hmac.compare_digest(str(hello.get("key", "")), self.secret):
+            log.warning("peer hello rejected", extra={"peer": server, "reason": "bad key"})
+            return False
+        return True
+
+    def _dial_loop(self, host: str, port: int):
+        while self._running:
+            known = self._dialers.get((host, port))
+            if known is None or known not in self._links:
+                try:
+                    self._dial(host, port)
+                except (OSError, ProtocolError) as e:
+                    log.debug("peer dial failed", extra={"peer": f"{host}:{port}", "error": str(e)})
+            time.sleep(RECONNECT_DELAY)
+
+    def _dial(self, host: str, port: int):
+        sock = socket.create_connection((host, port), timeout=HANDSHAKE_TIMEOUT)
+        try:
+            sock.sendall(self._hello_frame())
+            decoder = FrameDecoder()
+            hello = None
+            pending = None
+            while hello is None:
+                frames = read_frames(sock, decoder, 64 * 1024)
+                if frames is None:
+                    raise ProtocolError("peer closed during handshake")
+                for i, (op, _, payload) in enumerate(frames):
+                    if op == Op.PEER_HELLO:
+                        hello = decode_body(op, payload)
+                        pending = frames[i + 1:]
+                        break
+            if not self._check_hello(hello):
+                raise ProtocolError("peer hello rejected")
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        self._dialers[(host, port)] = hello["server"]
+        self._establish(sock, hello, decoder, pending, dialed=True)
+
+    def _establish(self, sock, hello: dict, decoder: FrameDecoder, pending, dialed: bool):
+        server = hello["server"]
+        codec = negotiate(hello.get("caps"), self.codecs)
+        link = PeerLink(self, sock, server, codec, hello.get("peers", ()), dialed)
+
+        with self._lock:
+            existing = self._links.get(server)
+            if existing is not None:
+                # Both sides dialed at once: both keep the link dialed by the smaller name
+                preferred_dialer = min(self.name, server)
+                keep_new = (self.name if dialed else server) == preferred_dialer
+                if not keep_new:
+                    link.close("duplicate link")
+                    return
+            self._links[server] = link
+        if existing is not None:
+            existing.close("replaced by a new link")
+
+        log.info("peer link up", extra={"peer": server, "codec": codec, "dialed": dialed})
+        link.start(decoder, pending)
+        self._announce_peers()
+
+        # Users the peer can reach show up as joins, here and further on
+        for user, origin in hello.get("users", ()):
+            self._learn(link, user, origin)
+
+    def _announce_peers(self):
+        """Tell every neighbour who our neighbours are now."""
+        with self._lock:
+            links = list(self._links.values())
+            names = list(self._links)
+        for link in links:
+            link.queue({"t": PEERS, "peers": [name for name in names if name != link.server]})
+
+    # ------------------------------------------------------------------
+    # Replication
+    # ------------------------------------------------------------------
+
+    def _new_event(self, kind: str, fields: dict) -> dict:
+        event = dict(fields)
+        event.update(t=kind, o=self.name, b=self.boot, s=next(self._seq), p=[self.name])
+        with self._lock:
+            self._remember((self.name, self.boot, event["s"]))
+        return event
+
+    def _remember(self, key) -> bool:
+        """Record an event id, False if it was already known. Caller holds the lock."""
+        if key in self._seen:
+            return False
+        self._seen[key] = None
+        if len(self._seen) > SEEN_LIMIT:
+            self._seen.popitem(last=False)
+        return True
+
+    def _learn(self, link: PeerLink, user: str, origin: str):
+        """A user became reachable through `link`."""
+        if user in set(self.local_users()):
+            return
+        with self._lock:
+            if user in self._remote_users:
+                return
+            self._remote_users[user] = (origin, link)
+        self.on_event({"t": JOIN, "user": user, "o": origin})
+        # A new event of ours, it carries where the user really is
+        self._flood(self._new_event(JOIN, {"user": user, "origin": origin}), link)
+
+    def _receive(self, link: PeerLink, event: dict):
+        kind = event.get("t")
+        if kind == PEERS:
+            link.peers = set(event.get("peers", ()))
+            return
+
+        path = event.get("p") or []
+        with self._lock:
+            if self.name in path or not self._remember((event.get("o"), event.get("b"), event.get("s"))):
+                return
+
+        if kind == DM:
+            user = event.get("to")
+            if user in set(self.local_users()):
+                self.on_event(event)
+                return
+            entry = self._remote_users.get(user)
+            if entry is not None and entry[1] is not link:
+                entry[1].queue(dict(event, p=path + [self.name]))
+            return
+
+        if kind == JOIN:
+            user = event.get("user")
+            with self._lock:
+                if user in self._remote_users:
+                    return
+                self._remote_users[user] = (event.get("origin") or event.get("o"), link)
+        elif kind == LEAVE:
+            user = event.get("user")
+            with self._lock:
+                entry = self._remote_users.get(user)
+                if entry is None or entry[1] is not link:
+                    return
+                del self._remote_users[user]
+
+        self.on_event(event)
+        self._flood(dict(event, p=path + [self.name]), link)
+
+    def _flood(self, event: dict, source: Optional[PeerLink]):
+        """Forward to every peer the event has not reached yet."""
+        path = set(event.get("p", ()))
+        skip = source.peers if source is not None else ()
+        with self._lock:
+            links = list(self._links.values())
+        for link in links:
+            if link is source or link.server in path or link.server in skip:
+                continue
+            link.queue(event)
+
+    def _link_closed(self, link: PeerLink):
+        with self._lock:
+            if self._links.get(link.server) is link:
+                del self._links[link.server]
+            lost = [user for user, (_, via) in self._remote_users.items() if via is link]
+            for user in lost:
+                del self._remote_users[user]
+        for user in lost:
+            self.on_event({"t": LEAVE, "user": user, "o": link.server})
+            self._flood(self._new_event(LEAVE, {"user": user}), link)
+        if self._running:
+            self._announce_peers()
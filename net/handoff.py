@@ -0,0 +1,218 @@
+"""
+Zero-downtime restarts: draining and listening socket handoff.
+
+Closing the listening socket on shutdown throws away every connection
+still waiting in its backlog, and until the new server has bound the
+port, connects are refused. Instead the old process hands the socket
+itself to its successor:
+
+  1. The new process connects to the old one's Unix socket at
+     `path` (see take_listener()).
+  2. The old process stops accepting, and sends the listening socket's
+     fd over that Unix socket (SCM_RIGHTS) together with a small JSON
+     header.
+  3. The new process starts accepting on the very same socket, so the
+     backlog carries over and no connect is refused. Then it says "ok".
+  4. Only then does the old process drain: it tells every client to
+     reconnect after a random delay (Op.RECONNECT), flushes their
+     queues and closes.
+
+If the new process never says "ok", the old one just resumes accepting.
+
+Acceptor runs the accept loop in a way that can be paused and stopped
+from another thread, which a blocking accept() cannot. It can accept on
+more than one listener, e.g. the TCP port and a Unix socket; only the
+first one, the port, is handed over.
+"""
+
+import json
+import os
+import selectors
+import socket
+import threading
+from typing import Optional, Tuple
+
+from .logs import SERVER, get_logger
+
+log = get_logger(SERVER)
+
+HANDOFF_TIMEOUT = 10.0     # seconds the old process waits for the new one to confirm
+_ACK = b"ok"
+
+
+class Acceptor:
+    """Accept loop over listening sockets that other threads can pause or stop."""
+
+    def __init__(self, sock: socket.socket, *others: socket.socket):
+        self.sock = sock
+        self.listeners = (sock,) + others
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        for listener in self.listeners:
+            # Non-blocking, because a process sharing the socket may take
+            # the connection between our select() and accept()
+            listener.setblocking(False)
+            self._selector.register(listener, selectors.EVENT_READ)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._paused = False
+        self._stopped = False
+        self._idle = threading.Event()
+        self._resumed = threading.Event()
+
+    def accept(self) -> Optional[Tuple[socket.socket, tuple]]:
+        """Next client, None once stopped. Blocks while paused."""
+        while True:
+            if self._stopped:
+                self._idle.set()
+                return None
+            if self._paused:
+                self._idle.set()
+                self._resumed.wait()
+                self._resumed.clear()
+                self._idle.clear()
+                continue
+            ready = []
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wake_r:
+                    try:
+                        self._wake_r.recv(64)
+                    except BlockingIOError:
+                        pass
+                else:
+                    ready.append(key.fileobj)
+            if self._stopped or self._paused:
+                continue
+            for listener in ready:
+                try:
+                    client, address = listener.accept()
+                except (BlockingIOError, InterruptedError):
+                    continue
+                client.setblocking(True)
+                return client, address
+
+    def pause(self, timeout: Optional[float] = None) -> bool:
+        """Stop accepting until resume(). True once the loop is idle."""
+        self._paused = True
+        self._wake()
+        return self._idle.wait(timeout)
+
+    def resume(self):
+        self._paused = False
+        self._resumed.set()
+
+    def stop(self):
+        """accept() returns None from now on. Safe from signal handlers."""
+        self._stopped = True
+        self._resumed.set()
+        self._wake()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    def close(self):
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+
+class HandoffServer:
+    """Old process side, gives the listening socket to a successor.
+
+    Once the successor accepts on it, the acceptor is stopped and
+    `handed_off` is set; draining is up to the accept loop's owner.
+    """
+
+    def __init__(self, path: str, acceptor: Acceptor, info: dict):
+        self.path = path
+        self.acceptor = acceptor
+        self.info = info
+        self.handed_off = False
+        self._sock = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(1)
+        threading.Thread(target=self._run, name="handoff", daemon=True).start()
+        log.info("handoff socket ready", extra={"path": self.path})
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if not self.handed_off and os.path.exists(self.path):
+                # After a handoff the path belongs to the successor
+                os.unlink(self.path)
+
+    def _run(self):
+        while self._sock is not None:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with conn:
+                if self._hand_over(conn):
+                    self.close()
+                    return
+
+    def _hand_over(self, conn: socket.socket) -> bool:
+        log.info("successor asked for the listening socket")
+        if not self.acceptor.pause(HANDOFF_TIMEOUT):
+            self.acceptor.resume()
+            return False
+        try:
+            conn.settimeout(HANDOFF_TIMEOUT)
+            socket.send_fds(conn, [json.dumps(self.info).encode("utf-8")], [self.acceptor.sock.fileno()])
+            if conn.recv(len(_ACK)) == _ACK:
+                self.handed_off = True
+                self.acceptor.stop()
+                log.info("listening socket handed off")
+                return True
+        except OSError as e:
+            log.warning("handoff failed", extra={"error": str(e)})
+        # The successor did not make it, keep serving
+        self.acceptor.resume()
+        return False
+
+
+def take_listener(path: str, timeout: float = HANDOFF_TIMEOUT) -> Optional[Tuple[socket.socket, dict, socket.socket]]:
+    """New process side: ask the process behind path for its listening socket.
+
+    Returns (listener, info, channel), or None if nobody is there. Call
+    confirm_takeover(channel) once accepting on the listener.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    channel.settimeout(timeout)
+    try:
+        channel.connect(path)
+        data, fds, _, _ = socket.recv_fds(channel, 4096, 1)
+    except OSError as e:
+        log.info("no process to take over from", extra={"path": path, "error": str(e)})
+        channel.close()
+        return None
+    if not fds:
+        channel.close()
+        return None
+    listener = socket.socket(fileno=fds[0])
+    return listener, json.loads(data.decode("utf-8") or "{}"), channel
+
+
+def confirm_takeover(channel: socket.socket):
+    """Tell the old process we accept on the socket now, so it can drain."""
+    try:
+        channel.sendall(_ACK)
+    finally:
+        channel.close()
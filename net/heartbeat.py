@@ -0,0 +1,88 @@
+"""
+Application-level heartbeats and dead-peer eviction.
+
+TCP keeps a half-open connection around for a very long time when the
+other end vanishes (lid closed, Wi-Fi dropped). The server therefore
+tracks when it last heard from each client. After `ping_interval`
+seconds of silence it sends a PING; if nothing at all arrives within
+`pong_timeout` after that, the peer is evicted.
+
+Recording activity is a single dict store on the hot path. The actual
+checks run on a shared TimerWheel, so there is no thread per client.
+"""
+
+import time
+from typing import Callable, Dict, Hashable
+
+from .timers import TimerWheel
+
+DEFAULT_PING_INTERVAL = 15.0
+DEFAULT_PONG_TIMEOUT = 10.0
+
+
+class HeartbeatMonitor:
+    """Idle detection for a set of connections keyed by any hashable."""
+
+    def __init__(self,
+                 send_ping: Callable[[Hashable], None],
+                 evict: Callable[[Hashable], None],
+                 ping_interval: float = DEFAULT_PING_INTERVAL,
+                 pong_timeout: float = DEFAULT_PONG_TIMEOUT,
+                 wheel: TimerWheel = None):
+        self.send_ping = send_ping
+        self.evict = evict
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.wheel = wheel or TimerWheel()
+        self._last_seen: Dict[Hashable, float] = {}
+        self._pinged: Dict[Hashable, float] = {}
+
+    def start(self):
+        self.wheel.start()
+
+    def stop(self):
+        self.wheel.stop()
+
+    def watch(self, key: Hashable):
+        """Start monitoring a connection."""
+        self._last_seen[key] = time.monotonic()
+        self.wheel.schedule(key, self.ping_interval, lambda: self._check(key))
+
+    def unwatch(self, key: Hashable):
+        """Stop monitoring a connection."""
+        self.wheel.cancel(key)
+        self._last_seen.pop(key, None)
+        self._pinged.pop(key, None)
+
+    def touch(self, key: Hashable):
+        """Record inbound activity. Cheap enough to call for every frame."""
+        if key in self._last_seen:
+            self._last_seen[key] = time.monotonic()
+
+    def _check(self, key: Hashable):
+        last_seen = self._last_seen.get(key)
+        if last_seen is None:
+            return
+
+        now = time.monotonic()
+        idle = now - last_seen
+        pinged_at = self._pinged.get(key)
+
+        if pinged_at is not None and last_seen < pinged_at:
+            # Silent since our ping, the peer is gone
+            self.unwatch(key)
+            self.evict(key)
+            return
+
+        if idle < self.ping_interval:
+            # Heard from the peer recently, check again when it could go idle
+            self._pinged.pop(key, None)
+            self.wheel.schedule(key, self.ping_interval - idle, lambda: self._check(key))
+            return
+
+        self._pinged[key] = now
+        try:
+            self.send_ping(key)
+        except OSError:
+            pass
+        self.wheel.schedule(key, self.pong_timeout, lambda: self._check(key))
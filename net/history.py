@@ -0,0 +1,277 @@
+"""
+Recent message history and session resumption.
+
+A client whose Wi-Fi drops for a few seconds should not log in from
+scratch. When it reconnects, its HELLO carries a resume block:
+
+    {"token": ..., "seq": {room: last seq received}, "roster": [id, version]}
+
+If the token is valid, the server sends only what the client missed:
+HISTORY frames with the messages after each room's position, and the
+roster deltas after its roster version. A fresh login still gets the
+full snapshot.
+
+HistoryStore keeps the last `per_room` messages of every room as
+(seq, op, payload), the payload being the JSON bytes that went out on
+the wire, so replays splice them into HISTORY frames without decoding
+or encoding anything. Typing indicators, receipts and other soft state
+are never numbered, so they are never stored. When the client's
+position is older than anything retained, the replay starts at the
+oldest message the store still has, and the HISTORY frame says where
+("start"), so the client moves its window past the messages that are
+gone.
+
+Rooms restored from a snapshot (net/persistence.py) stay encoded until
+a client needs them, which keeps startup independent of how many
+messages were stored.
+
+Resume tokens are stateless: an HMAC over the username and the issue
+time. Any worker process that shares the secret can check them, so a
+client may resume on a different worker than the one it lost.
+"""
+
+import base64
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .delivery import GENERAL, dm_members
+from .protocol import HEADER, Flags, Op
+
+HISTORY_PER_ROOM = 1000
+MAX_ROOMS = 10000
+HISTORY_BATCH = 128           # messages per HISTORY frame
+HISTORY_BATCH_BYTES = 256 * 1024
+RESUME_TTL = 24 * 3600       # a token older than this starts a fresh session
+
+_TOKEN = struct.Struct("!d")
+
+
+class HistoryStore:
+    """Bounded, in-memory history of the numbered messages of every room.
+
+    `journal(room, seq, op, payload)` is called for every message that
+    is new to the store, under the store's lock, so it must not block.
+    """
+
+    def __init__(self, per_room: int = HISTORY_PER_ROOM, max_rooms: int = MAX_ROOMS):
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        self.journal: Optional[Callable[[str, int, int, bytes], None]] = None
+        # room -> ([seq], [(op, payload)]), or a snapshot block not decoded yet
+        self._rooms: "OrderedDict[str, object]" = OrderedDict()
+        self._members: Dict[str, set] = {}  # user -> private rooms
+        self._dirty: Set[str] = set()       # rooms changed since take_dirty()
+        self._lock = threading.Lock()
+
+    def append(self, room: str, seq: int, op: int, payload: bytes, journal: bool = True) -> bool:
+        """Store one message. Out of order appends (other workers) are fine.
+
+        Returns False if the store already had it.
+        """
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                entry = self._rooms[room] = ([], [])
+                self._index(room)
+                if len(self._rooms) > self.max_rooms:
+                    self._drop(next(iter(self._rooms)))
+            else:
+                self._rooms.move_to_end(room)
+                if not isinstance(entry, tuple):
+                    if seq > entry.last_seq:
+                        # Newer than the whole block: kept beside it, replaying
+                        # the log on startup decodes no room
+                        if not isinstance(entry, _Tail):
+                            entry = self._rooms[room] = _Tail(entry, self.per_room)
+                        entry.seqs.append(seq)
+                        entry.items.append((op, payload))
+                        entry.last_seq = seq
+                        if len(entry.seqs) >= self.per_room:
+                            # The block has nothing left worth keeping
+                            self._rooms[room] = (entry.seqs, entry.items)
+                        return self._added(room, seq, op, payload, journal)
+                    entry = self._rooms[room] = entry.decode()
+            seqs, items = entry
+            if seqs and seq <= seqs[-1]:
+                at = bisect.bisect_left(seqs, seq)
+                if at < len(seqs) and seqs[at] == seq:
+                    return False
+            else:
+                at = len(seqs)
+            seqs.insert(at, seq)
+            items.insert(at, (op, payload))
+            if len(seqs) > self.per_room:
+                del seqs[0]
+                del items[0]
+            return self._added(room, seq, op, payload, journal)
+
+    def since(self, room: str, seq: int) -> Tuple[int, List[Tuple[int, bytes]]]:
+        """(start, messages) after seq. start > seq means older ones are gone."""
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                return seq, []
+            if not isinstance(entry, tuple):
+                entry = self._rooms[room] = entry.decode()
+            seqs, items = entry
+            start = seq
+            if seqs and seqs[0] > seq + 1:
+                start = seqs[0] - 1
+            at = bisect.bisect_right(seqs, start)
+            return start, items[at:]
+
+    def last(self, room: str) -> int:
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                return 0
+            if not isinstance(entry, tuple):
+                return entry.last_seq
+            return entry[0][-1] if entry[0] else 0
+
+    def rooms_of(self, user: str) -> List[str]:
+        """The general room plus every private room user is part of."""
+        with self._lock:
+            return [GENERAL] + sorted(self._members.get(user, ()))
+
+    # -- snapshots, see net/persistence.py ----------------------------------
+
+    def restore(self, blocks: Dict[str, object]):
+        """Install rooms from a snapshot. A block needs `last_seq` and
+        `decode() -> (seqs, items)`, it is decoded when first used."""
+        with self._lock:
+            for room, block in blocks.items():
+                if room not in self._rooms:
+                    self._index(room)
+                self._rooms[room] = block
+
+    def rooms(self) -> List[str]:
+        with self._lock:
+            return list(self._rooms)
+
+    def take_dirty(self) -> Set[str]:
+        """Rooms changed since the last call."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def export(self, room: str):
+        """A stable copy of room for a snapshot: (seqs, items), a block
+        that was never decoded, or None if the room is gone."""
+        with self._lock:
+            entry = self._rooms.get(room)
+            if isinstance(entry, _Tail):
+                entry = self._rooms[room] = entry.decode()
+            if entry is None or not isinstance(entry, tuple):
+                return entry
+            return list(entry[0]), list(entry[1])
+
+    def _added(self, room: str, seq: int, op: int, payload: bytes, journal: bool) -> bool:
+        self._dirty.add(room)
+        if journal and self.journal is not None:
+            self.journal(room, seq, op, payload)
+        return True
+
+    def _index(self, room: str):
+        for user in dm_members(room) or ():
+            self._members.setdefault(user, set()).add(room)
+
+    def _drop(self, room: str):
+        del self._rooms[room]
+        for user in dm_members(room) or ():
+            rooms = self._members.get(user)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self._members[user]
+
+
+class _Tail:
+    """A room restored from a snapshot plus the messages appended after
+    it, decoded together the first time a client needs the room."""
+
+    __slots__ = ("block", "seqs", "items", "last_seq", "per_room")
+
+    def __init__(self, block, per_room: int):
+        self.block = block
+        self.seqs: List[int] = []
+        self.items: List[Tuple[int, bytes]] = []
+        self.last_seq = block.last_seq
+        self.per_room = per_room
+
+    def decode(self) -> Tuple[List[int], List[Tuple[int, bytes]]]:
+        seqs, items = self.block.decode()
+        seqs += self.seqs
+        items += self.items
+        excess = len(seqs) - self.per_room
+        if excess > 0:
+            del seqs[:excess]
+            del items[:excess]
+        return seqs, items
+
+
+def history_batches(items: List[Tuple[int, bytes]], max_items: int = HISTORY_BATCH,
+                    max_bytes: int = HISTORY_BATCH_BYTES):
+    """Split replayed messages into lists of (op, payload) that fit a frame."""
+    batch, size = [], 0
+    for item in items:
+        weight = 8 + len(item[1])
+        if batch and (len(batch) >= max_items or size + weight > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(item)
+        size += weight
+    if batch:
+        yield batch
+
+
+def history_frame(room: str, batch: List[Tuple[int, bytes]], start: Optional[int] = None) -> bytes:
+    """HISTORY frame {"room", "items": [[op, body], ...], "start"?} built
+    around the stored payloads, which are JSON already."""
+    head = {"room": room}
+    if start is not None:
+        head["start"] = start
+    payload = b"".join((
+        json.dumps(head, separators=(",", ":"))[:-1].encode("utf-8"),
+        b',"items":[',
+        b",".join(b"[%d,%s]" % (op, body) for op, body in batch),
+        b"]}",
+    ))
+    return HEADER.pack(Op.HISTORY, Flags.NONE, len(payload)) + payload
+
+
+class ResumeTokens:
+    """Issues and checks session resume tokens."""
+
+    def __init__(self, secret: Optional[bytes] = None, ttl: float = RESUME_TTL):
+        self.secret = secret or os.urandom(32)
+        self.ttl = ttl
+
+    def issue(self, username: str, now: Optional[float] = None) -> str:
+        issued = _TOKEN.pack(time.time() if now is None else now)
+        return base64.urlsafe_b64encode(issued + self._mac(username, issued)).decode("ascii")
+
+    def verify(self, token, username: str, now: Optional[float] = None) -> bool:
+        """True if token was issued to username and has not expired."""
+        if not isinstance(token, str):
+            return False
+        try:
+            raw = base64.urlsafe_b64decode(token.encode("ascii"))
+        except (ValueError, UnicodeEncodeError):
+            return False
+        issued, mac = raw[:_TOKEN.size], raw[_TOKEN.size:]
+        if len(issued) != _TOKEN.size or not hmac.compare_digest(mac, self._mac(username, issued)):
+            return False
+        age = (time.time() if now is None else now) - _TOKEN.unpack(issued)[0]
+        return 0 <= age <= self.ttl
+
+    def _mac(self, username: str, issued: bytes) -> bytes:
+        return hmac.new(self.secret, username.encode("utf-8") + b"\0" + issued, hashlib.sha256).digest()[:16]
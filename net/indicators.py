@@ -0,0 +1,149 @@
+"""
+Typing indicators.
+
+A naive implementation sends a frame per keystroke. Here the sender
+only reports transitions: TypingDebouncer turns a stream of keystrokes
+into one "on" when typing starts, a refresh every `refresh` seconds
+while it continues, and one "off" after `idle` seconds without a key
+(or nothing at all when the message is sent, since the message itself
+ends the indicator).
+
+Indicators are soft state. Receivers drop them after `ttl` seconds
+unless refreshed (TypingTracker), so a lost "off" or a crashed peer can
+never leave someone "typing" forever. The server never stores them,
+coalesces repeats (TypingRelay), sends them only to the DM peer when
+the user is typing a private message, and queues them as droppable so
+they are the first thing thrown away when a client falls behind.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+TYPING_TTL = 6.0        # receivers forget an indicator after this long
+TYPING_REFRESH = 3.0    # senders repeat "on" this often while typing
+TYPING_IDLE = 4.0       # no keystroke for this long means "stopped typing"
+
+
+class TypingDebouncer:
+    """Sender side, turns keystrokes into on/off transitions.
+
+    `send(on, to)` is called with to=None for the room or a username
+    for a direct message. Not thread-safe, drive it from one thread.
+    """
+
+    def __init__(self, send: Callable[[bool, Optional[str]], None],
+                 idle: float = TYPING_IDLE, refresh: float = TYPING_REFRESH):
+        self.send = send
+        self.idle = idle
+        self.refresh = refresh
+        self.active = False
+        self.target: Optional[str] = None
+        self._last_key = 0.0
+        self._last_sent = 0.0
+
+    def keystroke(self, target: Optional[str] = None, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self._last_key = now
+        if self.active and target != self.target:
+            # Switched between room and DM, end the old indicator first
+            self.send(False, self.target)
+            self.active = False
+        if not self.active or now - self._last_sent >= self.refresh:
+            self.active = True
+            self.target = target
+            self._last_sent = now
+            self.send(True, target)
+
+    def poll(self, now: Optional[float] = None) -> Optional[float]:
+        """Stop if idle. Returns seconds until the next poll is useful, or None."""
+        if not self.active:
+            return None
+        now = time.monotonic() if now is None else now
+        remaining = self._last_key + self.idle - now
+        if remaining > 0:
+            return remaining
+        self.stop()
+        return None
+
+    def stop(self):
+        """Explicit stop, e.g. the input was cleared."""
+        if self.active:
+            self.active = False
+            self.send(False, self.target)
+
+    def reset(self):
+        """Forget the state without sending, the message that was just
+        sent ends the indicator on the receiving side."""
+        self.active = False
+
+
+class TypingTracker:
+    """Receiver side, who is typing right now."""
+
+    def __init__(self, ttl: float = TYPING_TTL):
+        self.ttl = ttl
+        self._expires: Dict[str, float] = {}
+
+    def update(self, user: str, on: bool, now: Optional[float] = None) -> bool:
+        """Apply an indicator, True if the visible set changed."""
+        if not on:
+            return self.clear(user)
+        now = time.monotonic() if now is None else now
+        is_new = user not in self._expires
+        self._expires[user] = now + self.ttl
+        return is_new
+
+    def clear(self, user: str) -> bool:
+        return self._expires.pop(user, None) is not None
+
+    def expire(self, now: Optional[float] = None) -> bool:
+        """Drop stale indicators, True if any were dropped."""
+        now = time.monotonic() if now is None else now
+        stale = [user for user, expires in self._expires.items() if expires <= now]
+        for user in stale:
+            del self._expires[user]
+        return bool(stale)
+
+    def next_expiry(self, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until the next indicator runs out, None if nobody is typing."""
+        if not self._expires:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, min(self._expires.values()) - now)
+
+    def users(self) -> List[str]:
+        return sorted(self._expires)
+
+
+class TypingRelay:
+    """Server side coalescing of indicators, one entry per sender.
+
+    Repeats of the same state are only passed on as TTL refreshes, at
+    most once per `refresh` seconds, however often a client sends them.
+    """
+
+    def __init__(self, refresh: float = TYPING_REFRESH):
+        self.refresh = refresh
+        self._state: Dict[str, Tuple[bool, Optional[str], float]] = {}
+        self._lock = threading.Lock()
+
+    def should_forward(self, sender: str, on: bool, to: Optional[str], now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            previous = self._state.get(sender)
+            if previous is None and not on:
+                return False
+            if previous is not None and previous[0] == on and previous[1] == to:
+                if not on or now - previous[2] < self.refresh * 0.9:
+                    return False
+            if on:
+                self._state[sender] = (on, to, now)
+            else:
+                self._state.pop(sender, None)
+            return True
+
+    def forget(self, sender: str):
+        """Sender sent a message or left, their indicator is over."""
+        with self._lock:
+            self._state.pop(sender, None)
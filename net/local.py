@@ -0,0 +1,87 @@
+"""
+Unix domain socket listener for clients on the server's own host.
+
+Bots, bridges and benchmarks usually run next to the server. Over a
+Unix socket they skip the TCP/IP stack entirely: no checksums, no
+Nagle or delayed ACKs, no loopback routing, just a copy between two
+socket buffers. The protocol is the same frame for frame, and accepted
+connections go through the same client handler and session registry
+as TCP ones.
+
+Access is controlled by the file system: the socket file gets `mode`,
+so only users allowed to open it can connect. TLS is not used on it,
+the bytes never leave the machine.
+
+A restarted server binds a temporary name and renames it over the path,
+so the path always leads to a server and a connect is never refused;
+connections queue in the new server's backlog until it accepts. The old
+process only removes the path on close if it is still its own socket.
+
+With several worker processes the listener is created before forking
+and every worker accepts on it, like the TCP port.
+"""
+
+import os
+import socket
+import struct
+from typing import Dict, Optional, Tuple
+
+_UCRED = struct.Struct("3i")  # pid, uid, gid
+_owned: Dict[str, int] = {}  # path -> inode of the socket file we bound
+
+
+def listen_unix(path: str, mode: int = 0o660, backlog: int = 128) -> socket.socket:
+    """Listening Unix socket at path, replacing whatever is there."""
+    temp = f"{path}.{os.getpid()}"
+    if os.path.exists(temp):
+        os.unlink(temp)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(temp)
+        os.chmod(temp, mode)
+        sock.listen(backlog)
+        os.replace(temp, path)
+    except OSError:
+        sock.close()
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+    _owned[path] = os.stat(path).st_ino
+    return sock
+
+
+def close_unix(sock: socket.socket, path: str):
+    """Close the listener, and remove path unless a successor owns it now."""
+    inode = _owned.pop(path, None)
+    sock.close()
+    try:
+        if inode is not None and os.stat(path).st_ino == inode:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+def is_local(sock) -> bool:
+    return getattr(sock, "family", None) == socket.AF_UNIX
+
+
+def peer_credentials(sock) -> Optional[Tuple[int, int, int]]:
+    """(pid, uid, gid) of the process on the other end, None where unsupported."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    try:
+        return _UCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _UCRED.size))
+    except OSError:
+        return None
+
+
+def connect_unix(path: str, timeout: Optional[float] = None) -> socket.socket:
+    """Client side: a connected socket to the server at path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,188 @@
+"""
+Structured, asynchronous logging.
+
+Every subsystem logs through a "proxichat.<subsystem>" logger. Calling
+threads only build the LogRecord and put it on a queue; one listener
+thread formats it and does the actual I/O, so a slow terminal or disk
+never stalls a reader or writer thread.
+
+Output is JSON lines (one object per record, extra= fields included)
+written to a rotating file, plus an optional short human readable line
+on the console.
+
+High-volume events (per-frame traffic) go through a SamplingFilter that
+lets only every Nth record of the same kind through. Warnings and
+errors are never sampled.
+"""
+
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import Dict, Optional
+
+ROOT = "proxichat"
+
+# Subsystem loggers, see get_logger()
+SERVER = "server"
+CLIENT = "client"
+NET = "net"
+TRAFFIC = "traffic"   # per-frame events, only on with LOG_NETWORK_TRAFFIC
+UI = "ui"
+SUBSYSTEMS = (SERVER, CLIENT, NET, TRAFFIC, UI)
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+DEFAULT_SAMPLE_EVERY = 100
+
+# LogRecord attributes that are not user supplied extra= fields
+_RESERVED = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Logger of one subsystem, e.g. get_logger(SERVER)."""
+    return logging.getLogger(f"{ROOT}.{subsystem}")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, extra= fields become keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Short line for humans: time, level, subsystem, message and fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(
+            f"{key}={value}" for key, value in record.__dict__.items()
+            if key not in _RESERVED and not key.startswith("_")
+        )
+        stamp = time.strftime("%H:%M:%S", time.localtime(record.created))
+        name = record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + ".") else record.name
+        line = f"{stamp} {record.levelname:<7} {name:<7} {record.getMessage()}"
+        if fields:
+            line = f"{line}  {fields}"
+        if record.exc_info:
+            line = f"{line}\n{self.formatException(record.exc_info)}"
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Pass one in `every` records per message template.
+
+    Runs on the calling thread, so it is kept to a dict lookup and a
+    next() on an itertools counter, which is atomic in CPython.
+    """
+
+    def __init__(self, every: int = DEFAULT_SAMPLE_EVERY):
+        super().__init__()
+        self.every = max(1, every)
+        self._counters: Dict[str, itertools.count] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.every == 1:
+            return True
+        counter = self._counters.get(record.msg)
+        if counter is None:
+            counter = self._counters.setdefault(record.msg, itertools.count())
+        if next(counter) % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps extra= fields and skips pre-formatting.
+
+    Records are only read by our own listener thread, so there is no
+    need to flatten them the way the stock handler does for pickling.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def configure_logging(path: Optional[str] = None,
+                      verbose: bool = False,
+                      network_traffic: bool = False,
+                      console: bool = True,
+                      sample_every: int = DEFAULT_SAMPLE_EVERY,
+                      max_bytes: int = DEFAULT_MAX_BYTES,
+                      backups: int = DEFAULT_BACKUPS,
+                      levels: Optional[Dict[str, int]] = None) -> logging.handlers.QueueListener:
+    """Install the queue handler and start the background listener.
+
+    `verbose` lowers every subsystem to DEBUG, `network_traffic` turns on
+    the (sampled) per-frame TRAFFIC logger. `levels` overrides single
+    subsystems, e.g. {"ui": logging.DEBUG}. Safe to call again, the
+    previous listener is stopped first.
+    """
+    global _listener
+    shutdown_logging()
+
+    handlers = []
+    if path:
+        file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    if console or not handlers:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(ConsoleFormatter())
+        handlers.append(console_handler)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger(ROOT)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_LocalQueueHandler(records))
+    root.propagate = False
+    root.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+    traffic = get_logger(TRAFFIC)
+    traffic.setLevel(logging.DEBUG if network_traffic else logging.WARNING)
+    for old in [f for f in traffic.filters if isinstance(f, SamplingFilter)]:
+        traffic.removeFilter(old)
+    traffic.addFilter(SamplingFilter(sample_every))
+
+    for subsystem, level in (levels or {}).items():
+        get_logger(subsystem).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,259 @@
+"""
+Offline mailbox for private messages.
+
+A private message to a user who is not online is queued here instead of
+being dropped, and delivered the next time they log in.
+
+Limits keep one user from filling the disk:
+
+  * per recipient: at most `max_messages` and `max_bytes` queued, older
+    than `max_age` seconds is dropped,
+  * per sender: at most `sender_messages` / `sender_bytes` waiting in
+    all mailboxes together,
+  * per server: `max_total_bytes`.
+
+A message over a limit is refused, and put() says which limit was hit,
+so the sender learns it was not queued.
+
+The users it knows double as the directory of end-to-end encryption
+keys: the public key a user logged in with is kept with their name and
+handed to whoever wants to write to them, see net/e2e.py.
+
+Mailboxes survive restarts through an append-only journal of JSON
+lines: "user" (a name that may receive mail, and its key), "put" and
+"take". Taking
+a whole mailbox is one record and one write, however many messages it
+held. On startup the journal is replayed. Once most of it is dead
+records it is compacted, written anew with only what is still queued
+and swapped in with os.replace().
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+from .logs import SERVER, get_logger
+
+log = get_logger(SERVER)
+
+MAILBOX_MESSAGES = 200
+MAILBOX_BYTES = 256 * 1024
+MAILBOX_AGE = 7 * 24 * 3600
+SENDER_MESSAGES = 100
+SENDER_BYTES = 128 * 1024
+MAILBOX_TOTAL_BYTES = 64 * 1024 * 1024
+COMPACT_MIN_BYTES = 1024 * 1024
+
+# Reasons put() gives for refusing a message
+FULL = "mailbox full"
+QUOTA = "sender quota exceeded"
+STORAGE = "server storage full"
+
+
+class QueuedMessage(NamedTuple):
+    sender: str
+    text: str
+    sent: float
+    id: Optional[str]
+
+    @property
+    def size(self) -> int:
+        return len(self.text.encode("utf-8")) + len(self.sender) + 32
+
+
+class OfflineMailbox:
+    """Queued private messages per recipient, optionally journaled to `path`."""
+
+    def __init__(self, path: Optional[str] = None,
+                 max_messages: int = MAILBOX_MESSAGES,
+                 max_bytes: int = MAILBOX_BYTES,
+                 max_age: float = MAILBOX_AGE,
+                 sender_messages: int = SENDER_MESSAGES,
+                 sender_bytes: int = SENDER_BYTES,
+                 max_total_bytes: int = MAILBOX_TOTAL_BYTES,
+                 fsync: bool = False):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sender_messages = sender_messages
+        self.sender_bytes = sender_bytes
+        self.max_total_bytes = max_total_bytes
+        self.fsync = fsync
+        self._boxes: Dict[str, Deque[QueuedMessage]] = {}
+        self._box_bytes: Dict[str, int] = {}
+        self._sent: Dict[str, List[int]] = {}  # sender -> [messages, bytes] queued
+        self._users: Dict[str, Optional[str]] = {}  # user -> public key
+        self._total = 0
+        self._journal = None
+        self._journal_bytes = 0
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+            self._journal = open(path, "a", encoding="utf-8")
+
+    # -- queries -----------------------------------------------------------
+
+    def knows(self, user: str) -> bool:
+        """True if user has logged in here before and may receive mail."""
+        return user in self._users
+
+    def key_of(self, user: str) -> Optional[str]:
+        """The public key user last logged in with, None if they had none."""
+        return self._users.get(user)
+
+    def pending(self, user: str) -> int:
+        with self._lock:
+            return len(self._boxes.get(user, ()))
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    # -- updates -----------------------------------------------------------
+
+    def remember(self, user: str, key: Optional[str] = None):
+        """Record a user that logged in and their public key, mail to
+        unknown names is refused."""
+        with self._lock:
+            if user in self._users and self._users[user] == key:
+                return
+            self._users[user] = key
+            self._write(self._user_record(user))
+
+    def put(self, sender: str, recipient: str, text: str, message_id: Optional[str] = None,
+            now: Optional[float] = None) -> Optional[str]:
+        """Queue a message. Returns None, or the reason it was refused."""
+        message = QueuedMessage(sender, text, time.time() if now is None else now, message_id)
+        with self._lock:
+            self._expire(recipient, message.sent)
+            box = self._boxes.get(recipient, ())
+            if len(box) >= self.max_messages or self._box_bytes.get(recipient, 0) + message.size > self.max_bytes:
+                return FULL
+            sent = self._sent.get(sender, (0, 0))
+            if sent[0] >= self.sender_messages or sent[1] + message.size > self.sender_bytes:
+                return QUOTA
+            if self._total + message.size > self.max_total_bytes:
+                return STORAGE
+            self._add(recipient, message)
+            self._write({"op": "put", "to": recipient, "from": sender, "text": text,
+                         "t": message.sent, "id": message_id})
+        return None
+
+    def take(self, recipient: str, now: Optional[float] = None) -> List[QueuedMessage]:
+        """Remove and return everything queued for recipient, oldest first."""
+        with self._lock:
+            self._expire(recipient, time.time() if now is None else now)
+            box = self._boxes.pop(recipient, None)
+            if not box:
+                return []
+            self._box_bytes.pop(recipient, None)
+            for message in box:
+                self._release(message)
+            # One record for the whole mailbox
+            self._write({"op": "take", "to": recipient})
+            self._maybe_compact()
+            return list(box)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    # -- internals ---------------------------------------------------------
+
+    def _add(self, recipient: str, message: QueuedMessage):
+        self._boxes.setdefault(recipient, deque()).append(message)
+        self._box_bytes[recipient] = self._box_bytes.get(recipient, 0) + message.size
+        sent = self._sent.setdefault(message.sender, [0, 0])
+        sent[0] += 1
+        sent[1] += message.size
+        self._total += message.size
+
+    def _release(self, message: QueuedMessage):
+        sent = self._sent.get(message.sender)
+        if sent is not None:
+            sent[0] -= 1
+            sent[1] -= message.size
+            if sent[0] <= 0:
+                del self._sent[message.sender]
+        self._total -= message.size
+
+    def _expire(self, recipient: str, now: float):
+        box = self._boxes.get(recipient)
+        while box and now - box[0].sent > self.max_age:
+            message = box.popleft()
+            self._box_bytes[recipient] -= message.size
+            self._release(message)
+        if box is not None and not box:
+            del self._boxes[recipient]
+            self._box_bytes.pop(recipient, None)
+
+    def _user_record(self, user: str) -> dict:
+        record = {"op": "user", "u": user}
+        if self._users[user] is not None:
+            record["pk"] = self._users[user]
+        return record
+
+    def _write(self, record: dict):
+        if self._journal is None:
+            return
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._journal_bytes += len(line)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path, encoding="utf-8") as journal:
+            for line in journal:
+                self._journal_bytes += len(line)
+                try:
+                    record = json.loads(line)
+                    op = record["op"]
+                    if op == "user":
+                        self._users[record["u"]] = record.get("pk")
+                    elif op == "put":
+                        self._add(record["to"], QueuedMessage(record["from"], record["text"], record["t"], record.get("id")))
+                    elif op == "take":
+                        for message in self._boxes.pop(record["to"], ()):
+                            self._release(message)
+                        self._box_bytes.pop(record["to"], None)
+                except (ValueError, KeyError, TypeError):
+                    # A torn last line after a crash, everything before it is fine
+                    log.warning("skipping bad mailbox record", extra={"path": self.path})
+        for recipient in list(self._boxes):
+            self._expire(recipient, now)
+        log.info("mailbox loaded", extra={"users": len(self._users), "queued": sum(map(len, self._boxes.values()))})
+
+    def _maybe_compact(self):
+        if self._journal is None or self._journal_bytes < COMPACT_MIN_BYTES:
+            return
+        if self._journal_bytes < 4 * (self._total + 64 * len(self._users)):
+            return
+        temp = self.path + ".tmp"
+        written = 0
+        with open(temp, "w", encoding="utf-8") as journal:
+            records = [self._user_record(user) for user in sorted(self._users)]
+            for recipient, box in self._boxes.items():
+                records.extend({"op": "put", "to": recipient, "from": m.sender, "text": m.text, "t": m.sent, "id": m.id}
+                               for m in box)
+            for record in records:
+                line = json.dumps(record, separators=(",", ":")) + "\n"
+                journal.write(line)
+                written += len(line)
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._journal.close()
+        os.replace(temp, self.path)
+        self._journal = open(self.path, "a", encoding="utf-8")
+        self._journal_bytes = written
+        log.info("mailbox journal compacted", extra={"bytes": written})
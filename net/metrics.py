@@ -0,0 +1,432 @@
+"""
+Server metrics: counters, gauges and fixed-bucket histograms, exported
+in the Prometheus text format on a small local HTTP endpoint.
+
+Recording is lock-free. Every thread that touches a metric gets its own
+cell (a plain list) which only that thread ever writes. A scrape sums
+the cells. Cells of threads that have exited are folded into a single
+retired total during the scrape, so per-connection threads coming and
+going do not grow the cell list forever. The only lock is taken once
+per thread per metric, when its cell is created.
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .protocol import HEADER_SIZE, op_name
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Cells:
+    """Per-thread value cells of one metric child."""
+
+    def __init__(self, width: int):
+        self._width = width
+        self._local = threading.local()
+        self._cells: List[Tuple[threading.Thread, list]] = []
+        self._retired = [0] * width
+        self._lock = threading.Lock()
+        self._prune_at = 64  # cell count at which new cells fold the dead ones
+
+    def cell(self) -> list:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = [0] * self._width
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+                if len(self._cells) >= self._prune_at:
+                    # Without a scraper nothing else folds them; pruning
+                    # only when the list doubled keeps this O(1) amortized
+                    self._fold_dead()
+                    self._prune_at = max(64, 2 * len(self._cells))
+            self._local.cell = cell
+            return cell
+
+    def totals(self) -> list:
+        with self._lock:
+            self._fold_dead()
+            totals = list(self._retired)
+            for _, cell in self._cells:
+                for i, value in enumerate(list(cell)):
+                    totals[i] += value
+            return totals
+
+    def _fold_dead(self):
+        """Move the cells of exited threads into the retired total; a dead
+        thread can no longer write. Called with the lock held."""
+        alive = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                for i, value in enumerate(list(cell)):
+                    self._retired[i] += value
+        self._cells = alive
+
+
+class _Metric:
+    """Shared behaviour: name, help text and optional labels."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, "_Metric"] = {}
+        self._children_lock = threading.Lock()
+
+    def labels(self, *values):
+        """Child metric for one combination of label values."""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._children_lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._new_child()
+                    self._children[key] = child
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_str(self, key: tuple, extra: Iterable[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        inner = ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + inner + "}"
+
+    def _series(self):
+        """Yield (label key, child) pairs to render."""
+        if self.labelnames:
+            return list(self._children.items())
+        return [((), self)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in self._series():
+            lines.extend(child._render_samples(self, key))
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._fn = fn
+        self._cells = _Cells(1)
+
+    def _new_child(self):
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount: float = 1):
+        self._cells.cell()[0] += amount
+
+    def value(self) -> float:
+        if self._fn is not None:
+            return self._fn()
+        return self._cells.totals()[0]
+
+    def _render_samples(self, parent, key):
+        return [f"{parent.name}{parent._label_str(key)} {_fmt(self.value())}"]
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, either set directly or read from fn at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._fn = fn
+        self._value = 0.0
+
+    def _new_child(self):
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value: float):
+        self._value = value
+
+    def value(self) -> float:
+        if self._fn is not None:
+            try:
+                return self._fn()
+            except Exception:
+                return float("nan")
+        return self._value
+
+    def _render_samples(self, parent, key):
+        return [f"{parent.name}{parent._label_str(key)} {_fmt(self.value())}"]
+
+
+class Histogram(_Metric):
+    """Fixed-bucket histogram, e.g. for latencies in seconds."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # One cell slot per bucket, +Inf, then sum
+        self._cells = _Cells(len(self.buckets) + 2)
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float):
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self):
+        """Context manager observing the duration of the block."""
+        return _Timer(self)
+
+    def _render_samples(self, parent, key):
+        totals = self._cells.totals()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, totals):
+            cumulative += count
+            lines.append(f"{parent.name}_bucket{parent._label_str(key, [('le', _fmt(bound))])} {cumulative}")
+        cumulative += totals[len(self.buckets)]
+        lines.append(f"{parent.name}_bucket{parent._label_str(key, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{parent.name}_sum{parent._label_str(key)} {_fmt(totals[-1])}")
+        lines.append(f"{parent.name}_count{parent._label_str(key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+def _fmt(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if value != value:
+        return "NaN"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """Holds metrics and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = (), fn=None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, fn))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), fn=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, fn))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# ============================================================================
+# STANDARD CHAT SERVER METRICS
+# ============================================================================
+
+class ServerMetrics:
+    """The metric set every chat server exports.
+
+    Callers pass functions for values that are cheaper to read at scrape
+    time than to track on every change (connection count, queue depth).
+    """
+
+    def __init__(self, registry: MetricsRegistry = None,
+                 active_connections: Callable[[], float] = None,
+                 queue_depths: Callable[[], Iterable[int]] = None,
+                 throttle_stats=None,
+                 compression_stats: Callable[[], Iterable] = None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+        self.started = time.time()
+
+        self.connections = r.counter("chat_connections_total", "Client connections accepted")
+        self.active = r.gauge("chat_connections_active", "Clients currently logged in", fn=active_connections)
+        self.messages_in = r.counter("chat_messages_in_total", "Frames received from clients", ["op"])
+        self.messages_out = r.counter("chat_messages_out_total", "Frames written to clients")
+        self.bytes_in = r.counter("chat_bytes_in_total", "Bytes received from clients")
+        self.bytes_out = r.counter("chat_bytes_out_total", "Bytes written to clients")
+        self.write_syscalls = r.counter("chat_write_syscalls_total", "Socket write calls made by client writers")
+        self.fanout_seconds = r.histogram("chat_fanout_seconds", "Time to hand a broadcast to every recipient")
+        self.file_bytes = r.counter("chat_file_bytes_total", "File payload bytes received")
+        self.file_seconds = r.histogram(
+            "chat_file_transfer_seconds", "Duration of completed file transfers",
+            buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+        )
+        self.errors = r.counter("chat_errors_total", "Errors by kind", ["kind"])
+        r.gauge("chat_uptime_seconds", "Seconds since the server started", fn=lambda: time.time() - self.started)
+
+        if queue_depths is not None:
+            r.gauge("chat_outbound_queue_bytes", "Bytes queued on all client writers",
+                    fn=lambda: sum(queue_depths()))
+            r.gauge("chat_outbound_queue_max_bytes", "Largest single client writer queue",
+                    fn=lambda: max(queue_depths(), default=0))
+
+        if throttle_stats is not None:
+            throttled = r.counter("chat_throttle_events_total", "Reader pauses by the rate limiter", ["bucket"])
+            delayed = r.counter("chat_throttle_seconds_total", "Seconds readers were paused", ["bucket"])
+            for bucket in ("messages", "bytes", "file"):
+                throttled.labels(bucket)._fn = lambda b=bucket: throttle_stats.snapshot()["events"][b]
+                delayed.labels(bucket)._fn = lambda b=bucket: throttle_stats.snapshot()["delay_seconds"][b]
+
+        # CompressionStats of open connections are read at scrape time,
+        # closed ones are folded in by retire_compression
+        self._compression_lock = threading.Lock()
+        self._compression_retired = {"raw_bytes": 0, "compressed_bytes": 0, "cpu_seconds": 0.0}
+        if compression_stats is not None:
+            def total(field):
+                with self._compression_lock:
+                    return self._compression_retired[field] + sum(getattr(s, field) for s in compression_stats())
+
+            def ratio():
+                raw = total("raw_bytes")
+                return total("compressed_bytes") / raw if raw else 1.0
+
+            r.counter("chat_compression_raw_bytes_total", "Payload bytes of compressed frames before compression",
+                      fn=lambda: total("raw_bytes"))
+            r.counter("chat_compression_bytes_total", "Payload bytes of compressed frames after compression",
+                      fn=lambda: total("compressed_bytes"))
+            r.counter("chat_compression_cpu_seconds_total", "Seconds writers spent compressing",
+                      fn=lambda: total("cpu_seconds"))
+            r.gauge("chat_compression_ratio", "Compressed / raw size over every connection so far", fn=ratio)
+
+    def watch_plugins(self, stats: Callable[[], Dict[str, dict]]):
+        """Per-plugin counters, read from Pipeline.stats at scrape time."""
+        r = self.registry
+        counters = {
+            "calls": r.counter("chat_plugin_calls_total", "Plugin hook calls", ["plugin"]),
+            "errors": r.counter("chat_plugin_errors_total", "Plugin hook calls that raised", ["plugin"]),
+            "over_budget": r.counter("chat_plugin_over_budget_total", "Plugin hook calls over their budget", ["plugin"]),
+            "skipped": r.counter("chat_plugin_skipped_total", "Messages a busy plugin did not get", ["plugin"]),
+            "seconds": r.counter("chat_plugin_seconds_total", "Seconds spent in plugin hooks", ["plugin"]),
+        }
+        inline = r.gauge("chat_plugin_inline", "1 while the plugin runs on the routing path", ["plugin"])
+        for name in stats():
+            for key, counter in counters.items():
+                counter.labels(name)._fn = lambda n=name, k=key: stats()[n][k]
+            inline.labels(name)._fn = lambda n=name: float(stats()[n]["mode"] == "inline")
+
+    def retire_compression(self, stats, remove: Callable[[], object]):
+        """A connection closes: remove() takes it out of compression_stats
+        and its counters move to the totals, under the lock a scrape takes,
+        so the counters never go backwards. Returns what remove() returned."""
+        with self._compression_lock:
+            result = remove()
+            if stats is not None:
+                for field in self._compression_retired:
+                    self._compression_retired[field] += getattr(stats, field)
+        return result
+
+    def record_frame_in(self, op: int, payload_size: int):
+        """Count one inbound frame."""
+        self.messages_in.labels(op_name(op)).inc()
+        self.bytes_in.inc(HEADER_SIZE + payload_size)
+
+    def record_flush(self, frames: int, nbytes: int, syscalls: int):
+        """CoalescingWriter on_flush hook."""
+        self.messages_out.inc(frames)
+        self.bytes_out.inc(nbytes)
+        self.write_syscalls.inc(syscalls)
+
+
+# ============================================================================
+# HTTP ENDPOINT
+# ============================================================================
+
+class MetricsServer:
+    """Serves GET /metrics from a registry on a background thread."""
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._httpd: Optional[ThreadingHTTPServer] = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes are not worth a line each
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True).start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
@@ -0,0 +1,465 @@
+"""
+Server state that survives a restart: snapshots plus a log tail.
+
+Without it a restarted server comes back with an empty history: every
+room starts over at seq 1 and resuming clients get nothing. StateStore
+keeps the message history (and with it the room sequence numbers and
+the private rooms of every user) in a directory:
+
+  log.<n>     every message that entered the history, appended in
+              batches by a background thread. Each record is
+              <kind op room_len seq payload_len> room payload crc32.
+  full.<n>    every room, as of the end of log.<n-1>
+  delta.<n>   only the rooms that changed since the previous snapshot
+
+Snapshots are taken off the hot path, by the same background thread,
+every `snapshot_interval` seconds or once `snapshot_records` messages
+were logged, whichever comes first. Most are deltas, every
+`full_every`-th one is full, after which older files are deleted. The
+log is rotated at every snapshot, so only the tail after the latest
+snapshot is ever replayed.
+
+A snapshot is one binary file, little-endian:
+
+  header   <4sBBHQI  magic, version, flags, reserved, first log, meta length
+  meta     JSON, e.g. the resume token secret
+  index    <I room count, then per room <HQIQQ name length, last seq,
+           message count, block offset, block length, and the name
+  blocks   per room: seqs (u64 each), ops (u8 each), payload lengths
+           (u32 each), then the payloads back to back
+
+Loading maps the snapshot files and reads the index only. The rooms go
+into the HistoryStore as blocks that are decoded the first time a
+client needs them, so startup takes the same time for a thousand
+stored messages as for millions, plus the log tail.
+
+Only one process writes a directory, the one holding its lock. A
+server that took over from a running one (see net/handoff.py) loads at
+startup, serves right away, and starts writing once its predecessor
+has exited, after catching up on what that one wrote in the meantime.
+"""
+
+import array
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Dict, List, Tuple
+
+from .logs import SERVER, get_logger
+
+log = get_logger(SERVER)
+
+SNAPSHOT_INTERVAL = 60.0     # seconds between snapshots of a changing history
+SNAPSHOT_RECORDS = 100000    # or after this many logged messages, bounds the replay on startup
+FLUSH_INTERVAL = 0.05        # seconds between log writes
+FULL_EVERY = 10              # every n-th snapshot is a full one
+
+MAGIC = b"PCSN"
+VERSION = 1
+FULL = 0x01
+
+KIND_MESSAGE = 1
+
+_SNAPSHOT = struct.Struct("<4sBBHQI")
+_COUNT = struct.Struct("<I")
+_ROOM = struct.Struct("<HQIQQ")
+_RECORD = struct.Struct("<BBHQI")
+_CRC = struct.Struct("<I")
+
+_SWAP = sys.byteorder != "little"
+
+
+class RoomBlock:
+    """One room of a snapshot file, decoded on first use."""
+
+    __slots__ = ("data", "offset", "length", "count", "last_seq")
+
+    def __init__(self, data, offset: int, length: int, count: int, last_seq: int):
+        self.data = data           # the mapped snapshot
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self.last_seq = last_seq
+
+    def raw(self) -> memoryview:
+        return memoryview(self.data)[self.offset:self.offset + self.length]
+
+    def decode(self) -> Tuple[List[int], List[Tuple[int, bytes]]]:
+        n, at = self.count, self.offset
+        seqs = array.array("Q")
+        seqs.frombytes(self.data[at:at + 8 * n])
+        at += 8 * n
+        ops = self.data[at:at + n]
+        at += n
+        lengths = array.array("I")
+        lengths.frombytes(self.data[at:at + 4 * n])
+        at += 4 * n
+        if _SWAP:
+            seqs.byteswap()
+            lengths.byteswap()
+        items = []
+        for op, length in zip(ops, lengths):
+            items.append((op, self.data[at:at + length]))
+            at += length
+        return seqs.tolist(), items
+
+
+def encode_room(seqs: List[int], items: List[Tuple[int, bytes]]) -> bytes:
+    """Block of one room, the inverse of RoomBlock.decode()."""
+    seq_array = array.array("Q", seqs)
+    lengths = array.array("I", [len(payload) for _, payload in items])
+    if _SWAP:
+        seq_array.byteswap()
+        lengths.byteswap()
+    return b"".join((
+        seq_array.tobytes(),
+        bytes(op for op, _ in items),
+        lengths.tobytes(),
+        b"".join(payload for _, payload in items),
+    ))
+
+
+def encode_record(room: str, seq: int, op: int, payload: bytes) -> bytes:
+    name = room.encode("utf-8")
+    record = _RECORD.pack(KIND_MESSAGE, op, len(name), seq, len(payload)) + name + payload
+    return record + _CRC.pack(zlib.crc32(record))
+
+
+def read_records(data, start: int = 0):
+    """Yield (room, seq, op, payload, end) from a log segment.
+
+    Stops at the first torn or corrupt record, i.e. where a crash cut
+    the last write short.
+    """
+    at, size = start, len(data)
+    view = memoryview(data)
+    names = {}  # a log has few rooms, decode each name once
+    while at + _RECORD.size <= size:
+        kind, op, name_length, seq, length = _RECORD.unpack_from(data, at)
+        end = at + _RECORD.size + name_length + length
+        if kind != KIND_MESSAGE or end + _CRC.size > size:
+            return
+        if _CRC.unpack_from(data, end)[0] != zlib.crc32(view[at:end]):
+            return
+        name_at = at + _RECORD.size
+        name = bytes(view[name_at:name_at + name_length])
+        room = names.get(name)
+        if room is None:
+            room = names[name] = name.decode("utf-8")
+        yield room, seq, op, bytes(view[name_at + name_length:end]), end + _CRC.size
+        at = end + _CRC.size
+
+
+class StateStore:
+    """Snapshots and log of a HistoryStore in `directory`.
+
+    load() once at startup, before serving. start() the writer in the
+    one process that should write, then hand record() to the history
+    as its journal.
+    """
+
+    def __init__(self, directory: str, history, sequencer,
+                 snapshot_interval: float = SNAPSHOT_INTERVAL,
+                 snapshot_records: int = SNAPSHOT_RECORDS,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 full_every: int = FULL_EVERY, fsync: bool = False):
+        self.directory = directory
+        self.history = history
+        self.sequencer = sequencer
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_records = snapshot_records
+        self.flush_interval = flush_interval
+        self.full_every = full_every
+        self.fsync = fsync
+        self.meta: dict = {}       # written into every snapshot, read back by load()
+        self.stats: dict = {}
+        self._queue = deque()
+        self._loaded_snapshot = 0  # newest snapshot number that load() used
+        self._position = (0, 0)    # log segment and offset load() stopped at
+        self._segment = 0
+        self._log = None
+        self._logged = 0           # records since the last snapshot
+        self._deltas = 0           # snapshots since the last full one
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._snapshot_on_close = True
+        # Snapshots carry the resume token secret
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    # -- startup ------------------------------------------------------------
+
+    def load(self) -> dict:
+        """Restore the latest snapshot and replay the log after it.
+
+        Returns the meta of the snapshot, {} for an empty directory.
+        """
+        started = time.monotonic()
+        for attempt in range(3):
+            try:
+                self._load()
+                break
+            except FileNotFoundError:
+                # A running predecessor replaced files under us, start over
+                if attempt == 2:
+                    raise
+        self.stats["seconds"] = time.monotonic() - started
+        return self.meta
+
+    def _load(self):
+        snapshots = self._snapshots()
+        fulls = [n for n, full in snapshots if full]
+        chain = []
+        if fulls:
+            chain = [n for n, full in snapshots if n >= fulls[-1]]
+        blocks: Dict[str, RoomBlock] = {}
+        for n in chain:
+            blocks.update(self._read_snapshot(n))
+        self.history.restore(blocks)
+        messages = 0
+        for room, block in blocks.items():
+            self.sequencer.advance(room, block.last_seq)
+            messages += block.count
+        self._loaded_snapshot = chain[-1] if chain else 0
+        self._deltas = len(chain) - 1 if chain else 0
+        first = self._loaded_snapshot
+        replayed, self._position = self._replay(first, 0)
+        self.stats.update(rooms=len(blocks), messages=messages, replayed=replayed,
+                          snapshots=len(chain))
+
+    def _read_snapshot(self, n: int) -> Dict[str, RoomBlock]:
+        path = self._path("full" if os.path.exists(self._path("full", n)) else "delta", n)
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, _, _, meta_length = _SNAPSHOT.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a snapshot of this version")
+        at = _SNAPSHOT.size
+        meta = json.loads(data[at:at + meta_length].decode("utf-8"))
+        if meta:
+            self.meta.update(meta)
+        at += meta_length
+        (count,) = _COUNT.unpack_from(data, at)
+        at += _COUNT.size
+        blocks = {}
+        for _ in range(count):
+            name_length, last_seq, messages, offset, length = _ROOM.unpack_from(data, at)
+            at += _ROOM.size
+            room = data[at:at + name_length].decode("utf-8")
+            at += name_length
+            blocks[room] = RoomBlock(data, offset, length, messages, last_seq)
+        return blocks
+
+    def _replay(self, first: int, offset: int) -> Tuple[int, Tuple[int, int]]:
+        """Append the log from segment first on. (records, where it ended)"""
+        replayed, position = 0, (first, offset)
+        highest: Dict[str, int] = {}
+        for n in self._segments():
+            if n < first:
+                continue
+            with open(self._path("log", n), "rb") as f:
+                data = f.read()
+            end = offset if n == first else 0
+            for room, seq, op, payload, end in read_records(data, end):
+                if self.history.append(room, seq, op, payload, journal=False):
+                    if seq > highest.get(room, 0):
+                        highest[room] = seq
+                    replayed += 1
+            position = (n, end)
+        # Once per room, not per record
+        for room, seq in highest.items():
+            self.sequencer.advance(room, seq)
+        return replayed, position
+
+    def _catch_up(self):
+        """Merge what a predecessor wrote after load(), we hold the lock now."""
+        merged = 0
+        for n, _ in self._snapshots():
+            if n <= self._loaded_snapshot:
+                continue
+            for room, block in self._read_snapshot(n).items():
+                seqs, items = block.decode()
+                for seq, (op, payload) in zip(seqs, items):
+                    if self.history.append(room, seq, op, payload, journal=False):
+                        self.sequencer.advance(room, seq)
+                        merged += 1
+            self._loaded_snapshot = n
+        segment, offset = self._position
+        replayed, _ = self._replay(segment, offset)
+        if merged or replayed:
+            log.info("caught up on state written by the previous server",
+                     extra={"merged": merged, "replayed": replayed})
+
+    # -- hot path -----------------------------------------------------------
+
+    def record(self, room: str, seq: int, op: int, payload: bytes):
+        """Log one message, soon. The journal of a HistoryStore."""
+        self._queue.append((room, seq, op, payload))
+
+    # -- writer thread ------------------------------------------------------
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="state", daemon=True)
+        self._thread.start()
+
+    def close(self, snapshot: bool = True):
+        """Write what is queued and stop. snapshot=False skips the final
+        snapshot, e.g. when a successor is about to take over."""
+        if self._thread is None:
+            return
+        self._snapshot_on_close = snapshot
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        self._lock_file = open(os.path.join(self.directory, "lock"), "a+b")
+        if not self._try_lock():
+            log.info("waiting for the previous server to release the state directory",
+                     extra={"dir": self.directory})
+            while not self._try_lock():
+                if self._stop.wait(0.1):
+                    self._lock_file.close()
+                    return
+            self._catch_up()
+        try:
+            segments = self._segments()
+            self._segment = max(segments[-1] + 1 if segments else 0, self._loaded_snapshot)
+            self._open_log()
+            if not any(full for _, full in self._snapshots()):
+                self._snapshot(full=True)
+            last_snapshot = time.monotonic()
+            while not self._stop.wait(self.flush_interval):
+                self._flush()
+                due = time.monotonic() - last_snapshot >= self.snapshot_interval
+                if self._logged and (due or self._logged >= self.snapshot_records):
+                    self._snapshot(full=self._deltas + 1 >= self.full_every)
+                    last_snapshot = time.monotonic()
+            self._flush()
+            if self._snapshot_on_close and self._logged:
+                self._snapshot(full=False)
+        except Exception as e:
+            log.error("state writer failed", extra={"error": str(e)})
+        finally:
+            if self._log is not None:
+                self._log.close()
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+
+    def _try_lock(self) -> bool:
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _open_log(self):
+        self._log = open(self._path("log", self._segment), "ab")
+
+    def _flush(self):
+        queue = self._queue
+        if not queue:
+            return
+        records = []
+        while queue:
+            records.append(encode_record(*queue.popleft()))
+        self._log.write(b"".join(records))
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self._logged += len(records)
+
+    def _snapshot(self, full: bool):
+        # Everything logged so far is in the history already, so the
+        # snapshot covers the closed segment and replay starts after it
+        self._log.close()
+        self._segment += 1
+        self._open_log()
+        self._logged = 0
+        started = time.monotonic()
+        n = self._segment
+        rooms = self.history.take_dirty()
+        if full:
+            rooms = self.history.rooms()
+        count = self._write_snapshot(n, rooms, full)
+        if full:
+            self._deltas = 0
+            for old, _ in self._snapshots():
+                if old < n:
+                    self._remove(self._path("full", old))
+                    self._remove(self._path("delta", old))
+        else:
+            self._deltas += 1
+        for old in self._segments():
+            if old < n:
+                self._remove(self._path("log", old))
+        log.info("state snapshot written", extra={
+            "kind": "full" if full else "delta", "rooms": count, "n": n,
+            "seconds": round(time.monotonic() - started, 3)})
+
+    def _write_snapshot(self, n: int, rooms, full: bool) -> int:
+        meta = json.dumps(self.meta).encode("utf-8")
+        header = _SNAPSHOT.pack(MAGIC, VERSION, FULL if full else 0, 0, n, len(meta))
+        blocks, index = [], []
+        for room in rooms:
+            entry = self.history.export(room)
+            if entry is None:
+                continue
+            if isinstance(entry, RoomBlock):
+                blocks.append(entry.raw())
+                index.append((room.encode("utf-8"), entry.last_seq, entry.count, len(blocks[-1])))
+            elif entry[0]:
+                seqs, items = entry
+                blocks.append(encode_room(seqs, items))
+                index.append((room.encode("utf-8"), seqs[-1], len(seqs), len(blocks[-1])))
+        offset = len(header) + len(meta) + _COUNT.size + sum(_ROOM.size + len(name) for name, *_ in index)
+        path = self._path("full" if full else "delta", n)
+        with open(path + ".tmp", "wb") as f:
+            f.write(header)
+            f.write(meta)
+            f.write(_COUNT.pack(len(index)))
+            for name, last_seq, count, length in index:
+                f.write(_ROOM.pack(len(name), last_seq, count, offset, length))
+                f.write(name)
+                offset += length
+            for block in blocks:
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        return len(index)
+
+    # -- files --------------------------------------------------------------
+
+    def _path(self, kind: str, n: int) -> str:
+        return os.path.join(self.directory, f"{kind}.{n:08d}")
+
+    def _numbers(self, kind: str) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            prefix, _, suffix = name.partition(".")
+            if prefix == kind and suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def _segments(self) -> List[int]:
+        return self._numbers("log")
+
+    def _snapshots(self) -> List[Tuple[int, bool]]:
+        """(number, is full) of every snapshot, oldest first."""
+        return sorted([(n, True) for n in self._numbers("full")] +
+                      [(n, False) for n in self._numbers("delta")])
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
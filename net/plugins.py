@@ -0,0 +1,311 @@
+"""
+Server plugins: an ordered middleware pipeline for chat messages.
+
+Moderation, link previews or a command bot hook in here instead of in
+listen_for_messages. Each CHAT and PRIVATE a client sends passes the
+inbound hooks of the plugins in order, before the server numbers it.
+Each message the server numbers passes the outbound hooks before it is
+encoded once for all its recipients, whether a client, another server
+or the mailbox sent it.
+
+A plugin declares how it runs:
+
+    INLINE  a plain method on the routing path. It may rewrite the text,
+            and an inbound hook may refuse the message. It has to fit
+            its budget: after STRIKES overruns in a row it is moved to
+            the worker pool for good, where it can no longer hold up a
+            message, nor change one
+    POOL    a plain method on the worker pool, for plugins that block
+            (HTTP requests, databases)
+    ASYNC   a coroutine on the plugin event loop, cancelled when it
+            overruns its budget
+
+POOL and ASYNC hooks run after the message was routed, on a copy of it
+as the INLINE hooks left it. They act through their PluginActions:
+say() posts to the room, tell() answers one user. Messages posted by
+plugins skip the pipeline, so bots cannot set each other off. Each
+plugin has at most MAX_PENDING calls waiting; further ones are skipped
+and counted, so a stuck plugin costs a counter and not memory. A hook
+that raises is counted, the first time logged, and the message goes on
+unchanged.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+
+from .e2e import is_sealed
+from .logs import SERVER, get_logger
+
+log = get_logger(SERVER)
+
+INLINE = "inline"
+POOL = "pool"
+ASYNC = "async"
+MODES = (INLINE, POOL, ASYNC)
+
+INBOUND = "inbound"
+OUTBOUND = "outbound"
+
+DEFAULT_BUDGET = 0.001  # seconds per call
+DEFAULT_WORKERS = 4
+STRIKES = 3  # overruns in a row that move an INLINE plugin to the pool
+MAX_PENDING = 256  # calls per plugin waiting on the pool or the loop
+
+
+class Message:
+    """A chat message on its way through the pipeline.
+
+    `to` is the recipient of a private message, None for the room. `seq`
+    is set once the server numbered it, so outbound POOL and ASYNC hooks
+    see it. The text of an end-to-end encrypted message is sealed, the
+    server cannot read it and neither can plugins.
+    """
+
+    __slots__ = ("op", "sender", "to", "text", "seq", "refused")
+
+    def __init__(self, op: int, sender: str, to: Optional[str], text: str, seq: Optional[int] = None):
+        self.op = op
+        self.sender = sender
+        self.to = to
+        self.text = text
+        self.seq = seq
+        self.refused: Optional[str] = None
+
+    @property
+    def encrypted(self) -> bool:
+        return is_sealed(self.text)
+
+    def refuse(self, reason: str = "refused by the server"):
+        """Drop an inbound message, the sender is told why. Outbound
+        messages are on their way already and cannot be refused."""
+        self.refused = reason
+
+    def copy(self) -> "Message":
+        return Message(self.op, self.sender, self.to, self.text, self.seq)
+
+    def __repr__(self):
+        return f"Message(op={self.op}, sender={self.sender!r}, to={self.to!r}, seq={self.seq})"
+
+
+class PluginActions:
+    """What a plugin can do, on behalf of its name."""
+
+    __slots__ = ("name", "_say", "_tell")
+
+    def __init__(self, name: str, say: Callable[[str, str], None], tell: Callable[[str, str, str], None]):
+        self.name = name
+        self._say = say
+        self._tell = tell
+
+    def say(self, text: str):
+        """Post to the room, from the plugin's name."""
+        self._say(self.name, text)
+
+    def tell(self, username: str, text: str, level: str = "info"):
+        """A system message to one user, on any worker."""
+        self._tell(username, text, level)
+
+
+class Plugin:
+    """Base class of plugins, override inbound, outbound or both.
+
+    For an ASYNC plugin they are coroutines. `budget` is in seconds per
+    call; the default suits INLINE plugins, POOL and ASYNC ones set what
+    a lookup of theirs may take. `name` defaults to the class name.
+    """
+
+    name: Optional[str] = None
+    mode = INLINE
+    budget = DEFAULT_BUDGET
+
+    def inbound(self, message: Message, actions: PluginActions):
+        """A client sent message, the server has not numbered it yet."""
+
+    def outbound(self, message: Message, actions: PluginActions):
+        """The server is sending message."""
+
+
+class _Slot:
+    """One plugin in the pipeline: how it runs now and what it cost."""
+
+    def __init__(self, plugin: Plugin, actions: PluginActions):
+        self.plugin = plugin
+        self.name = actions.name
+        self.actions = actions
+        self.mode = plugin.mode
+        self.budget = plugin.budget
+        self.hooks = {
+            direction: getattr(plugin, direction)
+            for direction in (INBOUND, OUTBOUND)
+            if getattr(type(plugin), direction) is not getattr(Plugin, direction)
+        }
+        self.strikes = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "errors": 0, "over_budget": 0, "skipped": 0, "seconds": 0.0}
+
+    def record(self, elapsed: float, error: Optional[BaseException] = None, cancelled: bool = False) -> bool:
+        """Count one call, True if it overran the budget. Only the first
+        error and the first overrun are logged, the counters keep the rest."""
+        over = cancelled or elapsed > self.budget
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["seconds"] += elapsed
+            self.stats["errors"] += error is not None
+            self.stats["over_budget"] += over
+            first_error = error is not None and self.stats["errors"] == 1
+            first_over = over and self.stats["over_budget"] == 1
+        if first_error:
+            log.error("plugin failed", exc_info=error, extra={"plugin": self.name})
+        if first_over:
+            log.warning("plugin over budget", extra={
+                "plugin": self.name, "mode": self.mode, "budget_ms": self.budget * 1e3,
+                "ms": round(elapsed * 1e3, 3),
+            })
+        return over
+
+    def reserve(self) -> bool:
+        """Take a place for one offloaded call, False if it is full."""
+        with self.lock:
+            if self.pending >= MAX_PENDING:
+                self.stats["skipped"] += 1
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+
+class Pipeline:
+    """The plugins of a server, in order.
+
+    The server calls inbound() and outbound() on the routing path, then
+    dispatch() once the message is routed. `say(name, text)` and
+    `tell(username, text, level)` are the server's side of PluginActions,
+    they are called from the pool and the loop thread too.
+    """
+
+    def __init__(self, plugins: Sequence[Plugin], say: Callable[[str, str], None],
+                 tell: Callable[[str, str, str], None], workers: int = DEFAULT_WORKERS):
+        self._slots: List[_Slot] = []
+        for plugin in plugins:
+            if plugin.mode not in MODES:
+                raise ValueError(f"{type(plugin).__name__}: mode must be one of {MODES}, not {plugin.mode!r}")
+            slot = _Slot(plugin, PluginActions(plugin.name or type(plugin).__name__, say, tell))
+            for direction, hook in slot.hooks.items():
+                if asyncio.iscoroutinefunction(hook) != (slot.mode == ASYNC):
+                    kind = "a coroutine" if slot.mode == ASYNC else "a plain method"
+                    raise ValueError(f"{slot.name}.{direction} must be {kind} for mode {slot.mode}")
+            self._slots.append(slot)
+        # Threads are only started when the first call is offloaded
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plugin")
+        self._loop = None
+        # Calls for the loop, handed over in batches with one wakeup each
+        self._loop_calls = deque()
+        self._wakeup_pending = False
+        if any(slot.mode == ASYNC for slot in self._slots):
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name="plugin-loop", daemon=True).start()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def inbound(self, message: Message) -> Message:
+        """Run the INLINE inbound hooks, stops at the first that refuses."""
+        for slot in self._slots:
+            hook = slot.hooks.get(INBOUND)
+            if hook is not None and slot.mode == INLINE:
+                self._run_inline(slot, hook, message)
+                if message.refused is not None:
+                    log.info("message refused", extra={"plugin": slot.name, "user": message.sender,
+                                                       "reason": message.refused})
+                    break
+        return message
+
+    def outbound(self, message: Message) -> Message:
+        """Run the INLINE outbound hooks."""
+        for slot in self._slots:
+            hook = slot.hooks.get(OUTBOUND)
+            if hook is not None and slot.mode == INLINE:
+                self._run_inline(slot, hook, message)
+        message.refused = None
+        return message
+
+    def dispatch(self, message: Message, direction: str):
+        """Hand a routed message to the POOL and ASYNC hooks of direction."""
+        for slot in self._slots:
+            hook = slot.hooks.get(direction)
+            if hook is None or slot.mode == INLINE or not slot.reserve():
+                continue
+            if slot.mode == POOL:
+                self._pool.submit(self._run_pooled, slot, hook, message.copy())
+            else:
+                self._loop_calls.append((slot, hook, message.copy()))
+                if not self._wakeup_pending:
+                    self._wakeup_pending = True
+                    self._loop.call_soon_threadsafe(self._start_async)
+
+    def stats(self) -> Dict[str, dict]:
+        """Counters of every plugin by name, and the mode it runs in now."""
+        snapshot = {}
+        for slot in self._slots:
+            with slot.lock:
+                snapshot[slot.name] = dict(slot.stats, mode=slot.mode, pending=slot.pending)
+        return snapshot
+
+    def close(self):
+        """Stop the pool and the loop, calls still waiting are dropped."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _run_inline(self, slot: _Slot, hook, message: Message):
+        error = None
+        started = time.perf_counter()
+        try:
+            hook(message, slot.actions)
+        except Exception as e:
+            error = e
+        if not slot.record(time.perf_counter() - started, error):
+            slot.strikes = 0
+            return
+        slot.strikes += 1
+        if slot.strikes >= STRIKES and slot.mode == INLINE:
+            # From now on it runs beside the routing, not in its way
+            slot.mode = POOL
+            log.warning("plugin moved to the worker pool", extra={"plugin": slot.name, "strikes": slot.strikes})
+
+    def _run_pooled(self, slot: _Slot, hook, message: Message):
+        error = None
+        started = time.perf_counter()
+        try:
+            hook(message, slot.actions)
+        except Exception as e:
+            error = e
+        finally:
+            slot.release()
+        slot.record(time.perf_counter() - started, error)
+
+    def _start_async(self):
+        """On the loop: start everything dispatched since the last wakeup."""
+        # Cleared first, a call appended from now on schedules a new wakeup
+        self._wakeup_pending = False
+        while self._loop_calls:
+            slot, hook, message = self._loop_calls.popleft()
+            task = self._loop.create_task(hook(message, slot.actions))
+            # Cheaper than wait_for, which wraps every call in another task
+            timeout = self._loop.call_later(slot.budget, task.cancel)
+            task.add_done_callback(lambda task, slot=slot, timeout=timeout, started=time.perf_counter():
+                                   self._finished_async(slot, task, timeout, started))
+
+    def _finished_async(self, slot: _Slot, task: asyncio.Task, timeout: asyncio.TimerHandle, started: float):
+        timeout.cancel()
+        slot.release()
+        cancelled = task.cancelled()
+        slot.record(time.perf_counter() - started, None if cancelled else task.exception(), cancelled)
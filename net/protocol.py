@@ -0,0 +1,246 @@
+"""
+Wire protocol shared by the chat servers and the client.
+
+Every message on the socket is a frame: a fixed 6-byte header followed by
+the payload.
+
+    op      1 byte   what the frame carries (see Op)
+    flags   1 byte   bit field (see Flags)
+    length  4 bytes  payload length, network byte order
+
+Chat and control payloads are compact UTF-8 JSON objects, file chunks are
+raw bytes. Framing replaces the old "whatever recv() returned" parsing,
+which merged or split messages whenever TCP felt like it.
+"""
+
+import json
+import ssl
+import struct
+from typing import List, Optional, Tuple, Union
+
+from .buffers import BufferPool, wait_readable
+
+# ============================================================================
+# FRAME LAYOUT
+# ============================================================================
+
+PROTOCOL_VERSION = 1  # bumped on incompatible changes, announced in discovery beacons
+
+HEADER = struct.Struct("!BBI")
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD_SIZE = 1024 * 1024  # 1MB, file data is sent in smaller chunks
+FILE_CHUNK_SIZE = 32 * 1024
+
+
+class Op:
+    """Frame opcodes."""
+
+    # Session
+    HELLO = 1              # c->s {"username", "caps", "resume"?, "pk"?}  see net/history.py, net/e2e.py
+    DISCONNECT = 2         # c->s {}
+    PING = 3               # both {"t"}  peer answers with PONG and the same body
+    PONG = 4               # both {"t"}
+    WELCOME = 5            # s->c {"codec", "seq", "token", "roster", "resumed"}  first frame after HELLO
+    RECONNECT = 6          # s->c {"after", "host"?, "port"?}  server is going away, come back after that many seconds
+
+    # Chat
+    CHAT = 10              # c->s {"text"}            s->c {"from", "text"}
+    PRIVATE = 11           # c->s {"to", "text"}      s->c {"from", "text"}
+    SYSTEM = 12            # s->c {"text", "level"}
+    THROTTLE = 13          # s->c {"wait"}  reading paused by the rate limiter
+    TYPING = 14            # c->s {"on", "to"?}       s->c {"from", "on", "to"?}
+
+    # End-to-end encryption, see net/e2e.py. The server only relays these
+    KEY_REQUEST = 15       # c->s {"users"}  public keys wanted
+    KEYS = 16              # s->c {"keys"}  {user: public key or null}
+    SENDER_KEY = 17        # c->s {"to", "box"|"want"}  s->c {"from", "box"|"want"}
+
+    # Presence
+    ROSTER_SNAPSHOT = 20   # s->c {"v", "users"}
+    ROSTER_ADD = 21        # s->c {"v", "user"}
+    ROSTER_REMOVE = 22     # s->c {"v", "user"}
+    ROSTER_SYNC = 23       # c->s {}  ask for a fresh snapshot
+
+    # File transfer
+    FILE_BEGIN = 30        # c->s {"name", "size"}
+    FILE_CHUNK = 31        # c->s raw bytes
+    FILE_END = 32          # c->s {}
+    FILE_RECEIVED = 33     # s->c {"name", "from", "size"}
+
+    # Federation, server to server on the same port
+    PEER_HELLO = 40        # both {"server", "key", "caps", "users", "peers"}
+    PEER_EVENTS = 41       # both {"events"}  a batch of replicated events
+
+    # Delivery, see net/delivery.py. CHAT, PRIVATE and FILE_RECEIVED sent
+    # by the server carry "seq"; CHAT and PRIVATE sent by clients an "id"
+    ACCEPTED = 50          # s->c {"room", "seq", "id"?, "queued"?, "refused"?}  the server took your message;
+                           # "queued": recipient offline, seq is null until a second ACCEPTED on delivery;
+                           # "refused": a plugin dropped it or the recipient cannot get it, seq is null,
+                           # a SYSTEM message says why
+    ACK = 51               # c->s {"recv"?, "read"?}  {room: seq} cumulative positions
+    RECEIPTS = 52          # s->c {"room", "read"}  {user: seq} read positions that moved
+    HISTORY = 53           # s->c {"room", "items", "start"?}  [[op, body], ...] missed while away
+
+
+class Flags:
+    """Frame flag bits."""
+
+    NONE = 0
+    COMPRESSED = 0x01      # payload is compressed with the negotiated codec
+
+
+# Opcodes whose payload is raw bytes instead of JSON
+BINARY_OPS = frozenset({Op.FILE_CHUNK})
+
+_OP_NAMES = {value: name for name, value in vars(Op).items() if name.isupper()}
+
+
+def op_name(op: int) -> str:
+    """Readable name of an opcode, for logs and metric labels."""
+    return _OP_NAMES.get(op, str(op))
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a malformed frame."""
+
+
+# ============================================================================
+# ENCODING
+# ============================================================================
+
+def encode_frame(op: int, body: Union[dict, bytes, None] = None, flags: int = Flags.NONE) -> bytes:
+    """Encode a single frame ready to be written to the socket."""
+    if body is None:
+        payload = b""
+    elif isinstance(body, (bytes, bytearray, memoryview)):
+        payload = bytes(body)
+    else:
+        payload = json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Payload too large ({len(payload)} bytes)")
+
+    return HEADER.pack(op, flags, len(payload)) + payload
+
+
+def send_raw_frame(sock, op: int, payload, flags: int = Flags.NONE):
+    """Write a frame with a binary payload, e.g. a file chunk, without
+    first copying it into a frame.
+
+    A plain socket gets the header and the caller's buffer (say a
+    memoryview of a reused read buffer) in one sendmsg(). A TLS socket
+    encrypts from a single buffer, so there they are joined.
+    """
+    length = len(payload)
+    if length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Payload too large ({length} bytes)")
+    header = HEADER.pack(op, flags, length)
+    if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, "sendmsg"):
+        sock.sendall(header + payload)
+        return
+    views = [memoryview(header), memoryview(payload)] if length else [memoryview(header)]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+def decode_body(op: int, payload: bytes) -> Union[dict, bytes]:
+    """Decode a frame payload according to its opcode."""
+    if op in BINARY_OPS:
+        return payload
+    if not payload:
+        return {}
+    try:
+        return json.loads(payload.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError(f"Invalid payload for op {op}: {e}")
+
+
+# ============================================================================
+# DECODING
+# ============================================================================
+
+class FrameDecoder:
+    """Incremental decoder turning a byte stream into frames.
+
+    Complete frames are cut straight out of the data passed to feed();
+    only the tail of a frame that is not complete yet is copied and kept.
+    """
+
+    __slots__ = ("_buffer", "max_payload")
+
+    def __init__(self, max_payload: int = MAX_PAYLOAD_SIZE):
+        self._buffer = bytearray()
+        self.max_payload = max_payload
+
+    def feed(self, data) -> List[Tuple[int, int, bytes]]:
+        """Add received bytes (any buffer) and return every frame completed by them."""
+        if self._buffer:
+            self._buffer += data
+            with memoryview(self._buffer) as view:
+                frames, used = self._parse(view)
+            del self._buffer[:used]
+            return frames
+
+        with memoryview(data) as view:
+            frames, used = self._parse(view)
+            if used < len(view):
+                self._buffer += view[used:]
+        return frames
+
+    def _parse(self, view: memoryview) -> Tuple[List[Tuple[int, int, bytes]], int]:
+        frames = []
+        offset = 0
+        size = len(view)
+        while size - offset >= HEADER_SIZE:
+            op, flags, length = HEADER.unpack_from(view, offset)
+            if length > self.max_payload:
+                raise ProtocolError(f"Frame too large ({length} bytes)")
+
+            end = offset + HEADER_SIZE + length
+            if size < end:
+                break
+
+            frames.append((op, flags, view[offset + HEADER_SIZE:end].tobytes()))
+            offset = end
+        return frames, offset
+
+    def pending(self) -> int:
+        """Number of buffered bytes not yet forming a full frame."""
+        return len(self._buffer)
+
+
+def read_frames(sock, decoder: FrameDecoder, bufsize: int = 2048,
+                pool: Optional[BufferPool] = None) -> Optional[List[Tuple[int, int, bytes]]]:
+    """Read from a blocking socket until at least one frame is available.
+
+    With a pool, every read borrows a slab for recv_into() and returns it
+    right after decoding, and waiting for data holds no buffer at all.
+
+    Returns None when the peer closed the connection.
+    """
+    while True:
+        if pool is None:
+            data = sock.recv(bufsize)
+            if not data:
+                return None
+            frames = decoder.feed(data)
+        else:
+            if not wait_readable(sock):
+                return None
+            slab = pool.acquire()
+            try:
+                received = sock.recv_into(slab)
+                if not received:
+                    return None
+                with memoryview(slab) as view:
+                    frames = decoder.feed(view[:received])
+            finally:
+                pool.release(slab)
+        if frames:
+            return frames
@@ -0,0 +1,143 @@
+"""
+Per-connection flood protection with token buckets.
+
+Each connection gets three buckets: messages per second, bytes per second
+for chat/control frames, and bytes per second for file data. Frames are
+always accepted and charged to the bucket; when a bucket goes into debt
+the reader simply stops reading that socket for as long as it takes to
+pay the debt back. TCP flow control then pushes back on the sender, so a
+flooding client slows itself down without being disconnected and without
+affecting anybody else.
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+
+from .protocol import Op, HEADER_SIZE
+
+# Longest single pause, keeps the reader responsive to heartbeats
+MAX_BACKPRESSURE_DELAY = 5.0
+
+
+class RateLimits:
+    """Rate limit configuration, shared by many connections."""
+
+    __slots__ = ("messages_per_sec", "message_burst", "bytes_per_sec",
+                 "byte_burst", "file_bytes_per_sec", "file_burst")
+
+    def __init__(self,
+                 messages_per_sec: float = 20.0,
+                 message_burst: float = 40.0,
+                 bytes_per_sec: float = 64 * 1024,
+                 byte_burst: float = 128 * 1024,
+                 file_bytes_per_sec: float = 4 * 1024 * 1024,
+                 file_burst: float = 1024 * 1024):
+        self.messages_per_sec = messages_per_sec
+        self.message_burst = message_burst
+        self.bytes_per_sec = bytes_per_sec
+        self.byte_burst = byte_burst
+        self.file_bytes_per_sec = file_bytes_per_sec
+        self.file_burst = file_burst
+
+
+DEFAULT_RATE_LIMITS = RateLimits()
+
+
+class TokenBucket:
+    """Classic token bucket that is allowed to go into debt."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def charge(self, amount: float, now: Optional[float] = None) -> float:
+        """Take `amount` tokens and return how long the caller should wait."""
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class ThrottleStats:
+    """Throttling counters aggregated over all connections."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events: Dict[str, int] = {"messages": 0, "bytes": 0, "file": 0}
+        self.delay_seconds: Dict[str, float] = {"messages": 0.0, "bytes": 0.0, "file": 0.0}
+
+    def record(self, bucket: str, delay: float):
+        with self._lock:
+            self.events[bucket] += 1
+            self.delay_seconds[bucket] += delay
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"events": dict(self.events), "delay_seconds": dict(self.delay_seconds)}
+
+
+class RateLimiter:
+    """The three buckets of one connection.
+
+    Readers call charge() for every inbound frame and wait() once per
+    batch; wait() sleeps off the largest debt, which is the backpressure.
+    """
+
+    __slots__ = ("messages", "bytes", "file", "stats", "_delay", "_bucket")
+
+    def __init__(self, limits: RateLimits = DEFAULT_RATE_LIMITS, stats: Optional[ThrottleStats] = None):
+        self.messages = TokenBucket(limits.messages_per_sec, limits.message_burst)
+        self.bytes = TokenBucket(limits.bytes_per_sec, limits.byte_burst)
+        self.file = TokenBucket(limits.file_bytes_per_sec, limits.file_burst)
+        self.stats = stats
+        self._delay = 0.0
+        self._bucket = None
+
+    def charge(self, op: int, payload_size: int) -> float:
+        """Charge one inbound frame, return the backpressure delay it causes."""
+        now = time.monotonic()
+        size = HEADER_SIZE + payload_size
+
+        if op == Op.FILE_CHUNK:
+            delay = self.file.charge(size, now)
+            bucket = "file"
+        else:
+            message_delay = self.messages.charge(1, now)
+            byte_delay = self.bytes.charge(size, now)
+            if message_delay >= byte_delay:
+                delay, bucket = message_delay, "messages"
+            else:
+                delay, bucket = byte_delay, "bytes"
+
+        if delay > self._delay:
+            self._delay, self._bucket = delay, bucket
+        return delay
+
+    def pending(self) -> float:
+        """Delay wait() is about to apply."""
+        return min(self._delay, MAX_BACKPRESSURE_DELAY)
+
+    def wait(self) -> float:
+        """Stop reading for the pending delay, return the seconds slept."""
+        delay = self.pending()
+        if delay <= 0:
+            return 0.0
+        if self.stats is not None:
+            self.stats.record(self._bucket, delay)
+        self._delay, self._bucket = 0.0, None
+        time.sleep(delay)
+        return delay
+
+
+def limits_for(username: str, user_limits: Dict[str, RateLimits], default: RateLimits = DEFAULT_RATE_LIMITS) -> RateLimits:
+    """Per-user override if configured, otherwise the global limits."""
+    return user_limits.get(username, default)
@@ -0,0 +1,235 @@
+"""
+Client reconnects without a thundering herd.
+
+When a server restarts, every client notices within the same second.
+If they all retry after a fixed delay they come back in lockstep, again
+and again, and the server spends its first seconds refusing them.
+
+ReconnectScheduler spreads them out:
+
+  * Capped exponential backoff with full jitter: attempt n waits a
+    uniformly random time in [0, min(cap, base * 2**n)], so retries
+    decorrelate after the first round.
+  * A network change hint skips the rest of the current wait. Hints are
+    a new local address (Wi-Fi came back, roaming to another network)
+    or a beacon from a server we know (it is up again). The retry still
+    happens after a short random delay, because the beacon reaches all
+    clients at once too.
+  * Every known server gets a HealthTracker score from recent connect
+    outcomes and latency. The best one is tried first, and servers that
+    just failed cool down before they are tried again. A small random
+    term splits clients evenly between equally healthy servers.
+
+Attempts run on the scheduler's own thread, so the UI never blocks on
+connect(). The connected socket is handed to `on_connected`.
+"""
+
+import random
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .logs import CLIENT, get_logger
+
+log = get_logger(CLIENT)
+
+Address = Tuple[str, int]
+
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+FAST_RETRY_WINDOW = 1.0       # random delay after a network change hint
+NETWORK_POLL = 2.0            # how often the local address is checked
+CONNECT_TIMEOUT = 5.0
+HEALTH_ALPHA = 0.3            # weight of the newest outcome in a score
+COOLDOWN_CAP = 60.0
+
+
+class Backoff:
+    """Capped exponential backoff with full jitter."""
+
+    def __init__(self, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP, rng: random.Random = None):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+        self._rng = rng or random.Random()
+
+    def next_delay(self) -> float:
+        ceiling = min(self.cap, self.base * (2 ** self.attempts))
+        self.attempts += 1
+        return self._rng.uniform(0, ceiling)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class ServerHealth:
+    """Connect history of one server."""
+
+    __slots__ = ("score", "latency", "failures", "last_failure")
+
+    def __init__(self):
+        self.score = 0.5          # unknown servers rank between good and bad ones
+        self.latency = None       # smoothed connect time, seconds
+        self.failures = 0         # consecutive
+        self.last_failure = 0.0
+
+    def cooling_down(self, now: float) -> bool:
+        if not self.failures:
+            return False
+        return now - self.last_failure < min(COOLDOWN_CAP, BACKOFF_BASE * 2 ** self.failures)
+
+
+class HealthTracker:
+    """Scores for every server the client knows, thread-safe."""
+
+    def __init__(self, rng: random.Random = None):
+        self._servers: Dict[Address, ServerHealth] = {}
+        self._lock = threading.Lock()
+        self._rng = rng or random.Random()
+
+    def record_success(self, server: Address, latency: float):
+        with self._lock:
+            health = self._servers.setdefault(server, ServerHealth())
+            health.score += HEALTH_ALPHA * (1.0 - health.score)
+            health.latency = latency if health.latency is None else 0.7 * health.latency + 0.3 * latency
+            health.failures = 0
+
+    def record_failure(self, server: Address, now: Optional[float] = None):
+        with self._lock:
+            health = self._servers.setdefault(server, ServerHealth())
+            health.score -= HEALTH_ALPHA * health.score
+            health.failures += 1
+            health.last_failure = time.monotonic() if now is None else now
+
+    def score(self, server: Address) -> float:
+        with self._lock:
+            health = self._servers.get(server)
+            return 0.5 if health is None else health.score
+
+    def ranked(self, servers: Iterable[Address], now: Optional[float] = None) -> List[Address]:
+        """Best first. Servers cooling down go last, unless all of them are."""
+        now = time.monotonic() if now is None else now
+        ready, cooling = [], []
+        with self._lock:
+            for server in dict.fromkeys(servers):
+                health = self._servers.get(server) or ServerHealth()
+                value = health.score - 0.1 * min(health.latency or 0.0, 2.0) + self._rng.uniform(0, 0.05)
+                (cooling if health.cooling_down(now) else ready).append((value, server))
+        return [server for _, server in sorted(ready, reverse=True) + sorted(cooling, reverse=True)]
+
+
+def local_address() -> Optional[str]:
+    """Address of the interface with the default route, None when offline.
+
+    Connecting a UDP socket only selects a route, nothing is sent.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(("192.0.2.1", 9))
+        return sock.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def open_connection(host: str, port: int, timeout: float = CONNECT_TIMEOUT) -> socket.socket:
+    return socket.create_connection((host, port), timeout=timeout)
+
+
+class ReconnectScheduler:
+    """Retries until some server accepts a connection.
+
+    `servers()` lists the candidates for the next round, `on_connected
+    (sock, server)` runs on the scheduler thread once one accepted.
+    """
+
+    def __init__(self, servers: Callable[[], List[Address]],
+                 on_connected: Callable[[socket.socket, Address], None],
+                 connect: Callable[[str, int], socket.socket] = open_connection,
+                 backoff: Backoff = None,
+                 health: HealthTracker = None,
+                 watch_network: bool = True):
+        self.servers = servers
+        self.on_connected = on_connected
+        self.connect = connect
+        self.backoff = backoff or Backoff()
+        self.health = health or HealthTracker()
+        self.watch_network = watch_network
+        self._hint = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stopped.is_set()
+
+    def start(self, delay: Optional[float] = None):
+        """Start retrying. The first attempt waits `delay` if given,
+        e.g. what the server asked for when it went away."""
+        with self._lock:
+            if self.running:
+                return
+            self._stopped = threading.Event()
+            self._hint.clear()
+            self._thread = threading.Thread(target=self._run, args=(self._stopped, delay), name="reconnect", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Give up, e.g. the user connected by hand or closed the app."""
+        self._stopped.set()
+        self._hint.set()
+
+    def network_changed(self):
+        """Something suggests a retry would work now, skip the wait."""
+        self._hint.set()
+
+    def _run(self, stopped: threading.Event, delay: Optional[float] = None):
+        address = local_address() if self.watch_network else None
+        while not stopped.is_set():
+            address = self._wait(self.backoff.next_delay() if delay is None else delay, address, stopped)
+            delay = None
+            if stopped.is_set():
+                return
+            for server in self.health.ranked(self.servers()):
+                if stopped.is_set():
+                    return
+                started = time.monotonic()
+                try:
+                    sock = self.connect(*server)
+                except OSError as e:
+                    self.health.record_failure(server)
+                    log.debug("reconnect failed", extra={"server": f"{server[0]}:{server[1]}", "error": str(e)})
+                    continue
+                self.health.record_success(server, time.monotonic() - started)
+                if stopped.is_set():
+                    sock.close()
+                    return
+                self.backoff.reset()
+                stopped.set()
+                self.on_connected(sock, server)
+                return
+
+    def _wait(self, delay: float, address: Optional[str], stopped: threading.Event) -> Optional[str]:
+        """Sleep for delay, or less after a hint. Returns the local address."""
+        deadline = time.monotonic() + delay
+        while not stopped.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return address
+            if self._hint.wait(min(remaining, NETWORK_POLL) if self.watch_network else remaining):
+                self._hint.clear()
+                break
+            if self.watch_network:
+                current = local_address()
+                if current != address:
+                    log.info("network changed", extra={"address": current})
+                    address = current
+                    if current is not None:
+                        break
+        # Everyone got the same hint at the same moment, keep them apart
+        self.backoff.reset()
+        stopped.wait(random.uniform(0, FAST_RETRY_WINDOW))
+        return address
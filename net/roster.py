@@ -0,0 +1,150 @@
+"""
+Versioned presence roster.
+
+The server owns a Roster and bumps its version on every join or leave.
+A new client gets one full snapshot, everybody else only gets the small
+add/remove delta tagged with the new version. Clients keep a
+RosterReplica and ask for a fresh snapshot only when they notice a gap
+in the version sequence.
+
+The server also keeps the last few changes, so a client that resumes a
+session only gets the deltas after the version it already has.
+"""
+
+import os
+import threading
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+
+ROSTER_HISTORY = 1024  # changes kept for resuming clients
+
+
+class Roster:
+    """Server side set of online users with a monotonically increasing version."""
+
+    def __init__(self, history: int = ROSTER_HISTORY):
+        self.id = os.urandom(4).hex()  # versions only compare within one roster
+        self._users = {}  # dict keeps join order and gives O(1) membership
+        self._version = 0
+        self._changes = deque(maxlen=history)  # (version, added, username)
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def add(self, username: str) -> Optional[int]:
+        """Add a user and return the new version, or None if already present."""
+        with self._lock:
+            if username in self._users:
+                return None
+            self._users[username] = True
+            self._version += 1
+            self._changes.append((self._version, True, username))
+            return self._version
+
+    def remove(self, username: str) -> Optional[int]:
+        """Remove a user and return the new version, or None if not present."""
+        with self._lock:
+            if self._users.pop(username, None) is None:
+                return None
+            self._version += 1
+            self._changes.append((self._version, False, username))
+            return self._version
+
+    def snapshot(self) -> Tuple[int, List[str]]:
+        """Return (version, users) consistent with each other."""
+        with self._lock:
+            return self._version, list(self._users)
+
+    def changes_since(self, version: int) -> Optional[List[Tuple[int, bool, str]]]:
+        """Deltas after version in order, None if they are no longer kept."""
+        with self._lock:
+            if version == self._version:
+                return []
+            if version > self._version or not self._changes or self._changes[0][0] > version + 1:
+                return None
+            return [change for change in self._changes if change[0] > version]
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+
+class RosterReplica:
+    """Client side mirror of the server roster.
+
+    Deltas are applied in version order. A delta that skips a version
+    means something was missed: the replica asks for a resync through
+    `request_sync` and parks later deltas until the snapshot arrives.
+    """
+
+    def __init__(self,
+                 on_snapshot: Callable[[List[str]], None],
+                 on_add: Callable[[str], None],
+                 on_remove: Callable[[str], None],
+                 request_sync: Callable[[], None]):
+        self.on_snapshot = on_snapshot
+        self.on_add = on_add
+        self.on_remove = on_remove
+        self.request_sync = request_sync
+        self.version: Optional[int] = None
+        self.users: List[str] = []
+        self._syncing = False
+        self._parked: List[Tuple[int, bool, str]] = []
+
+    @property
+    def in_sync(self) -> bool:
+        """True when the replica matches a known server version."""
+        return self.version is not None and not self._syncing
+
+    def reset(self):
+        """Forget all state, e.g. after a disconnect."""
+        self.version = None
+        self.users = []
+        self._syncing = False
+        self._parked.clear()
+
+    def apply_snapshot(self, version: int, users: List[str]):
+        """Replace the replica with a full snapshot."""
+        self.version = version
+        self.users = list(users)
+        self._syncing = False
+        self.on_snapshot(self.users.copy())
+
+        # Replay deltas that raced ahead of the snapshot
+        parked = sorted(self._parked)
+        self._parked.clear()
+        for delta_version, added, username in parked:
+            self._apply_delta(delta_version, added, username)
+
+    def apply_add(self, version: int, username: str):
+        self._apply_delta(version, True, username)
+
+    def apply_remove(self, version: int, username: str):
+        self._apply_delta(version, False, username)
+
+    def _apply_delta(self, version: int, added: bool, username: str):
+        if self._syncing or self.version is None:
+            self._parked.append((version, added, username))
+            return
+
+        if version <= self.version:
+            return  # Already covered by the snapshot
+
+        if version != self.version + 1:
+            self._syncing = True
+            self._parked.append((version, added, username))
+            self.request_sync()
+            return
+
+        self.version = version
+        if added:
+            if username not in self.users:
+                self.users.append(username)
+                self.on_add(username)
+        elif username in self.users:
+            self.users.remove(username)
+            self.on_remove(username)
@@ -0,0 +1,135 @@
+"""
+Registry of the client sessions of one server process.
+
+Every connection is one Session, found in O(1) by username, socket fd
+or session id. A session is added as soon as its writer exists and
+joins once the client is welcomed; only joined sessions are looked up
+by name and receive broadcasts.
+
+Broadcasts iterate a snapshot: a tuple of the joined sessions that is
+rebuilt after a join or leave, on first use, and then shared by every
+reader. Fan-out never takes the registry lock and never copies the
+list, it only pays for a copy once per membership change.
+
+During a resume the same user briefly has two sessions, the new one and
+the one that has not timed out yet. Both get broadcasts, name lookups
+find the newest.
+"""
+
+import itertools
+import socket
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .writer import CoalescingWriter
+
+_session_ids = itertools.count(1)
+
+
+class Session:
+    """Per-connection state of one client."""
+
+    __slots__ = ("id", "username", "sock", "fd", "writer", "codec", "resumed", "connected")
+
+    def __init__(self, username: str, sock: socket.socket, writer: Optional[CoalescingWriter] = None,
+                 codec: Optional[str] = None):
+        self.id = next(_session_ids)
+        self.username = username
+        self.sock = sock
+        self.fd = sock.fileno()   # kept, fileno() is -1 once the socket is closed
+        self.writer = writer
+        self.codec = codec
+        self.resumed = False
+        self.connected = time.monotonic()
+
+    def __repr__(self):
+        return f"<Session {self.id} {self.username} fd={self.fd}>"
+
+
+class SessionRegistry:
+    """All sessions of this process, thread-safe."""
+
+    def __init__(self):
+        self._by_fd: Dict[int, Session] = {}
+        self._by_id: Dict[int, Session] = {}
+        self._by_name: Dict[str, Session] = {}   # newest joined session per user
+        self._joined: Dict[int, Session] = {}    # fd -> session, broadcast order
+        self._snapshot: Optional[Tuple[Session, ...]] = ()
+        self._lock = threading.Lock()
+
+    def add(self, session: Session):
+        """Register a connection that has not joined yet."""
+        with self._lock:
+            self._by_fd[session.fd] = session
+            self._by_id[session.id] = session
+
+    def join(self, session: Session) -> Optional[Session]:
+        """Make session visible to broadcasts and name lookups.
+
+        Returns the user's previous session, if it is still around.
+        """
+        with self._lock:
+            previous = self._by_name.get(session.username)
+            self._by_name[session.username] = session
+            self._joined[session.fd] = session
+            self._snapshot = None
+        return previous if previous is not session else None
+
+    def remove(self, session: Session) -> bool:
+        """Forget session. True if the user has no other session left."""
+        with self._lock:
+            if self._by_fd.get(session.fd) is session:
+                del self._by_fd[session.fd]
+            self._by_id.pop(session.id, None)
+            if self._joined.get(session.fd) is session:
+                del self._joined[session.fd]
+                self._snapshot = None
+            if self._by_name.get(session.username) is session:
+                del self._by_name[session.username]
+            return session.username not in self._by_name
+
+    # -- lookups, lock-free reads of a dict are atomic ----------------------
+
+    def by_username(self, username: str) -> Optional[Session]:
+        return self._by_name.get(username)
+
+    def by_fd(self, fd: int) -> Optional[Session]:
+        return self._by_fd.get(fd)
+
+    def by_id(self, session_id: int) -> Optional[Session]:
+        return self._by_id.get(session_id)
+
+    def of(self, sock: socket.socket) -> Optional[Session]:
+        """Session of a socket, None once it is closed or removed."""
+        return self._by_fd.get(sock.fileno())
+
+    def snapshot(self) -> Tuple[Session, ...]:
+        """Joined sessions as an immutable tuple, safe to iterate while others join or leave."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._joined.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def all(self) -> List[Session]:
+        """Every session, including the ones that have not joined yet."""
+        return list(self._by_fd.values())
+
+    def usernames(self) -> List[str]:
+        return list(self._by_name)
+
+    def writers(self) -> List[CoalescingWriter]:
+        """Writers of every session, joined or not."""
+        return [s.writer for s in list(self._by_fd.values()) if s.writer is not None]
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._by_name
+
+    def __len__(self) -> int:
+        return len(self.snapshot())
+
+    def __iter__(self) -> Iterator[Session]:
+        return iter(self.snapshot())
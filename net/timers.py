@@ -0,0 +1,99 @@
+"""
+Hashed timer wheel.
+
+One background thread drives every timer on the server, instead of one
+thread (or threading.Timer) per client. Scheduling and cancelling are
+O(1); each tick only looks at the timers that landed in the current slot.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from .logs import NET, get_logger
+
+log = get_logger(NET)
+
+
+class TimerWheel:
+    """Coarse-grained timers keyed by an arbitrary hashable key.
+
+    Scheduling a key that already has a timer replaces it, which is what
+    idle timers want. Callbacks run on the wheel thread and must be quick.
+    """
+
+    def __init__(self, tick: float = 0.5, slots: int = 128):
+        self.tick = tick
+        self._slots: List[Dict[Hashable, Tuple[int, Callable[[], None]]]] = [dict() for _ in range(slots)]
+        self._where: Dict[Hashable, int] = {}
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the wheel thread."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="timer-wheel", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the wheel thread, pending timers are dropped."""
+        self._running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.tick * 2)
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], None]):
+        """Run callback after roughly delay seconds (rounded up to a tick)."""
+        ticks = max(1, int(-(-delay // self.tick)))
+        rounds = (ticks - 1) // len(self._slots)
+        with self._lock:
+            self._cancel_locked(key)
+            slot = (self._cursor + ticks) % len(self._slots)
+            self._slots[slot][key] = (rounds, callback)
+            self._where[key] = slot
+
+    def cancel(self, key: Hashable):
+        """Cancel the timer for key, if any."""
+        with self._lock:
+            self._cancel_locked(key)
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def _cancel_locked(self, key: Hashable):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            self._slots[slot].pop(key, None)
+
+    def advance(self):
+        """Process one tick. Called by the wheel thread, or directly by tests/benchmarks."""
+        due = []
+        with self._lock:
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            bucket = self._slots[self._cursor]
+            for key, (rounds, callback) in list(bucket.items()):
+                if rounds:
+                    bucket[key] = (rounds - 1, callback)
+                else:
+                    del bucket[key]
+                    del self._where[key]
+                    due.append(callback)
+
+        # Callbacks run outside the lock so they can reschedule themselves
+        for callback in due:
+            try:
+                callback()
+            except Exception:
+                log.exception("timer callback failed")
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while self._running:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.advance()
+            next_tick += self.tick
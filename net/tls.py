@@ -0,0 +1,132 @@
+"""
+Optional TLS for client connections.
+
+TLS is off unless the server is given a certificate. When it is on, the
+listening socket stays a plain TCP socket (so handing it to a successor
+works as before) and every accepted connection is wrapped on its own
+client thread, never on the accept loop.
+
+Reconnects skip the full handshake: the server hands out session
+tickets (TLS 1.3, or RFC 5077 tickets with TLS 1.2) and the client
+keeps the latest session per server in a TLSSessionCache and offers it
+on the next connect. The ticket keys live in the server's SSLContext,
+so workers forked after creating it resume each other's sessions. A
+restarted server has new keys, and the first reconnect to it does a
+full handshake again.
+
+Two things a plain socket can do and an SSLSocket cannot, which the
+rest of the package works around:
+
+  - sendmsg(): a batch of frames is joined and written with sendall(),
+    see writer.py. It is encrypted into one buffer either way.
+  - MSG_PEEK: the bytes on the wire are ciphertext, so waiting for data
+    without a buffer uses select() instead, see buffers.py.
+
+Where the kernel supports it (Linux kTLS, OpenSSL 3, Python 3.12), the
+contexts ask OpenSSL to hand record encryption to the kernel.
+"""
+
+import socket
+import ssl
+import threading
+from typing import Dict, Optional, Tuple
+
+HANDSHAKE_TIMEOUT = 10.0   # seconds a client gets to complete the TLS handshake
+SESSION_TICKETS = 2        # tickets per handshake (TLS 1.3), one per parallel reconnect
+
+_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 0)
+
+
+def server_context(certfile: str, keyfile: Optional[str] = None,
+                   cafile: Optional[str] = None) -> ssl.SSLContext:
+    """Context for the listener. With cafile, clients need a certificate it signed."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.options |= _KTLS
+    context.num_tickets = SESSION_TICKETS
+    if cafile:
+        context.load_verify_locations(cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+def client_context(cafile: Optional[str] = None, verify: bool = True) -> ssl.SSLContext:
+    """Context for connecting to a server.
+
+    cafile trusts the certificate of a LAN server (self-signed or from
+    an in-house CA), without it the system's CAs are used. verify=False
+    accepts any certificate: traffic is still encrypted, but not
+    protected from someone in the middle.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= _KTLS
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def accept_tls(context: ssl.SSLContext, sock: socket.socket,
+               timeout: float = HANDSHAKE_TIMEOUT) -> ssl.SSLSocket:
+    """Server side handshake on an accepted socket, raises OSError on failure."""
+    _no_delay(sock)
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    wrapped = context.wrap_socket(sock, server_side=True)
+    wrapped.settimeout(previous)
+    return wrapped
+
+
+def _no_delay(sock: socket.socket):
+    # A handshake is several small writes in a row, with Nagle on the
+    # last one waits for the peer's delayed ACK. Frames are coalesced
+    # by the writers anyway
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def is_tls(sock) -> bool:
+    return isinstance(sock, ssl.SSLSocket)
+
+
+class TLSSessionCache:
+    """Latest TLS session per server, offered again on reconnect."""
+
+    def __init__(self):
+        self._sessions: Dict[Tuple[str, int], ssl.SSLSession] = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, context: ssl.SSLContext, sock: socket.socket, host: str, port: int) -> ssl.SSLSocket:
+        """Client side handshake on a connected socket, resuming if we can."""
+        with self._lock:
+            session = self._sessions.get((host, port))
+        server_hostname = host if context.check_hostname else None
+        _no_delay(sock)
+        try:
+            return context.wrap_socket(sock, server_hostname=server_hostname, session=session)
+        except ssl.SSLError:
+            # A server that no longer knows the session just does a full
+            # handshake, so this is something else: do not offer it again
+            self.forget(host, port)
+            raise
+
+    def remember(self, host: str, port: int, sock):
+        """Keep the session of sock. With TLS 1.3 the ticket arrives after
+        the handshake, so call it once the server has sent something."""
+        session = getattr(sock, "session", None)
+        if session is not None and session.has_ticket:
+            with self._lock:
+                self._sessions[(host, port)] = session
+
+    def forget(self, host: str, port: int):
+        with self._lock:
+            self._sessions.pop((host, port), None)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
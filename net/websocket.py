@@ -0,0 +1,440 @@
+"""
+WebSocket gateway: browsers and scripts speak the native protocol over
+WebSocket (RFC 6455), on the server's own WS_PORT, no gateway process.
+
+A WebSocket connection becomes an ordinary session once the upgrade is
+done: the decoder here turns WebSocket messages into native frames for
+the client handler, and the framer turns native frames back into
+WebSocket messages on the connection's writer thread. Routing, the
+session registry, rate limits, history and everything else are shared
+with native clients.
+
+Two subprotocols, chosen with Sec-WebSocket-Protocol:
+
+    proxichat.json  (the default) text messages, one JSON object per
+                    frame: the body with the opcode name added,
+                    {"op": "CHAT", "text": "hi"}. A binary message
+                    carries native frames as they are, e.g. FILE_CHUNKs.
+    proxichat       binary messages carrying native frames, what a
+                    script that already speaks the protocol wants.
+
+Server heartbeats are WebSocket pings, which browsers answer by
+themselves, and a pong counts as a native PONG.
+
+permessage-deflate (RFC 7692) is offered, and the server never keeps
+its compression context between messages (server_no_context_takeover).
+That costs a little ratio, but makes a compressed message the same
+bytes for every client, so a broadcast is still converted and deflated
+once: MessageCache keeps the WebSocket form of recent frames, and every
+other writer sending the same frame reuses it.
+"""
+
+import base64
+import hashlib
+import json
+import socket
+import struct
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .protocol import (
+    BINARY_OPS, HEADER_SIZE, MAX_PAYLOAD_SIZE, FrameDecoder, Op, ProtocolError, op_name,
+)
+
+SUBPROTOCOL_JSON = "proxichat.json"
+SUBPROTOCOL_BINARY = "proxichat"
+
+HANDSHAKE_TIMEOUT = 10.0     # seconds to send the HTTP upgrade request
+MAX_REQUEST_BYTES = 8192     # of the upgrade request
+DEFLATE_THRESHOLD = 128      # smaller messages are sent uncompressed
+DEFLATE_LEVEL = 6
+CACHE_FRAMES = 1024          # WebSocket forms of recent frames kept per variant
+
+_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_TAIL = b"\x00\x00\xff\xff"
+
+# Opcodes
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+GOING_AWAY = 1001            # close code of a server that shuts down
+
+_OPS_BY_NAME = {name: value for name, value in vars(Op).items() if name.isupper()}
+
+
+class RawMessage(bytes):
+    """An already framed WebSocket message, the framer passes it through."""
+
+
+def encode_message(opcode: int, payload: bytes, compressed: bool = False) -> bytes:
+    """A complete, unmasked (server to client) WebSocket frame."""
+    first = 0x80 | opcode | (0x40 if compressed else 0)
+    length = len(payload)
+    if length < 126:
+        header = bytes((first, length))
+    elif length < 65536:
+        header = struct.pack("!BBH", first, 126, length)
+    else:
+        header = struct.pack("!BBQ", first, 127, length)
+    return header + payload
+
+
+def close_message(code: int = GOING_AWAY, reason: str = "") -> RawMessage:
+    return RawMessage(encode_message(CLOSE, struct.pack("!H", code) + reason.encode("utf-8")[:120]))
+
+
+def _unmask(data, mask: bytes) -> bytes:
+    length = len(data)
+    if not length:
+        return b""
+    # One big-integer XOR instead of a Python loop over the bytes
+    key = int.from_bytes((mask * (length // 4 + 1))[:length], "little")
+    return (int.from_bytes(data, "little") ^ key).to_bytes(length, "little")
+
+
+# ============================================================================
+# HANDSHAKE
+# ============================================================================
+
+class WebSocket:
+    """What accept_websocket() negotiated for one connection."""
+
+    def __init__(self, subprotocol: str, deflate_bits: int, reset_inflater: bool,
+                 cache: "MessageCache", early: bytes):
+        self.subprotocol = subprotocol
+        self.deflate_bits = deflate_bits
+        self.decoder = WebSocketDecoder(bool(deflate_bits), reset_inflater)
+        self.framer = WebSocketFramer(subprotocol == SUBPROTOCOL_BINARY, deflate_bits, cache)
+        # Messages that arrived together with the upgrade request
+        self.early = self.decoder.feed(early) if early else []
+
+
+def accept_websocket(sock, cache: "MessageCache", deflate: bool = True,
+                     origins: Optional[Iterable[str]] = None,
+                     timeout: float = HANDSHAKE_TIMEOUT) -> WebSocket:
+    """Read the HTTP upgrade request on sock and answer it.
+
+    Raises ProtocolError (after answering with an HTTP error) for
+    anything that is not an acceptable WebSocket upgrade.
+    """
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    request = b""
+    try:
+        while b"\r\n\r\n" not in request:
+            if len(request) > MAX_REQUEST_BYTES:
+                _refuse(sock, 431, "Request Header Fields Too Large")
+            data = sock.recv(4096)
+            if not data:
+                raise ProtocolError("Connection closed during the WebSocket handshake")
+            request += data
+    except socket.timeout:
+        raise ProtocolError("WebSocket handshake timed out")
+    head, _, early = request.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    method, _, _ = lines[0].partition(" ")
+    headers: Dict[str, str] = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        name = name.strip().lower()
+        # Repeated headers are combined, as HTTP allows for lists
+        headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+
+    if method != "GET" or "websocket" not in headers.get("upgrade", "").lower():
+        _refuse(sock, 426, "Upgrade Required", extra="Upgrade: websocket\r\nSec-WebSocket-Version: 13\r\n")
+    key = headers.get("sec-websocket-key")
+    if not key or headers.get("sec-websocket-version") != "13":
+        _refuse(sock, 400, "Bad Request", extra="Sec-WebSocket-Version: 13\r\n")
+    if origins is not None and headers.get("origin") not in origins:
+        _refuse(sock, 403, "Forbidden")
+
+    accept = base64.b64encode(hashlib.sha1(key.encode("ascii") + _GUID).digest()).decode("ascii")
+    response = [
+        "HTTP/1.1 101 Switching Protocols",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        f"Sec-WebSocket-Accept: {accept}",
+    ]
+    subprotocol = SUBPROTOCOL_JSON
+    offered = [p.strip() for p in headers.get("sec-websocket-protocol", "").split(",") if p.strip()]
+    for protocol in offered:
+        if protocol in (SUBPROTOCOL_JSON, SUBPROTOCOL_BINARY):
+            subprotocol = protocol
+            response.append(f"Sec-WebSocket-Protocol: {protocol}")
+            break
+
+    deflate_bits, reset_inflater = 0, False
+    if deflate:
+        agreed = _negotiate_deflate(headers.get("sec-websocket-extensions", ""))
+        if agreed is not None:
+            deflate_bits, reset_inflater, extension = agreed
+            response.append(f"Sec-WebSocket-Extensions: {extension}")
+
+    sock.sendall(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+    sock.settimeout(previous)
+    return WebSocket(subprotocol, deflate_bits, reset_inflater, cache, early)
+
+
+def _refuse(sock, status: int, reason: str, extra: str = ""):
+    try:
+        sock.sendall(f"HTTP/1.1 {status} {reason}\r\n{extra}Connection: close\r\n"
+                     f"Content-Length: 0\r\n\r\n".encode("latin-1"))
+    except OSError:
+        pass
+    raise ProtocolError(f"WebSocket upgrade refused: {status} {reason}")
+
+
+def _negotiate_deflate(header: str) -> Optional[Tuple[int, bool, str]]:
+    """(server window bits, client resets its context, response) for the
+    first permessage-deflate offer we can take, None if there is none."""
+    for offer in header.split(","):
+        name, *params = [part.strip() for part in offer.split(";")]
+        if name != "permessage-deflate":
+            continue
+        bits, reset, response = 15, False, ["permessage-deflate", "server_no_context_takeover"]
+        try:
+            for param in params:
+                key, _, value = param.partition("=")
+                key, value = key.strip(), value.strip().strip('"')
+                if key == "server_max_window_bits":
+                    # Raw deflate cannot do 8, 9 is just as compatible
+                    bits = max(9, int(value))
+                    if bits > 15:
+                        raise ValueError(value)
+                    response.append(f"server_max_window_bits={bits}")
+                elif key == "client_no_context_takeover":
+                    reset = True
+                    response.append("client_no_context_takeover")
+                elif key not in ("client_max_window_bits", "server_no_context_takeover"):
+                    raise ValueError(key)
+        except ValueError:
+            continue
+        return bits, reset, "; ".join(response)
+    return None
+
+
+# ============================================================================
+# INBOUND
+# ============================================================================
+
+class WebSocketDecoder:
+    """Incremental decoder turning WebSocket messages into native frames,
+    a drop-in for FrameDecoder in read_frames().
+
+    Pings are answered through `reply`, which the client handler points
+    at the session's writer once it has one. A close becomes a native
+    DISCONNECT.
+    """
+
+    def __init__(self, deflate: bool = False, reset_inflater: bool = False,
+                 max_message: int = MAX_PAYLOAD_SIZE + HEADER_SIZE):
+        self.reply: Optional[Callable[[bytes], object]] = None
+        self.max_message = max_message
+        self.closed = False
+        self._deflate = deflate
+        self._reset_inflater = reset_inflater
+        self._inflater = zlib.decompressobj(-15) if deflate else None
+        self._buffer = bytearray()
+        self._parts: List[bytes] = []
+        self._size = 0
+        self._kind = None
+        self._compressed = False
+        self._native = FrameDecoder()
+
+    def feed(self, data) -> List[Tuple[int, int, bytes]]:
+        self._buffer += data
+        frames = []
+        offset = 0
+        buffer = self._buffer
+        while not self.closed:
+            if len(buffer) - offset < 2:
+                break
+            first, second = buffer[offset], buffer[offset + 1]
+            length = second & 0x7F
+            start = offset + 2
+            if length == 126:
+                if len(buffer) - start < 2:
+                    break
+                length = int.from_bytes(buffer[start:start + 2], "big")
+                start += 2
+            elif length == 127:
+                if len(buffer) - start < 8:
+                    break
+                length = int.from_bytes(buffer[start:start + 8], "big")
+                start += 8
+            if not second & 0x80:
+                raise ProtocolError("Unmasked WebSocket frame from a client")
+            if length > self.max_message:
+                raise ProtocolError(f"WebSocket frame too large ({length} bytes)")
+            end = start + 4 + length
+            if len(buffer) < end:
+                break
+            with memoryview(buffer) as view:
+                payload = _unmask(view[start + 4:end], bytes(view[start:start + 4]))
+            offset = end
+            self._frame(first, payload, frames)
+        del buffer[:offset]
+        return frames
+
+    def _frame(self, first: int, payload: bytes, frames: list):
+        opcode = first & 0x0F
+        fin = first & 0x80
+        if opcode >= CLOSE:
+            if not fin or len(payload) > 125:
+                raise ProtocolError("Bad WebSocket control frame")
+            if opcode == CLOSE:
+                self.closed = True
+                self._send(RawMessage(encode_message(CLOSE, payload[:2])))
+                frames.append((Op.DISCONNECT, 0, b""))
+            elif opcode == PING:
+                self._send(RawMessage(encode_message(PONG, payload)))
+            elif opcode == PONG and payload:
+                # Answer to a server heartbeat, payload is the PING body
+                frames.append((Op.PONG, 0, payload))
+            return
+
+        if opcode == CONTINUATION:
+            if self._kind is None:
+                raise ProtocolError("WebSocket continuation without a message")
+        elif opcode in (TEXT, BINARY):
+            if self._kind is not None:
+                raise ProtocolError("New WebSocket message inside a fragmented one")
+            self._kind = opcode
+            self._compressed = bool(first & 0x40)
+            if self._compressed and not self._deflate:
+                raise ProtocolError("Compressed WebSocket message without permessage-deflate")
+        else:
+            raise ProtocolError(f"Unknown WebSocket opcode {opcode}")
+        self._parts.append(payload)
+        self._size += len(payload)
+        if self._size > self.max_message:
+            raise ProtocolError("WebSocket message too large")
+        if not fin:
+            return
+
+        message = self._parts[0] if len(self._parts) == 1 else b"".join(self._parts)
+        kind, compressed = self._kind, self._compressed
+        self._parts, self._size, self._kind = [], 0, None
+        if compressed:
+            message = self._inflate(message)
+        if kind == BINARY:
+            frames.extend(self._native.feed(message))
+        else:
+            frames.append(_from_json(message))
+
+    def _inflate(self, data: bytes) -> bytes:
+        if self._reset_inflater:
+            self._inflater = zlib.decompressobj(-15)
+        try:
+            message = self._inflater.decompress(data + _TAIL, self.max_message)
+        except zlib.error as e:
+            raise ProtocolError(f"Corrupt compressed WebSocket message: {e}")
+        if self._inflater.unconsumed_tail:
+            raise ProtocolError("Compressed WebSocket message expands past the size limit")
+        return message
+
+    def _send(self, message: RawMessage):
+        if self.reply is not None:
+            self.reply(message)
+
+
+def _from_json(message: bytes) -> Tuple[int, int, bytes]:
+    """{"op": "CHAT", ...} to a native (op, flags, payload)."""
+    try:
+        body = json.loads(message)
+        name = body.pop("op")
+    except (ValueError, TypeError, AttributeError, KeyError):
+        raise ProtocolError("WebSocket text message is not a JSON object with an op")
+    op = name if isinstance(name, int) else _OPS_BY_NAME.get(str(name).upper())
+    if op is None or op in BINARY_OPS:
+        raise ProtocolError(f"Unknown op {name!r} in a WebSocket message")
+    return op, 0, json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+# ============================================================================
+# OUTBOUND
+# ============================================================================
+
+class MessageCache:
+    """WebSocket forms of recently sent native frames, shared by every
+    WebSocket writer of the process. A broadcast frame is converted by
+    the first writer that sends it, the others find it here.
+
+    Plain dicts, whose single get and set are atomic: two writers
+    converting the same frame at once just both do the work.
+    """
+
+    def __init__(self, size: int = CACHE_FRAMES):
+        self.size = size
+        self._variants: Dict[Tuple[bool, int], Dict[bytes, bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def variant(self, binary: bool, deflate_bits: int) -> Dict[bytes, bytes]:
+        return self._variants.setdefault((binary, deflate_bits), {})
+
+    def store(self, variant: Dict[bytes, bytes], frame: bytes, message: bytes):
+        if len(variant) >= self.size:
+            # Broadcasts are converted within moments of each other,
+            # anything older is not worth an LRU
+            variant.clear()
+        variant[frame] = message
+
+
+class WebSocketFramer:
+    """Converts native frames of one connection into WebSocket messages.
+
+    It takes the compressor slot of the connection's CoalescingWriter,
+    so conversion runs on the writer thread, off the broadcasting one.
+    """
+
+    def __init__(self, binary: bool, deflate_bits: int, cache: MessageCache):
+        self.binary = binary
+        self.deflate_bits = deflate_bits
+        self.cache = cache
+        self._variant = cache.variant(binary, deflate_bits)
+
+    def compress_batch(self, frames: List[bytes]) -> List[bytes]:
+        return [self.convert(frame) for frame in frames]
+
+    def convert(self, frame: bytes) -> bytes:
+        if type(frame) is RawMessage:
+            return frame
+        message = self._variant.get(frame)
+        if message is not None:
+            self.cache.hits += 1
+            return message
+        self.cache.misses += 1
+        message = self._encode(frame)
+        self.cache.store(self._variant, frame, message)
+        return message
+
+    def _encode(self, frame: bytes) -> bytes:
+        op = frame[0]
+        if self.binary:
+            opcode, payload = BINARY, frame
+        else:
+            payload = memoryview(frame)[HEADER_SIZE:]
+            if op == Op.PING and len(payload) <= 125:
+                # Browsers answer WebSocket pings by themselves
+                return encode_message(PING, payload.tobytes())
+            opcode, payload = TEXT, _to_json(op, payload)
+        if self.deflate_bits and len(payload) >= DEFLATE_THRESHOLD:
+            deflater = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -self.deflate_bits)
+            compressed = deflater.compress(payload) + deflater.flush(zlib.Z_SYNC_FLUSH)
+            if compressed.endswith(_TAIL) and len(compressed) - 4 < len(payload):
+                return encode_message(opcode, compressed[:-4], compressed=True)
+        return encode_message(opcode, bytes(payload))
+
+
+def _to_json(op: int, payload) -> bytes:
+    """Native JSON payload to {"op": name, ...}, spliced without re-encoding."""
+    name = op_name(op)
+    tag = f'{{"op":"{name}"'.encode("ascii") if not name.isdigit() else f'{{"op":{op}'.encode("ascii")
+    if len(payload) <= 2:
+        return tag + b"}"
+    return tag + b"," + bytes(payload[1:])
@@ -0,0 +1,210 @@
+"""
+Per-client outbound writer with write coalescing.
+
+Broadcasting used to call sendall() once per message per recipient from
+whichever thread produced the message. Now producers only append the
+encoded frame to the recipient's queue; a writer thread per client
+gathers everything queued and hands it to the kernel with a single
+sendmsg() (scatter/gather, no copying into one big buffer). A TLS
+socket has no sendmsg(), there the batch is joined and encrypted in one
+go.
+
+When the connection has been quiet the first frame is written right
+away, so interactive chat stays snappy. When the connection is busy the
+writer lingers for at most `flush_window` seconds, or until
+`max_batch_bytes` are queued, to batch the burst into fewer syscalls.
+
+If the connection negotiated compression, frames are compressed here,
+on the writer thread, so the broadcasting thread only ever encodes once.
+
+Frames queued as droppable (typing indicators and similar soft state)
+are refused once more than `drop_watermark` bytes are waiting, so a
+client that falls behind loses those before anything that matters.
+"""
+
+import ssl
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+DEFAULT_FLUSH_WINDOW = 0.002           # Max extra latency added while busy
+DEFAULT_MAX_BATCH_BYTES = 64 * 1024    # Flush as soon as this much is queued
+DEFAULT_MAX_QUEUE_BYTES = 4 * 1024 * 1024  # Slow consumer limit
+BUSY_INTERVAL = 0.01                   # Flushes closer than this mean "busy"
+MAX_IOVEC = 512                        # Stay well below IOV_MAX
+
+
+class WriterStats:
+    """Counters of one writer, read without locking."""
+
+    __slots__ = ("frames", "bytes", "batches", "syscalls", "dropped")
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.batches = 0
+        self.syscalls = 0
+        self.dropped = 0
+
+
+class CoalescingWriter:
+    """Queue frames for one socket and flush them in batches."""
+
+    __slots__ = ("sock", "compressor", "flush_window", "max_batch_bytes", "max_queue_bytes",
+                 "drop_watermark", "on_error", "on_flush", "stats", "_queue", "_queued_bytes",
+                 "_cond", "_closed", "_last_flush", "_use_sendmsg", "_thread")
+
+    def __init__(self, sock,
+                 flush_window: float = DEFAULT_FLUSH_WINDOW,
+                 max_batch_bytes: int = DEFAULT_MAX_BATCH_BYTES,
+                 max_queue_bytes: int = DEFAULT_MAX_QUEUE_BYTES,
+                 on_error: Optional[Callable[[Exception], None]] = None,
+                 name: str = "writer",
+                 compressor=None,
+                 on_flush: Optional[Callable[[int, int, int], None]] = None):
+        self.sock = sock
+        self.compressor = compressor
+        self.flush_window = flush_window
+        self.max_batch_bytes = max_batch_bytes
+        self.max_queue_bytes = max_queue_bytes
+        self.drop_watermark = max_batch_bytes
+        self.on_error = on_error
+        self.on_flush = on_flush
+        self.stats = WriterStats()
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._last_flush = 0.0
+        self._use_sendmsg = hasattr(sock, "sendmsg") and not isinstance(sock, ssl.SSLSocket)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    def send(self, frame: bytes, droppable: bool = False) -> bool:
+        """Queue an encoded frame. Returns False if the writer is closed or full,
+        or if a droppable frame was dropped because the client is behind."""
+        with self._cond:
+            if self._closed:
+                return False
+            if droppable and self._queued_bytes > self.drop_watermark:
+                self.stats.dropped += 1
+                return False
+            if self._queued_bytes + len(frame) > self.max_queue_bytes:
+                overflow = True
+            else:
+                overflow = False
+                self._queue.append(frame)
+                self._queued_bytes += len(frame)
+                self._cond.notify()
+
+        if overflow:
+            self._fail(BufferError("Outbound queue full, client is not reading"))
+            return False
+        return True
+
+    def close(self, flush: bool = True, timeout: float = 1.0):
+        """Stop the writer, optionally waiting for queued frames to go out."""
+        with self._cond:
+            self._closed = True
+            if not flush:
+                self._queue.clear()
+                self._queued_bytes = 0
+            self._cond.notify()
+        if flush and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def join(self, timeout: Optional[float] = None):
+        """Wait for the writer thread to finish, e.g. after close(timeout=0)."""
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _fail(self, error: Exception):
+        with self._cond:
+            already_closed = self._closed
+            self._closed = True
+            self._queue.clear()
+            self._queued_bytes = 0
+            self._cond.notify()
+        if not already_closed and self.on_error is not None:
+            self.on_error(error)
+
+    def _take_batch(self):
+        """Pop up to max_batch_bytes worth of frames. Caller holds the lock."""
+        batch = []
+        size = 0
+        while self._queue and len(batch) < MAX_IOVEC:
+            frame = self._queue[0]
+            if batch and size + len(frame) > self.max_batch_bytes:
+                break
+            self._queue.popleft()
+            batch.append(frame)
+            size += len(frame)
+        self._queued_bytes -= size
+        return batch, size
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+
+                # Linger only while busy; a lone message on a quiet
+                # connection goes out immediately
+                now = time.monotonic()
+                if self.flush_window > 0 and now - self._last_flush < BUSY_INTERVAL:
+                    deadline = now + self.flush_window
+                    while self._queued_bytes < self.max_batch_bytes and not self._closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+
+                batch, size = self._take_batch()
+
+            syscalls = self.stats.syscalls
+            try:
+                if self.compressor is not None:
+                    batch = self.compressor.compress_batch(batch)
+                    size = sum(len(frame) for frame in batch)
+                self._write(batch)
+            except Exception as e:
+                # Not only the socket: a compressor or WebSocket framer that
+                # raises must not end this thread without telling the owner
+                self._fail(e)
+                return
+
+            self._last_flush = time.monotonic()
+            stats = self.stats
+            stats.frames += len(batch)
+            stats.bytes += size
+            stats.batches += 1
+            if self.on_flush is not None:
+                self.on_flush(len(batch), size, stats.syscalls - syscalls)
+
+    def _write(self, buffers):
+        if not self._use_sendmsg:
+            self.sock.sendall(b"".join(buffers))
+            self.stats.syscalls += 1
+            return
+
+        views = [memoryview(b) for b in buffers]
+        index = 0
+        while index < len(views):
+            sent = self.sock.sendmsg(views[index:])
+            self.stats.syscalls += 1
+            # Skip fully written buffers, trim a partially written one
+            while sent:
+                length = len(views[index])
+                if sent >= length:
+                    sent -= length
+                    index += 1
+                else:
+                    views[index] = views[index][sent:]
+                    sent = 0
@@ -1,187 +1,1085 @@
 # import modules
+import logging
+import os
+import random
+import signal
 import socket
 import threading
+import time
+
+from net import (
+    Op,
+    FrameDecoder,
+    ProtocolError,
+    Roster,
+    HeartbeatMonitor,
+    RateLimits,
+    RateLimiter,
+    ThrottleStats,
+    limits_for,
+    CoalescingWriter,
+    SUPPORTED_CODECS,
+    FrameCompressor,
+    FrameDecompressor,
+    negotiate,
+    inflate_frames,
+    ServerMetrics,
+    MetricsServer,
+    encode_frame,
+    decode_body,
+    read_frames,
+    op_name,
+)
+from net.protocol import HEADER_SIZE
+from net.discovery import BeaconSender
+from net.indicators import TypingRelay
+from net.delivery import (
+    GENERAL, RECEIPT_INTERVAL, RoomSequencer, SharedRoomSequencer, RecentMessages, ReceiptBoard,
+    dm_room, dm_members, is_member,
+)
+from net.history import HistoryStore, ResumeTokens, history_batches, history_frame
+from net.persistence import StateStore
+from net.mailbox import OfflineMailbox
+from net.sessions import Session, SessionRegistry
+from net.buffers import BufferPool
+from net.handoff import Acceptor, HandoffServer, take_listener, confirm_takeover
+from net.tls import server_context, accept_tls, is_tls
+from net.local import listen_unix, close_unix, is_local, peer_credentials
+from net.websocket import MessageCache, WebSocketFramer, accept_websocket, close_message
+from net.plugins import INBOUND, OUTBOUND, Message, Pipeline
+from net.bus import BusOp, WorkerBus, create_mesh, close_foreign_links, pack_delivery, unpack_delivery
+from net import federation as fed
+from net.logs import SERVER, TRAFFIC, configure_logging, get_logger, shutdown_logging
 
 HOST = '192.168.0.125'
 PORT = 1234 # you can use any port b/w 0 to 65535
 LISTENER_LIMIT = 5
-active_client = []
-active_client_socket = {} # List of all current users on the server
+PING_INTERVAL = 15.0 # seconds of silence before the server pings a client
+PONG_TIMEOUT = 10.0 # seconds to wait for any reply before evicting it
+RATE_LIMITS = RateLimits() # per-connection token buckets for everyone
+USER_RATE_LIMITS = {} # per-user overrides, e.g. {"bot": RateLimits(messages_per_sec=100)}
+WRITE_FLUSH_WINDOW = 0.002 # max seconds a busy writer waits to batch more frames
+WRITE_BATCH_BYTES = 64 * 1024 # flush as soon as this much is queued
+COMPRESSION_CODECS = SUPPORTED_CODECS # set to () to turn compression off
+COMPRESSION_THRESHOLD = 64 # frames with smaller payloads are sent as is
+RECV_DIR = "received_files"
+RECV_SLAB_SIZE = 16 * 1024 # reads borrow pooled slabs of this size, None reads with plain recv()
+THREAD_STACK_SIZE = 1024 * 1024 # per client thread, two per connection, still deep enough for the recursion limit; None keeps the OS default
+METRICS_HOST = '127.0.0.1' # metrics stay local unless you really mean it
+METRICS_PORT = 9108 # Prometheus scrape port, None turns the endpoint off
+LOG_FILE = "server.log" # rotating JSON lines, None logs to the console only
+VERBOSE_LOGGING = False # DEBUG level for every subsystem
+LOG_NETWORK_TRAFFIC = False # sampled per-frame log, noisy even when sampled
+LOG_SAMPLE_EVERY = 100 # keep one traffic record in this many
+WORKERS = 1 # >1 forks that many processes sharing PORT through SO_REUSEPORT
+FEDERATION_SECRET = None # shared key between linked servers, setting it turns federation on
+FEDERATION_PEERS = [] # servers to link to, e.g. [("10.0.2.10", 1234)]
+SERVER_NAME = None # unique name among linked servers, defaults to HOST:PORT
+DISCOVERY_BEACONS = True # announce this server to clients on the LAN over multicast
+TLS_CERT_FILE = None # PEM certificate chain, setting it makes every client connection TLS
+TLS_KEY_FILE = None # PEM private key, None if it is in TLS_CERT_FILE
+TLS_CLIENT_CA = None # CA file that client certificates must be signed by, None asks for none
+UNIX_SOCKET_PATH = None # also accept clients on this Unix socket, e.g. "/run/proxichat/chat.sock"; same protocol, never TLS
+UNIX_SOCKET_MODE = 0o660 # permissions of the socket file, they decide who on this host may connect
+WS_PORT = None # WebSocket gateway for browsers and scripts on this port, e.g. 8080; wss:// when TLS_CERT_FILE is set
+WS_DEFLATE = True # offer permessage-deflate to WebSocket clients
+WS_ORIGINS = None # Origin headers a browser may connect from, e.g. {"https://chat.example.com"}; None accepts any
+HANDOFF_PATH = None # Unix socket a restarted server takes the listening socket over from, e.g. "/tmp/proxichat.sock"
+DRAIN_WINDOW = 10.0 # on shutdown clients are told to reconnect at random within this many seconds
+DRAIN_TIMEOUT = 5.0 # max seconds to flush outbound queues before closing
+DRAIN_REDIRECT = None # (host, port) clients move to when the server stops without a successor
+MAILBOX_FILE = "mailbox.log" # journal of private messages queued for offline users, None keeps them in memory
+STATE_DIR = "state" # snapshots and log of the message history, reloaded on restart; None keeps it in memory only
+SNAPSHOT_INTERVAL = 60.0 # seconds between incremental snapshots, the log after the last one is replayed on startup
+KEY_REQUEST_USERS = 256 # public keys answered per KEY_REQUEST, see net/e2e.py
+PLUGINS = [] # Plugin instances every chat message passes, in this order; see net/plugins.py
+PLUGIN_WORKERS = 4 # threads for blocking plugins and the ones too slow to run on the routing path
+sessions = SessionRegistry() # every connection, by username, fd and session id
+buffer_pool = None # recv_into slabs shared by all reader threads, see RECV_SLAB_SIZE
+tls_context = None # SSLContext of the listener, created before forking so workers share ticket keys
+ws_messages = MessageCache() # WebSocket forms of recent frames, a broadcast is converted once for every browser
+unix_listener = None # listening Unix socket, see UNIX_SOCKET_PATH; created before forking so workers share it
+draining = False # set while shutting down, no more roster fan-out
+roster = Roster() # Versioned presence, drives snapshot/delta updates
+throttle_stats = ThrottleStats() # how often and how long readers were paused
+bus = None # WorkerBus to the other worker processes, None when single process
+remote_users = {} # username -> worker id, users logged in on other workers
+federation = None # links to other servers, see FEDERATION_SECRET
+typing_relay = TypingRelay() # coalesces typing indicators, nothing is stored
+sequencer = RoomSequencer() # per-room sequence numbers, shared memory with several workers
+recent_messages = RecentMessages() # client message ids already delivered, retries are not resent
+receipts = ReceiptBoard() # delivered/read positions of our users, read ones are fanned out
+history = HistoryStore() # recent numbered messages per room, replayed to resuming clients
+resume_tokens = ResumeTokens() # created before forking, so every worker shares the secret
+mailbox = OfflineMailbox() # private messages for offline users, replaced by the journaled one in main()
+state = None # StateStore of the history, see STATE_DIR
+plugins = None # Pipeline of PLUGINS, None when there are none
+log = get_logger(SERVER)
+traffic = get_logger(TRAFFIC)
+metrics = ServerMetrics(
+    active_connections=lambda: len(sessions),
+    queue_depths=lambda: [w.queued_bytes for w in sessions.writers()],
+    throttle_stats=throttle_stats,
+    compression_stats=lambda: [w.compressor.stats for w in sessions.writers() if isinstance(w.compressor, FrameCompressor)]
+)
 
-#Function to send message to a single client
-def send_message_client(client, message):
+#Function to send an encoded frame to a single client,
+# the frame is queued and written by the client's writer thread
+def send_message_client(client, frame, droppable=False):
+    session = sessions.of(client)
+    if session is not None and session.writer is not None:
+        session.writer.send(frame, droppable)
+        return
+    if droppable:
+        return
     try:
-        client.sendall(message.encode())
+        client.sendall(frame)
     except:
         # Handle case where client is disconnected
         pass
 
-def file_handler(client):
+def writer_failed(username, client, error):
+    """The writer could not deliver, let the reader thread clean up"""
+    metrics.errors.labels("slow_consumer" if isinstance(error, BufferError) else "write").inc()
+    log.warning("write failed", extra={"user": username, "error": str(error)})
     try:
-        client.send("sending_file".encode())
-        file_bytes = b""
-        done = False
-        while not done:
-            message = client.recv(2048)
-            if not message:  # Client disconnected
-                break
-            if file_bytes[-5:] == b"<END>":
-                done = True
-            else:
-                file_bytes += message
-        client.sendall(file_bytes)
-        client.sendall(b"<END>")
-        msg = "file_sent"
-        client.sendall(msg.encode())
-    except:
-        # Handle disconnection during file transfer
+        client.shutdown(socket.SHUT_RDWR)
+    except OSError:
         pass
 
-def remove_client(username, client):
-    """Remove client from active lists"""
-    # Remove from active_client list
-    for i, (user, cli) in enumerate(active_client):
-        if user == username and cli == client:
-            active_client.pop(i)
-            break
-    
-    # Remove from active_client_socket dictionary
-    if username in active_client_socket:
-        del active_client_socket[username]
+def send_system_message(client, text, level="info"):
+    send_message_client(client, encode_frame(Op.SYSTEM, {"text": text, "level": level}))
+
+def send_roster_snapshot(client):
+    """Send the full roster to a single client"""
+    version, users = roster.snapshot()
+    send_message_client(client, encode_frame(Op.ROSTER_SNAPSHOT, {"v": version, "users": users}))
+
+def file_handler(client, username, transfer, op, body):
+    """Handle one file transfer frame, returns the updated transfer state"""
+    try:
+        if op == Op.FILE_BEGIN:
+            os.makedirs(RECV_DIR, exist_ok=True)
+            name = os.path.basename(body.get("name", "file"))
+            path = os.path.join(RECV_DIR, f"{username}_{name}")
+            return {"name": name, "file": open(path, "wb"), "size": 0, "started": time.monotonic()}
+
+        if transfer is None:
+            return None
+
+        if op == Op.FILE_CHUNK:
+            transfer["file"].write(body)
+            transfer["size"] += len(body)
+            metrics.file_bytes.inc(len(body))
+            return transfer
+
+        # FILE_END
+        transfer["file"].close()
+        metrics.file_seconds.observe(time.monotonic() - transfer["started"])
+        send_to_room(Op.FILE_RECEIVED, {"name": transfer["name"], "from": username, "size": transfer["size"]})
+        if federation is not None:
+            federation.publish(fed.FILE, user=username, name=transfer["name"], size=transfer["size"])
+        return None
+    except OSError:
+        # Handle disk errors during file transfer
+        metrics.errors.labels("file").inc()
+        if transfer is not None:
+            transfer["file"].close()
+        send_system_message(client, "File transfer failed on the server", "error")
+        return None
+
+def remove_client(session):
+    """Remove a session from the registry, True if it was the user's last one"""
+    compressor = session.writer.compressor if session.writer is not None else None
+    if not isinstance(compressor, FrameCompressor):
+        compressor = None
+    last = metrics.retire_compression(compressor and compressor.stats, lambda: sessions.remove(session))
+    if compressor is not None:
+        log.info("compression", extra=dict(compressor.stats.as_dict(), user=session.username, codec=compressor.codec))
+
+    # Stop the writer, nothing queued matters anymore
+    if session.writer is not None:
+        session.writer.close(flush=False)
     
     # Close the client socket
     try:
-        client.close()
+        session.sock.close()
     except:
         pass
+    return last
+
+def client_left(session):
+    """Remove client and send the roster delta to everyone else"""
+    username = session.username
+    heartbeats.unwatch(session)
+    if not remove_client(session):
+        # The user resumed on a new connection before this one timed out
+        return
+    typing_relay.forget(username)
+    version = roster.remove(username)
+    if version is not None:
+        if not draining:
+            # While draining everyone here is leaving, nobody needs the delta
+            send_messages_to_all(encode_frame(Op.ROSTER_REMOVE, {"v": version, "user": username}))
+        if bus is not None:
+            bus.publish(BusOp.LEAVE, {"user": username})
+        if federation is not None:
+            federation.publish(fed.LEAVE, user=username)
+
+def send_ping(session):
+    session.writer.send(encode_frame(Op.PING, {"t": time.monotonic()}))
+
+def evict_client(session):
+    """Drop a peer that stopped answering pings"""
+    log.info("client timed out, evicting", extra={"user": session.username})
+    metrics.errors.labels("timeout").inc()
+    try:
+        # Wakes up the recv() blocked in listen_for_messages
+        session.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    client_left(session)
+
+# Idle timers for every client run on one shared timer wheel
+heartbeats = HeartbeatMonitor(send_ping, evict_client, PING_INTERVAL, PONG_TIMEOUT)
 
 # function used to listen any upcoming messages
-def listen_for_messages(client, username):
+def listen_for_messages(session, decoder, pending=None, decompressor=None):
+    client, username = session.sock, session.username
+    transfer = None
+    limiter = RateLimiter(limits_for(username, USER_RATE_LIMITS, RATE_LIMITS), throttle_stats)
+    throttled = False
     while True:
         try:
-            message = client.recv(2048).decode('utf-8')
-            if message == "":  # Client disconnected
-                print(f"Client {username} disconnected")
-                # Notify other clients
-                disconnect_msg = f"{username}~left the chat"
-                send_messages_to_all(disconnect_msg)
-                # Remove client from active lists
-                remove_client(username, client)
+            # Frames that arrived together with HELLO are handled first
+            frames = pending or read_frames(client, decoder, pool=buffer_pool)
+            pending = None
+            if frames is None:  # Client disconnected
+                log.info("client disconnected", extra={"user": username})
+                client_left(session)
                 break
-            elif message == "sending_file":
-                file_handler(client)
-            elif message.startswith("@"):
-                # Private message format: @username: message
-                try:
-                    target_username, private_message = message[1:].split(":", 1)
-                    if target_username in active_client_socket:
-                        active_client_socket[target_username].send(f"Private from {username}~{private_message}".encode())
+            frames = inflate_frames(frames, decompressor)
+
+            heartbeats.touch(session)
+            for op, _, payload in frames:
+                limiter.charge(op, len(payload))
+                metrics.record_frame_in(op, len(payload))
+                if traffic.isEnabledFor(logging.DEBUG):
+                    traffic.debug("frame in", extra={"user": username, "op": op_name(op), "size": len(payload)})
+                body = decode_body(op, payload)
+                if op == Op.CHAT:
+                    typing_relay.forget(username)
+                    if already_accepted(client, username, body.get("id")):
+                        continue
+                    if plugins is not None:
+                        message = plugins.inbound(Message(Op.CHAT, username, None, body.get("text", "")))
+                        if message.refused is not None:
+                            refuse(client, body, GENERAL, message.refused)
+                            continue
+                        body["text"] = message.text
+                    text = body.get("text", "")
+                    seq = send_to_room(Op.CHAT, {"from": username, "text": text}, exclude=client)
+                    accepted(client, username, body.get("id"), GENERAL, seq)
+                    if federation is not None:
+                        federation.publish(fed.CHAT, user=username, text=text)
+                    if plugins is not None:
+                        message.seq = seq
+                        plugins.dispatch(message, INBOUND)
+                elif op == Op.PRIVATE:
+                    # Private message: {"to": username, "text": message, "id": ...}
+                    target_username = body.get("to", "")
+                    typing_relay.forget(username)
+                    if already_accepted(client, username, body.get("id")):
+                        continue
+                    if plugins is not None:
+                        message = plugins.inbound(Message(Op.PRIVATE, username, target_username, body.get("text", "")))
+                        if message.refused is not None:
+                            refuse(client, body, dm_room(username, target_username), message.refused)
+                            continue
+                        body["text"] = message.text
+                    if not reachable(target_username):
+                        queue_private(client, username, target_username, body)
                     else:
-                        client.send(f"User {target_username}~not found.".encode())
-                except ValueError:
-                    client.send("Invalid private message format. Use @username: message".encode())
-            else:
-                final_msg = username + '~' + message
-                send_messages_to_all(final_msg)
+                        room, seq = send_private(username, target_username, body.get("text", ""))
+                        accepted(client, username, body.get("id"), room, seq)
+                        if plugins is not None:
+                            message.seq = seq
+                    if plugins is not None:
+                        plugins.dispatch(message, INBOUND)
+                elif op == Op.TYPING:
+                    relay_typing(client, username, body)
+                elif op == Op.KEY_REQUEST:
+                    send_public_keys(client, body)
+                elif op == Op.SENDER_KEY:
+                    relay_sender_key(username, body)
+                elif op == Op.ACK:
+                    record_acks(username, body)
+                elif op in (Op.FILE_BEGIN, Op.FILE_CHUNK, Op.FILE_END):
+                    transfer = file_handler(client, username, transfer, op, body)
+                elif op == Op.ROSTER_SYNC:
+                    # Client noticed a gap in roster versions
+                    send_roster_snapshot(client)
+                elif op == Op.PING:
+                    send_message_client(client, encode_frame(Op.PONG, body))
+                elif op == Op.DISCONNECT:
+                    raise ConnectionResetError
+
+            # Over the limit: stop reading this socket for a while and let
+            # TCP push back on the sender instead of dropping it
+            delay = limiter.pending()
+            if delay and not throttled:
+                # Tell the client once per throttling episode
+                send_message_client(client, encode_frame(Op.THROTTLE, {"wait": round(delay, 3)}))
+            throttled = bool(limiter.wait())
         except ConnectionResetError:
             # Client forcibly closed connection
-            print(f"Client {username} forcibly disconnected")
-            disconnect_msg = f"{username}~left the chat"
-            send_messages_to_all(disconnect_msg)
-            remove_client(username, client)
+            log.info("client forcibly disconnected", extra={"user": username})
+            client_left(session)
             break
         except Exception as e:
-            # Handle other exceptions
-            print(f"Error with client {username}: {e}")
-            disconnect_msg = f"{username}~left the chat"
-            send_messages_to_all(disconnect_msg)
-            remove_client(username, client)
+            # Handle other exceptions, including malformed frames
+            log.warning("client error", extra={"user": username, "error": str(e)})
+            metrics.errors.labels("protocol" if isinstance(e, ProtocolError) else "read").inc()
+            client_left(session)
             break
+    if transfer is not None:
+        transfer["file"].close()
+
+def already_accepted(client, username, message_id):
+    """A retried message: confirm it again instead of delivering it twice"""
+    if message_id is None:
+        return False
+    known = recent_messages.lookup(username, message_id)
+    if known is None:
+        return False
+    send_message_client(client, encode_frame(Op.ACCEPTED, {"id": message_id, "room": known[0], "seq": known[1]}))
+    return True
 
-#Function to send any message to all clients that
+def accepted(client, username, message_id, room, seq):
+    """Tell the sender which sequence number its message got"""
+    confirmation = {"room": room, "seq": seq}
+    if message_id is not None:
+        recent_messages.remember(username, message_id, room, seq)
+        confirmation["id"] = message_id
+    send_message_client(client, encode_frame(Op.ACCEPTED, confirmation))
+
+def confirm_refused(client, body, room):
+    """Confirm a message that will not be delivered, so the client drops
+    it from its outbox instead of sending it again on every reconnect"""
+    confirmation = {"room": room, "seq": None, "refused": True}
+    if body.get("id") is not None:
+        confirmation["id"] = body["id"]
+    send_message_client(client, encode_frame(Op.ACCEPTED, confirmation))
+
+def refuse(client, body, room, reason):
+    """A plugin dropped the message: say why, and confirm it"""
+    send_system_message(client, f"Message not sent: {reason}.", "warning")
+    confirm_refused(client, body, room)
+
+def reachable(username):
+    """Whether a private message to username can be delivered right now"""
+    return (username in sessions or username in remote_users
+            or (federation is not None and federation.locate(username) is not None))
+
+def deliver_to(username, frame):
+    """Queue a frame for one user on this server, whichever worker has them"""
+    target = sessions.by_username(username)
+    if target is not None:
+        target.writer.send(frame)
+        return True
+    worker = remote_users.get(username)
+    if worker is not None:
+        return bus.send_to(worker, BusOp.DELIVER, pack_delivery(username, frame))
+    return False
+
+def send_public_keys(client, body):
+    """Answer KEY_REQUEST from the key directory kept with the mailbox"""
+    users = [user for user in (body.get("users") or [])[:KEY_REQUEST_USERS] if isinstance(user, str)]
+    send_message_client(client, encode_frame(Op.KEYS, {"keys": {user: mailbox.key_of(user) for user in users}}))
+
+def relay_sender_key(username, body):
+    """Pass a sealed sender key, or a request for one, on to its recipient;
+    if they are offline it is dropped, they ask again when they need it"""
+    relayed = {"from": username}
+    for field in ("box", "want"):
+        if isinstance(body.get(field), str):
+            relayed[field] = body[field]
+    deliver_to(body.get("to", ""), encode_frame(Op.SENDER_KEY, relayed))
+
+def send_to_room(op, body, exclude=None, plugin=None):
+    """Number a message of the general room, keep it in the history and fan it out;
+    messages a plugin posts (plugin is its name) skip the plugins"""
+    message = None
+    if plugins is not None and op == Op.CHAT and plugin is None:
+        message = plugins.outbound(Message(op, body["from"], None, body.get("text", "")))
+        body["text"] = message.text
+    def deliver(seq):
+        body["seq"] = seq
+        frame = encode_frame(op, body)
+        history.append(GENERAL, seq, op, frame[HEADER_SIZE:])
+        broadcast(frame, exclude)
+    seq = sequencer.assign(GENERAL, deliver)
+    if message is not None:
+        message.seq = seq
+        plugins.dispatch(message, OUTBOUND)
+    return seq
+
+def send_private(username, target_username, text):
+    """Number a private message, keep it and deliver it, returns (room, seq)"""
+    room = dm_room(username, target_username)
+    message = None
+    if plugins is not None:
+        message = plugins.outbound(Message(Op.PRIVATE, username, target_username, text))
+        text = message.text
+    def deliver(seq):
+        frame = encode_frame(Op.PRIVATE, {"from": username, "text": text, "seq": seq})
+        history.append(room, seq, Op.PRIVATE, frame[HEADER_SIZE:])
+        if bus is not None:
+            # Every worker keeps it, the user may resume on any of them
+            bus.publish(BusOp.RECORD, pack_delivery(target_username, frame))
+        if not deliver_to(target_username, frame) and federation is not None:
+            # The other server numbers it in its own sequence
+            federation.send_direct(target_username, user=username, text=text)
+    seq = sequencer.assign(room, deliver)
+    if message is not None:
+        message.seq = seq
+        plugins.dispatch(message, OUTBOUND)
+    return room, seq
+
+def queue_private(client, username, target_username, body):
+    """The recipient is offline, keep the message for their next login"""
+    room = dm_room(username, target_username)
+    if not mailbox.knows(target_username):
+        confirm_refused(client, body, room)
+        send_system_message(client, f"User {target_username} not found.", "warning")
+        return
+    refused = mailbox.put(username, target_username, body.get("text", ""), body.get("id"))
+    if refused is not None:
+        confirm_refused(client, body, room)
+        send_system_message(client, f"Message to {target_username} not queued: {refused}.", "warning")
+        return
+    confirmation = {"room": room, "seq": None, "queued": True}
+    if body.get("id") is not None:
+        confirmation["id"] = body["id"]
+    send_message_client(client, encode_frame(Op.ACCEPTED, confirmation))
+
+def deliver_mailbox(username):
+    """Send a user who just logged in everything queued for them,
+    the mailbox is emptied with one journal write"""
+    for message in mailbox.take(username):
+        room, seq = send_private(message.sender, username, message.text)
+        # The sender learns the number its message finally got
+        confirmation = {"room": room, "seq": seq}
+        if message.id is not None:
+            confirmation["id"] = message.id
+        deliver_to(message.sender, encode_frame(Op.ACCEPTED, confirmation))
+
+def replay(client, room, last):
+    """Send a resuming client the messages of room after last"""
+    start, items = history.since(room, last)
+    if not items and sequencer.current(room) > start:
+        # Nothing retained, move the client's window to the present
+        start = sequencer.current(room)
+    if start == last and not items:
+        return
+    batches = list(history_batches(items)) or [[]]
+    for i, batch in enumerate(batches):
+        send_message_client(client, history_frame(room, batch, start if i == 0 and start != last else None))
+
+def send_roster_changes(client, changes):
+    """Roster deltas a resuming client missed, instead of a snapshot"""
+    for version, added, user in changes:
+        send_message_client(client, encode_frame(Op.ROSTER_ADD if added else Op.ROSTER_REMOVE, {"v": version, "user": user}))
+
+def record_acks(username, body):
+    """Cumulative positions from a client, one entry per room"""
+    for room, seq in (body.get("recv") or {}).items():
+        if is_member(username, room):
+            receipts.delivered(username, room, int(seq))
+    for room, seq in (body.get("read") or {}).items():
+        if is_member(username, room):
+            receipts.read(username, room, int(seq))
+
+def flush_receipts():
+    """Fan out the read positions that moved, one frame per room"""
+    try:
+        for room, positions in receipts.take_changes().items():
+            frame = encode_frame(Op.RECEIPTS, {"room": room, "read": positions})
+            members = dm_members(room)
+            if members is None:
+                broadcast(frame)
+            else:
+                for member in members:
+                    deliver_to(member, frame)
+    finally:
+        heartbeats.wheel.schedule("receipts", RECEIPT_INTERVAL, flush_receipts)
+
+def relay_typing(client, username, body):
+    """Pass a typing indicator on to the room or the DM peer only"""
+    on = bool(body.get("on"))
+    to = body.get("to") or None
+    if not typing_relay.should_forward(username, on, to):
+        return
+    indicator = {"from": username, "on": on}
+    if to:
+        indicator["to"] = to
+    frame = encode_frame(Op.TYPING, indicator)
+    if to is None:
+        send_messages_to_all(frame, exclude=client, droppable=True)
+        if bus is not None:
+            bus.publish(BusOp.FORWARD, frame)
+        return
+    # One lookup each, the peer may leave at any moment
+    target = sessions.by_username(to)
+    if target is not None:
+        target.writer.send(frame, droppable=True)
+        return
+    worker = remote_users.get(to)
+    if worker is not None:
+        bus.send_to(worker, BusOp.DELIVER, pack_delivery(to, frame))
+
+# Plugin actions, called from the routing path, the plugin pool and the plugin loop
+def plugin_say(name, text):
+    """A plugin posts to the room; other servers do not get it, their
+    plugins answer their own users"""
+    send_to_room(Op.CHAT, {"from": name, "text": text}, plugin=name)
+
+def plugin_tell(username, text, level):
+    """A plugin answers one user, on whichever worker they are"""
+    deliver_to(username, encode_frame(Op.SYSTEM, {"text": text, "level": level}))
+
+#Function to send an encoded frame to every client of the chat,
+# including the ones connected to other worker processes
+def broadcast(frame, exclude=None):
+    send_messages_to_all(frame, exclude)
+    if bus is not None:
+        bus.publish(BusOp.FORWARD, frame)
+
+#Function to send an encoded frame to all clients that
 # are currently connected to this server
-def send_messages_to_all(message):
-    # Create a copy of the list to avoid modification during iteration
-    clients_copy = active_client.copy()
-    for user in clients_copy:
-        try:
-            send_message_client(user[1], message)
-        except:
-            # If sending fails, remove the client
-            remove_client(user[0], user[1])
+def send_messages_to_all(frame, exclude=None, droppable=False):
+    # The snapshot is immutable, joins and leaves do not disturb the loop
+    with metrics.fanout_seconds.time():
+        for session in sessions.snapshot():
+            if session.sock is exclude:
+                continue
+            # Only queues the frame; write errors are reported by the writer
+            session.writer.send(frame, droppable)
 
 #function to handle client
-def client_handler(client):
-    # Server will listen for client message that
+def hello_rejected(hello):
+    """What is wrong with a client's HELLO body, None if it can be used as is"""
+    if not isinstance(hello, dict):
+        return "not an object"
+    username = hello.get("username")
+    if not isinstance(username, str) or not username:
+        return "bad username"
+    caps = hello.get("caps")
+    if caps is not None and not (isinstance(caps, list) and all(isinstance(cap, str) for cap in caps)):
+        return "bad caps"
+    resume = hello.get("resume") or {}
+    if not isinstance(resume, dict):
+        return "bad resume"
+    last_seen = resume.get("seq") or {}
+    if not isinstance(last_seen, dict) or not all(type(seq) is int for seq in last_seen.values()):
+        return "bad resume seq"
+    position = resume.get("roster")
+    if position is not None and not (isinstance(position, list) and len(position) == 2 and type(position[1]) is int):
+        return "bad resume roster"
+    return None
+
+def client_handler(client, websocket=False):
+    # The handshake runs here, a slow client must not stall accept()
+    if tls_context is not None and not is_local(client):
+        try:
+            client = accept_tls(tls_context, client)
+        except OSError as e:
+            log.warning("TLS handshake failed", extra={"error": str(e)})
+            client.close()
+            return
+
+    # A client of the WebSocket port upgrades first, from then on its
+    # messages are decoded into native frames and it is a client like any other
+    ws = None
+    if websocket:
+        try:
+            ws = accept_websocket(client, ws_messages, WS_DEFLATE, WS_ORIGINS)
+        except (OSError, ProtocolError) as e:
+            log.info("websocket upgrade failed", extra={"error": str(e)})
+            client.close()
+            return
+        ws.decoder.reply = client.sendall
+
+    # Server will wait for the HELLO frame that
     # will contain username
     username = None
+    hello = {}
+    decoder = ws.decoder if ws is not None else FrameDecoder()
+    early = ws.early if ws is not None else None
+    pending = None
     try:
-        while True:
-            # recv is used to listen message from client
-            # 2048 specifies the length of message
-            # utf-8 is the encoding used
-            username = client.recv(2048).decode('utf-8')
-            if username != "":
-                active_client.append((username, client))
-                active_client_socket[username] = client
-
-                  # --- ADD THE NEW LOGIC HERE ---
-                # 1. Get the list of all current usernames
-                current_users = [user for user, _ in active_client]
-                
-                # 2. Format the list into a string
-                active_users_list_str = "active_users:" + ",".join(current_users)
-                
-                # 3. Send the list to the new client only
-                send_message_client(client, active_users_list_str)
-
-                prompt_message = f"{username}~joined the chat"
-                send_messages_to_all(prompt_message)
-                break
-            else:
-                print("Client Username is empty")
-    except:
-        print("Error receiving username from client")
+        while username is None:
+            frames = early or read_frames(client, decoder, pool=buffer_pool)
+            early = None
+            if frames is None:
+                client.close()
+                return
+            for i, (op, _, payload) in enumerate(frames):
+                if op == Op.PEER_HELLO:
+                    # Another server linking to us, not a chat client
+                    if federation is None or ws is not None:
+                        client.close()
+                    else:
+                        federation.accept(client, decode_body(op, payload), decoder, frames[i + 1:])
+                    return
+                if op == Op.HELLO:
+                    hello = decode_body(op, payload)
+                    reason = hello_rejected(hello)
+                    if reason is not None:
+                        # Checked before the session exists, nothing to undo
+                        log.warning("client hello rejected", extra={"reason": reason})
+                        client.close()
+                        return
+                    username = hello["username"]
+                    pending = frames[i + 1:]
+                    break
+    except (OSError, ProtocolError):
+        log.warning("error receiving username from client")
         client.close()
         return
-    
+
+    # Public key for end-to-end encryption, a client without one gets plain text
+    public_key = hello.get("pk") if isinstance(hello.get("pk"), str) else None
+
+    # Pick a compression codec both sides support, WebSocket clients
+    # have permessage-deflate instead
+    codec = negotiate(hello.get("caps"), COMPRESSION_CODECS) if ws is None else None
+    compressor = FrameCompressor(codec, COMPRESSION_THRESHOLD) if codec else None
+    decompressor = FrameDecompressor(codec) if codec else None
+    if ws is not None:
+        compressor = ws.framer
+
+    session = Session(username, client, codec=codec)
+    session.writer = CoalescingWriter(
+        client, WRITE_FLUSH_WINDOW, WRITE_BATCH_BYTES,
+        on_error=lambda error: writer_failed(username, client, error),
+        name=f"writer-{username}",
+        compressor=compressor,
+        on_flush=metrics.record_flush
+    )
+    sessions.add(session)
+    if ws is not None:
+        # Pong and close replies queue behind what the writer is sending
+        ws.decoder.reply = session.writer.send
+    # A reconnecting client proves it had a session and says what it has
+    resume = hello.get("resume") or {}
+    resumed = session.resumed = resume_tokens.verify(resume.get("token"), username)
+    last_seen = (resume.get("seq") or {}) if resumed else {}
+    welcome = {"codec": codec, "token": resume_tokens.issue(username), "roster": roster.id, "resumed": resumed}
+    if not resumed:
+        welcome["seq"] = {room: sequencer.current(room) for room in history.rooms_of(username)}
+
+    previous = None
+
+    def register(seq):
+        nonlocal previous
+        # Under the room lock, so the client gets every message after seq
+        if resumed:
+            send_message_client(client, encode_frame(Op.WELCOME, welcome))
+            replay(client, GENERAL, last_seen.get(GENERAL, 0))
+        else:
+            welcome["seq"][GENERAL] = seq
+            send_message_client(client, encode_frame(Op.WELCOME, welcome))
+        previous = sessions.join(session)
+    sequencer.enter(GENERAL, register)
+    metrics.connections.inc()
+    log.info("client joined", extra={
+        "user": username, "codec": codec, "resumed": resumed, "session": session.id,
+        "tls": is_tls(client), "tls_resumed": is_tls(client) and client.session_reused,
+        "local": is_local(client), "websocket": ws.subprotocol if ws is not None else None})
+    heartbeats.watch(session)
+    if resumed:
+        for room in history.rooms_of(username)[1:]:
+            replay(client, room, last_seen.get(room, 0))
+        if previous is not None:
+            # The old connection is dead, it just has not timed out yet
+            try:
+                previous.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    # Known with its key before anyone hears of the join and asks for it
+    mailbox.remember(username, public_key)
+
+    # The new client gets the full roster once, or only what changed
+    # since its last session, everyone else only gets the delta for this join
+    version = roster.add(username)
+    changes = None
+    if resumed and resume.get("roster") and resume["roster"][0] == roster.id:
+        changes = roster.changes_since(resume["roster"][1])
+    if changes is None:
+        send_roster_snapshot(client)
+    else:
+        send_roster_changes(client, changes)
+    if version is not None:
+        send_messages_to_all(encode_frame(Op.ROSTER_ADD, {"v": version, "user": username}), exclude=client)
+    if bus is not None:
+        bus.publish(BusOp.JOIN, {"user": username, "pk": public_key})
+    if federation is not None:
+        federation.publish(fed.JOIN, user=username)
+    deliver_mailbox(username)
+
     # Start listening for messages from this client
-    threading.Thread(target=listen_for_messages, args=(client, username)).start()
-
-def main():
-    #Creating the socket class object
-    # AF_INET = we are using IPV4,
-    #SOCK_STREAM = using TCP protocol
-    # if you want to use UDP use SOCK_DGRAM
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
-    # Allow socket reuse
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
-    # Creating try catch block
-    try:
-        server.bind((HOST, PORT))  # passing socket (socket = ip+port)
-        print(f"Running the server on {HOST} {PORT}")
-    except:
-        print(f"Unable to bind to host {HOST} and port {PORT}")
+    threading.Thread(target=listen_for_messages, args=(session, decoder, pending, decompressor)).start()
+    if draining:
+        # Joined while the server was draining, send it along too
+        send_message_client(client, encode_frame(Op.RECONNECT, {"after": round(random.uniform(0, DRAIN_WINDOW), 3)}))
+        session.writer.close()
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def drain(redirect=None):
+    """Move every client off this process without a reconnect storm:
+    each one is told to come back after its own random delay, then its
+    queue is flushed and the connection closed"""
+    global draining
+    draining = True
+    target = {} if redirect is None else {"host": redirect[0], "port": redirect[1]}
+    leaving = sessions.all()
+    log.info("draining", extra={"clients": len(leaving), "window": DRAIN_WINDOW, "redirect": redirect})
+    for session in leaving:
+        hint = dict(target, after=round(random.uniform(0, DRAIN_WINDOW), 3))
+        session.writer.send(encode_frame(Op.RECONNECT, hint))
+        if isinstance(session.writer.compressor, WebSocketFramer):
+            session.writer.send(close_message())
+        session.writer.close(timeout=0)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    for session in leaving:
+        session.writer.join(max(0.0, deadline - time.monotonic()))
+        try:
+            session.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+# Bus handlers, run on the bus reader thread of the sending worker's link
+def remote_joined(worker, username, public_key=None):
+    remote_users[username] = worker
+    mailbox.remember(username, public_key)
+    version = roster.add(username)
+    if version is not None:
+        send_messages_to_all(encode_frame(Op.ROSTER_ADD, {"v": version, "user": username}))
+    # Messages queued on this worker while they were away
+    deliver_mailbox(username)
+
+def remote_left(worker, username):
+    if remote_users.get(username) != worker:
         return
+    del remote_users[username]
+    version = roster.remove(username)
+    if version is not None:
+        send_messages_to_all(encode_frame(Op.ROSTER_REMOVE, {"v": version, "user": username}))
+
+def bus_frame(worker, op, payload):
+    """Handle one frame from another worker"""
+    if op == BusOp.FORWARD:
+        if payload[0] in (Op.CHAT, Op.FILE_RECEIVED):
+            record(GENERAL, payload)
+        send_messages_to_all(payload, droppable=payload[0] == Op.TYPING)
+    elif op == BusOp.RECORD:
+        target_username, frame = unpack_delivery(payload)
+        record(target_username, frame)
+    elif op == BusOp.DELIVER:
+        target_username, frame = unpack_delivery(payload)
+        target = sessions.by_username(target_username)
+        if target is not None:
+            target.writer.send(frame, droppable=frame[0] == Op.TYPING)
+    elif op == BusOp.JOIN:
+        joined = decode_body(op, payload)
+        remote_joined(worker, joined["user"], joined.get("pk"))
+    elif op == BusOp.LEAVE:
+        remote_left(worker, decode_body(op, payload)["user"])
+
+def record(target, frame):
+    """Keep a message numbered by another worker in our history too,
+    target is the room, or the recipient of a private message"""
+    body = decode_body(frame[0], frame[HEADER_SIZE:])
+    room = target if frame[0] != Op.PRIVATE else dm_room(body["from"], target)
+    history.append(room, body["seq"], frame[0], frame[HEADER_SIZE:])
+
+# Federation handler, runs on the reader thread of the peer link
+def federated_event(event):
+    """Deliver an event replicated from another server"""
+    kind = event["t"]
+    # Replicated messages are numbered in this server's own sequence
+    if kind == fed.CHAT:
+        send_to_room(Op.CHAT, {"from": event["user"], "text": event["text"]})
+    elif kind == fed.FILE:
+        send_to_room(Op.FILE_RECEIVED, {"name": event["name"], "from": event["user"], "size": event["size"]})
+    elif kind == fed.DM:
+        if event["to"] in sessions:
+            send_private(event["user"], event["to"], event["text"])
+    elif kind == fed.JOIN:
+        version = roster.add(event["user"])
+        if version is not None:
+            send_messages_to_all(encode_frame(Op.ROSTER_ADD, {"v": version, "user": event["user"]}))
+    elif kind == fed.LEAVE:
+        if event["user"] in sessions:
+            return
+        version = roster.remove(event["user"])
+        if version is not None:
+            send_messages_to_all(encode_frame(Op.ROSTER_REMOVE, {"v": version, "user": event["user"]}))
+
+def bus_peer_lost(worker):
+    """A worker died, everyone logged in there is gone too"""
+    for username, owner in list(remote_users.items()):
+        if owner == worker:
+            remote_left(worker, username)
+
+def load_state():
+    """Restore the history of the last run, before serving or forking"""
+    global state, resume_tokens
+    state = StateStore(STATE_DIR, history, sequencer, SNAPSHOT_INTERVAL)
+    state.load()
+    # Tokens issued before the restart stay valid
+    secret = state.meta.get("resume_secret")
+    if secret:
+        resume_tokens = ResumeTokens(bytes.fromhex(secret))
+    else:
+        state.meta["resume_secret"] = resume_tokens.secret.hex()
+
+def main(worker_id=None, links=None):
+    global bus, federation, plugins, mailbox, buffer_pool, tls_context, unix_listener, LOG_FILE, METRICS_PORT, MAILBOX_FILE
+    if worker_id is not None:
+        # Each worker gets its own log file, mailbox journal and metrics port
+        if LOG_FILE:
+            root, ext = os.path.splitext(LOG_FILE)
+            LOG_FILE = f"{root}.w{worker_id}{ext}"
+        if MAILBOX_FILE:
+            root, ext = os.path.splitext(MAILBOX_FILE)
+            MAILBOX_FILE = f"{root}.w{worker_id}{ext}"
+        if METRICS_PORT is not None:
+            METRICS_PORT += worker_id
+
+    # Logging runs on its own thread so client threads never block on stdout
+    configure_logging(LOG_FILE, VERBOSE_LOGGING, LOG_NETWORK_TRAFFIC, sample_every=LOG_SAMPLE_EVERY)
+    if STATE_DIR and state is None:
+        load_state()
+    if state is not None:
+        log.info("state loaded", extra=state.stats)
+        if not worker_id:
+            # Every worker has the whole history, one of them writes it
+            history.journal = state.record
+            state.start()
+    if MAILBOX_FILE:
+        mailbox = OfflineMailbox(MAILBOX_FILE)
+    if TLS_CERT_FILE and tls_context is None:
+        tls_context = server_context(TLS_CERT_FILE, TLS_KEY_FILE, TLS_CLIENT_CA)
+    if RECV_SLAB_SIZE:
+        buffer_pool = BufferPool(RECV_SLAB_SIZE)
+    if THREAD_STACK_SIZE:
+        # Client threads only run short, shallow handlers
+        threading.stack_size(THREAD_STACK_SIZE)
+
+    # A running server may hand over its listening socket, then nothing
+    # waiting in its backlog is lost and no connect is refused
+    handoff_path = None
+    if HANDOFF_PATH:
+        handoff_path = HANDOFF_PATH if worker_id is None else f"{HANDOFF_PATH}.w{worker_id}"
+    takeover = take_listener(handoff_path) if handoff_path else None
+    if takeover is not None:
+        server, _, channel = takeover
+        log.info("took over the listening socket", extra={"host": HOST, "port": PORT, "worker": worker_id})
+    else:
+        #Creating the socket class object
+        # AF_INET = we are using IPV4,
+        #SOCK_STREAM = using TCP protocol
+        # if you want to use UDP use SOCK_DGRAM
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Allow socket reuse
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if worker_id is not None:
+            # Every worker binds the same port, the kernel balances accepts
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # Creating try catch block
+        try:
+            server.bind((HOST, PORT))  # passing socket (socket = ip+port)
+            log.info("server running", extra={"host": HOST, "port": PORT, "worker": worker_id})
+        except:
+            log.error("unable to bind", extra={"host": HOST, "port": PORT})
+            shutdown_logging()
+            return
+
+        # SET SERVER LIMIT
+        server.listen(LISTENER_LIMIT)
+    if UNIX_SOCKET_PATH and unix_listener is None:
+        # Renamed over the path, a predecessor's clients move to us from now on
+        unix_listener = open_unix_listener()
+    ws_listener = open_ws_listener(worker_id) if WS_PORT is not None else None
+    heartbeats.start()
+    heartbeats.wheel.schedule("receipts", RECEIPT_INTERVAL, flush_receipts)
+    if links:
+        bus = WorkerBus(worker_id, links, bus_frame, bus_peer_lost)
+        bus.start()
+    if DISCOVERY_BEACONS and not worker_id:
+        # One beacon per server, worker 0 speaks for all of them,
+        # load counts the clients of every worker
+        load = lambda: len(sessions) + len(remote_users)
+        BeaconSender(SERVER_NAME or f"{HOST}:{PORT}", PORT, load, HOST).start()
+    if FEDERATION_SECRET:
+        if worker_id is not None:
+            log.warning("federation needs WORKERS = 1, not linking this server")
+        else:
+            federation = fed.Federation(
+                SERVER_NAME or f"{HOST}:{PORT}", federated_event,
+                sessions.usernames, FEDERATION_SECRET, COMPRESSION_CODECS
+            )
+            for peer_host, peer_port in FEDERATION_PEERS:
+                federation.connect(peer_host, peer_port)
+    if PLUGINS:
+        # Started after forking, every worker has its own pool and loop
+        plugins = Pipeline(PLUGINS, plugin_say, plugin_tell, PLUGIN_WORKERS)
+        metrics.watch_plugins(plugins.stats)
+        log.info("plugins loaded", extra={"plugins": list(plugins.stats())})
+    if METRICS_PORT is not None:
+        try:
+            MetricsServer(metrics.registry, METRICS_HOST, METRICS_PORT).start()
+            log.info("metrics endpoint up", extra={"url": f"http://{METRICS_HOST}:{METRICS_PORT}/metrics"})
+        except OSError as e:
+            log.error("unable to start metrics endpoint", extra={"error": str(e)})
     
-    # SET SERVER LIMIT
-    server.listen(LISTENER_LIMIT)
-    
+    if unix_listener is not None:
+        log.info("listening on unix socket", extra={"path": UNIX_SOCKET_PATH, "worker": worker_id})
+    acceptor = Acceptor(server, *[listener for listener in (unix_listener, ws_listener) if listener is not None])
+    handoff = None
+    if handoff_path:
+        handoff = HandoffServer(handoff_path, acceptor, {"host": HOST, "port": PORT, "worker": worker_id})
+        handoff.start()
+    if takeover is not None:
+        # We accept on it from here on, the old server can drain now
+        confirm_takeover(channel)
+    # Ctrl-C and SIGTERM drain the clients instead of dropping them
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: acceptor.stop())
+
     # Listening to client connection
     while True:
         try:
-            client, address = server.accept()
-            # address is tuple where 0th item = host_ip
-            # 1st item = port
-            print(f"Connected to Client {address[0]}:{address[1]}")
-            threading.Thread(target=client_handler, args=(client,)).start()
-        except KeyboardInterrupt:
-            print("Server shutting down...")
-            break
+            accepted = acceptor.accept()
+            if accepted is None:
+                break
+            client, address = accepted
+            websocket = ws_listener is not None and not is_local(client) and client.getsockname()[1] == WS_PORT
+            if is_local(client):
+                # Same host, the kernel tells us which process it is
+                pid, uid, _ = peer_credentials(client) or (None, None, None)
+                log.info("connection accepted", extra={"unix": UNIX_SOCKET_PATH, "pid": pid, "uid": uid})
+            else:
+                # address is tuple where 0th item = host_ip
+                # 1st item = port
+                log.info("connection accepted", extra={"addr": f"{address[0]}:{address[1]}"})
+            threading.Thread(target=client_handler, args=(client, websocket)).start()
         except Exception as e:
-            print(f"Error accepting connection: {e}")
+            log.error("error accepting connection", extra={"error": str(e)})
+
+    # Stopped, either handed to a successor or asked to shut down
+    handed_off = handoff is not None and handoff.handed_off
+    acceptor.close()
+    server.close()
+    if unix_listener is not None:
+        close_unix(unix_listener, UNIX_SOCKET_PATH)
+    if ws_listener is not None:
+        ws_listener.close()
+    if handoff is not None:
+        handoff.close()
+    # After a handoff clients come back to the same address, the successor
+    drain(None if handed_off else DRAIN_REDIRECT)
+    if plugins is not None:
+        plugins.close()
+    if state is not None and not worker_id:
+        # A successor has loaded the state already and writes from here on
+        state.close(snapshot=not handed_off)
+    log.info("server shutting down", extra={"handed_off": handed_off})
+    shutdown_logging()
+
+def open_ws_listener(worker_id):
+    """Listen on WS_PORT, None if that fails (native clients are still served)"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # Shared by the workers, and by a successor while we drain
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        listener.bind((HOST, WS_PORT))
+    except OSError as e:
+        log.error("unable to bind websocket port", extra={"host": HOST, "port": WS_PORT, "error": str(e)})
+        listener.close()
+        return None
+    listener.listen(LISTENER_LIMIT)
+    log.info("websocket gateway running", extra={"host": HOST, "port": WS_PORT, "worker": worker_id})
+    return listener
+
+def open_unix_listener():
+    """Listen on UNIX_SOCKET_PATH, None if that fails (TCP clients are still served)"""
+    try:
+        listener = listen_unix(UNIX_SOCKET_PATH, UNIX_SOCKET_MODE, LISTENER_LIMIT)
+    except OSError as e:
+        log.error("unable to bind unix socket", extra={"path": UNIX_SOCKET_PATH, "error": str(e)})
+        return None
+    return listener
+
+def run_workers(count=None):
+    """Fork `count` workers sharing the port and wait for them"""
+    global sequencer, tls_context, unix_listener
+    count = count or WORKERS
+    if count < 2 or not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        main()
+        return
+
+    # The mesh and the shared sequence counters have to exist
+    # before forking so every worker inherits them
+    sequencer = SharedRoomSequencer()
+    if TLS_CERT_FILE:
+        # One set of ticket keys, a session resumes on whichever worker the kernel picks
+        tls_context = server_context(TLS_CERT_FILE, TLS_KEY_FILE, TLS_CLIENT_CA)
+    if STATE_DIR:
+        load_state()
+    if UNIX_SOCKET_PATH:
+        # There is no SO_REUSEPORT for Unix sockets, the workers accept on one
+        unix_listener = open_unix_listener()
+    mesh = create_mesh(count)
+    children = []
+    for worker_id in range(count):
+        pid = os.fork()
+        if pid == 0:
+            close_foreign_links(mesh, worker_id)
+            try:
+                main(worker_id, mesh[worker_id])
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    # The supervisor keeps no sockets of its own
+    for links in mesh:
+        for sock in links.values():
+            sock.close()
+    if unix_listener is not None:
+        # Only closed, the path stays until the last worker is done
+        unix_listener.close()
+    def stop_workers(signum, frame):
+        # Every worker drains its own clients
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    for pid in children:
+        os.waitpid(pid, 0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_workers()
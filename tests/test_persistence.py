@@ -0,0 +1,236 @@
+"""
+StateStore: the snapshot block format, the log's crash recovery, loading
+a chain of delta snapshots, and catching up after a handoff.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from net.delivery import RoomSequencer, dm_room  # noqa: E402
+from net.history import GENERAL, HistoryStore  # noqa: E402
+from net.persistence import RoomBlock, StateStore, encode_record, encode_room, read_records  # noqa: E402
+
+DM = dm_room("alice", "bob")
+
+
+def open_store(directory, **kwargs):
+    history, sequencer = HistoryStore(), RoomSequencer()
+    kwargs.setdefault("flush_interval", 0.01)
+    store = StateStore(str(directory), history, sequencer, **kwargs)
+    return store, history, sequencer
+
+
+def start(store, history, wait=True):
+    """Start the writer, by default wait until it holds the directory
+    and its first full snapshot is written"""
+    history.journal = store.record
+    store.start()
+    if wait:
+        wait_for(lambda: store._log is not None and any(full for _, full in store._snapshots()))
+
+
+def post(history, room, first, last, op=11):
+    for seq in range(first, last + 1):
+        history.append(room, seq, op, f"{room} {seq}".encode())
+
+
+def contents(history, room):
+    _, items = history.since(room, 0)
+    return [bytes(payload) for _, payload in items]
+
+
+def expected(room, last):
+    return [f"{room} {seq}".encode() for seq in range(1, last + 1)]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+# -- formats ----------------------------------------------------------------
+
+
+def test_room_block_round_trip():
+    seqs = [1, 2, 7, 2**40]
+    items = [(11, b"hello"), (12, b""), (11, "héllo".encode()), (30, bytes(range(256)) * 40)]
+    data = b"padding" + encode_room(seqs, items)
+    block = RoomBlock(data, 7, len(data) - 7, len(seqs), seqs[-1])
+    assert block.decode() == (seqs, items)
+    assert bytes(block.raw()) == data[7:]
+
+
+def test_empty_room_block():
+    block = RoomBlock(encode_room([], []), 0, 0, 0, 0)
+    assert block.decode() == ([], [])
+
+
+def test_read_records_whole_log():
+    records = [(GENERAL, 1, 11, b"a"), (DM, 1, 12, b""), (GENERAL, 2, 11, b"c" * 1000)]
+    data = b"".join(encode_record(*record) for record in records)
+    read = list(read_records(data))
+    assert [entry[:4] for entry in read] == records
+    assert read[-1][4] == len(data)
+    # Picking up where an earlier read stopped
+    assert [entry[:4] for entry in read_records(data, read[0][4])] == records[1:]
+
+
+def test_read_records_stops_at_torn_write():
+    first, second = encode_record(GENERAL, 1, 11, b"kept"), encode_record(GENERAL, 2, 11, b"torn")
+    for cut in range(1, len(second)):
+        read = list(read_records(first + second[:cut]))
+        assert [entry[1] for entry in read] == [1]
+        assert read[-1][4] == len(first)
+
+
+def test_read_records_stops_at_bad_crc():
+    records = [encode_record(GENERAL, seq, 11, b"payload %d" % seq) for seq in (1, 2, 3)]
+    data = bytearray(b"".join(records))
+    # One flipped bit in the payload of the second record
+    data[len(records[0]) + len(records[1]) - 6] ^= 0x01
+    assert [entry[1] for entry in read_records(bytes(data))] == [1]
+
+
+# -- loading ----------------------------------------------------------------
+
+
+def test_load_empty_directory(tmp_path):
+    store, history, sequencer = open_store(tmp_path)
+    assert store.load() == {}
+    assert history.rooms() == [] and sequencer.current(GENERAL) == 0
+
+
+def test_load_delta_chain_and_log_tail(tmp_path):
+    # Each run logs more messages and leaves a delta snapshot behind,
+    # the last one stops without a snapshot, as a crash would
+    runs = [(GENERAL, 1, 50), (DM, 1, 20), (GENERAL, 51, 80), (DM, 21, 30)]
+    for i, (room, first, last) in enumerate(runs):
+        store, history, _ = open_store(tmp_path, full_every=100)
+        store.load()
+        store.meta["run"] = i
+        start(store, history)
+        post(history, room, first, last)
+        wait_for(lambda: not store._queue)
+        store.close(snapshot=i < len(runs) - 1)
+
+    names = os.listdir(tmp_path)
+    assert sum(name.startswith("full.") for name in names) == 1
+    assert sum(name.startswith("delta.") for name in names) == 3
+
+    store, history, sequencer = open_store(tmp_path)
+    assert store.load() == {"run": 2}
+    assert store.stats["snapshots"] == 4 and store.stats["replayed"] == 10
+    assert contents(history, GENERAL) == expected(GENERAL, 80)
+    assert contents(history, DM) == expected(DM, 30)
+    assert sequencer.current(GENERAL) == 80 and sequencer.current(DM) == 30
+    assert history.rooms_of("bob") == [GENERAL, DM]
+
+
+def test_full_snapshot_ends_the_chain(tmp_path):
+    # Snapshots the writer takes once 10 messages were logged, every
+    # second one full: it replaces the chain before it
+    chains = [[True, False], [True], [True, False]]
+    for first, chain in zip((1, 11, 21), chains):
+        store, history, _ = open_store(tmp_path, snapshot_records=10, full_every=2)
+        store.load()
+        start(store, history)
+        post(history, GENERAL, first, first + 9)
+        wait_for(lambda: [full for _, full in store._snapshots()] == chain)
+        store.close()
+
+    store, history, sequencer = open_store(tmp_path)
+    store.load()
+    assert store.stats["snapshots"] == 2 and store.stats["replayed"] == 0
+    assert contents(history, GENERAL) == expected(GENERAL, 30)
+    assert sequencer.current(GENERAL) == 30
+
+
+def test_log_tail_leaves_rooms_encoded(tmp_path):
+    store, history, _ = open_store(tmp_path)
+    store.load()
+    start(store, history)
+    post(history, GENERAL, 1, 8)
+    store.close()
+    store, history, _ = open_store(tmp_path)
+    store.load()
+    start(store, history)
+    post(history, GENERAL, 9, 12)
+    store.close(snapshot=False)
+
+    store, history, sequencer = open_store(tmp_path)
+    history.per_room = 10
+    store.load()
+    assert store.stats["replayed"] == 4
+    # Replaying the tail did not decode the room, a duplicate is still noticed
+    assert not isinstance(history._rooms[GENERAL], tuple)
+    assert history.last(GENERAL) == 12 and not history.append(GENERAL, 12, 11, b"again")
+    assert contents(history, GENERAL) == expected(GENERAL, 12)[-10:]
+    assert sequencer.current(GENERAL) == 12
+
+
+def test_load_after_torn_log(tmp_path):
+    store, history, _ = open_store(tmp_path)
+    store.load()
+    start(store, history)
+    post(history, GENERAL, 1, 10)
+    wait_for(lambda: not store._queue)
+    store.close(snapshot=False)
+
+    log_path = os.path.join(tmp_path, sorted(n for n in os.listdir(tmp_path) if n.startswith("log."))[-1])
+    with open(log_path, "r+b") as f:
+        f.truncate(os.path.getsize(log_path) - 3)
+
+    store, history, sequencer = open_store(tmp_path)
+    store.load()
+    assert contents(history, GENERAL) == expected(GENERAL, 9)
+    assert sequencer.current(GENERAL) == 9
+
+
+# -- handoff ----------------------------------------------------------------
+
+
+def handoff(tmp_path, snapshot):
+    old, old_history, _ = open_store(tmp_path)
+    old.load()
+    start(old, old_history)
+    post(old_history, GENERAL, 1, 10)
+    wait_for(lambda: not old._queue)
+
+    # The successor loads while the old server still writes
+    new, new_history, new_sequencer = open_store(tmp_path)
+    new.load()
+    assert new_sequencer.current(GENERAL) == 10
+    start(new, new_history, wait=False)
+    post(old_history, GENERAL, 11, 25)
+    post(old_history, DM, 1, 5)
+    wait_for(lambda: not old._queue)
+    old.close(snapshot=snapshot)
+
+    wait_for(lambda: new_sequencer.current(GENERAL) == 25)
+    assert contents(new_history, GENERAL) == expected(GENERAL, 25)
+    assert contents(new_history, DM) == expected(DM, 5)
+    assert new_sequencer.current(DM) == 5
+
+    # From now on the successor is the writer
+    wait_for(lambda: new._log is not None)
+    post(new_history, GENERAL, 26, 30)
+    wait_for(lambda: not new._queue)
+    new.close()
+    store, history, _ = open_store(tmp_path)
+    store.load()
+    assert contents(history, GENERAL) == expected(GENERAL, 30)
+
+
+def test_catch_up_from_log(tmp_path):
+    handoff(tmp_path, snapshot=False)
+
+
+def test_catch_up_from_snapshot(tmp_path):
+    handoff(tmp_path, snapshot=True)
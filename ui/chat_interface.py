@@ -33,11 +33,16 @@ from kivy.uix.image import Image
 import os
 import time
 
+from net.logs import UI, get_logger
+
 # Import your enhanced components
 from .components import MessageCard, MessageContainer, ChatHeader, MessageInputCard
+from .constants import SystemMessages
 from .login_dialog import LoginDialogManager
 from .sidebar import EnhancedSidebar
 
+log = get_logger(UI)
+
 
 class ModernChatInterface(MDScreen):
     """Modern chat interface with enhanced visual design."""
@@ -50,6 +55,8 @@ class ModernChatInterface(MDScreen):
         self.send_message_callback: Optional[Callable[[str], None]] = None
         self.send_file_callback: Optional[Callable[[str], None]] = None
         self.connect_callback: Optional[Callable[[str, str], bool]] = None
+        self.typing_callback: Optional[Callable[[str], None]] = None
+        self.typing_label = None
         self._active_users: List[str] = []
         self.app_logo = None
         self.logo_scale = None
@@ -330,7 +337,20 @@ class ModernChatInterface(MDScreen):
             bold=True
         )
         
+        # Typing indicator, fixed height so showing it never moves the layout
+        self.typing_label = MDLabel(
+            text="",
+            theme_text_color="Custom",
+            text_color=[0.6, 0.6, 0.6, 1],
+            font_size=sp(12),
+            italic=True,
+            shorten=True,
+            size_hint_y=None,
+            height=dp(16)
+        )
+        
         title_section.add_widget(chat_title)
+        title_section.add_widget(self.typing_label)
         
         # Right side info
         info_section = MDBoxLayout(
@@ -534,15 +554,18 @@ class ModernChatInterface(MDScreen):
         
         # Bind Enter key
         self.message_input.bind(on_text_validate=self.on_enter_pressed)
+        self.message_input.bind(text=self.on_input_text)
     
     # Enhanced callback methods
     def set_callbacks(self, send_message_callback: Callable[[str], None],
                      send_file_callback: Callable[[str], None],
-                     connect_callback: Callable[[str, str], bool]):
+                     connect_callback: Callable[[str, str], bool],
+                     typing_callback: Optional[Callable[[str], None]] = None):
         """Set callback functions."""
         self.send_message_callback = send_message_callback
         self.send_file_callback = send_file_callback
         self.connect_callback = connect_callback
+        self.typing_callback = typing_callback
     
     def show_login_dialog(self, default_username: str = "", default_host: str = "192.168.0.125"):
         """Show enhanced login dialog."""
@@ -667,6 +690,26 @@ class ModernChatInterface(MDScreen):
             self.message_input.text = ""
             self.message_input.focus = True
     
+    def on_input_text(self, instance, text):
+        """Report edits of the message input for typing indicators."""
+        if self.typing_callback:
+            self.typing_callback(text)
+    
+    def show_typing(self, users: List[str]):
+        """Show who is typing. Only the label text changes."""
+        if self.typing_label is None:
+            return
+        if not users:
+            text = ""
+        elif len(users) == 1:
+            text = SystemMessages.USER_TYPING.format(username=users[0])
+        elif len(users) <= 3:
+            text = f"{', '.join(users[:-1])} and {users[-1]} are typing..."
+        else:
+            text = "Several people are typing..."
+        if self.typing_label.text != text:
+            self.typing_label.text = text
+    
     def on_send_message(self, message: str):
         """Handle sending message."""
         if self.send_message_callback:
@@ -682,8 +725,8 @@ class ModernChatInterface(MDScreen):
         
         self.show_file_manager()
     
-    def display_message(self, username: str, content: str):
-        """Display message with error handling."""
+    def display_message(self, username: str, content: str) -> Optional[MessageCard]:
+        """Display message with error handling, returns the message card."""
         try:
             is_own_message = username == self.username
             
@@ -704,9 +747,11 @@ class ModernChatInterface(MDScreen):
             # Animate user activity in sidebar
             if username != self.username:
                 self.sidebar.animate_user_activity(username)
+            return message_card
             
         except Exception as e:
-            print(f"Message display error: {e}")
+            log.warning("message display error", extra={"error": str(e)})
+            return None
     
     def add_enhanced_system_message(self, message: str, msg_type: str = "info"):
         color_map = {
@@ -829,21 +874,19 @@ class ModernChatInterface(MDScreen):
     
     def user_joined(self, username: str):
         """Handle user joined with animation - USES SIDEBAR METHOD."""
-        print(f"DEBUG: User joined called with username: {username}")  # Debug print
         self.add_enhanced_system_message(f" {username} joined the chat", "info")
         self.add_active_user(username)  # This calls sidebar.add_active_user()
-        print(f"DEBUG: Active users after join: {self._active_users}")  # Debug print
+        log.debug("user joined", extra={"user": username, "active": len(self._active_users)})
     
     def user_left(self, username: str):
         """Handle user left with animation - USES SIDEBAR METHOD."""
-        print(f"DEBUG: User left called with username: {username}")  # Debug print
         self.add_enhanced_system_message(f" {username} left the chat", "warning")
         self.remove_active_user(username)  # This calls sidebar.remove_active_user()
-        print(f"DEBUG: Active users after leave: {self._active_users}")  # Debug print
+        log.debug("user left", extra={"user": username, "active": len(self._active_users)})
     
     def update_user_list(self, users: List[str]):
         """Update the entire user list - USES SIDEBAR METHOD."""
-        print(f"DEBUG: Updating user list with: {users}")  # Debug print
+        log.debug("user list replaced", extra={"count": len(users)})
         self._active_users = users.copy()
         
         # Clear sidebar and repopulate
@@ -855,7 +898,7 @@ class ModernChatInterface(MDScreen):
     
     def set_active_users(self, users: List[str]):
         """Set the active users list - USES SIDEBAR METHOD."""
-        print(f"DEBUG: Setting active users to: {users}")  # Debug print
+        log.debug("active users set", extra={"count": len(users)})
         self._active_users = users.copy()
         
         # Update sidebar's internal list and display
@@ -920,6 +963,10 @@ class ModernChatInterface(MDScreen):
     def update_sidebar_connection_time(self):
         """Update connection time in sidebar."""
         self.sidebar.update_connection_time()
+    
+    def update_latency(self, rtt_ms: float):
+        """Show heartbeat round-trip time in sidebar."""
+        self.sidebar.update_latency(rtt_ms)
 
 
 # Color scheme constants for consistent theming
@@ -26,6 +26,8 @@ class MessageCard(MDCard):
         self.username = username
         self.content = content
         self.is_own_message = is_own_message
+        self.sent_at = time.strftime('%H:%M')
+        self.status_label = None
 
         self.chat_width = chat_width or dp(400)
         
@@ -112,7 +114,7 @@ class MessageCard(MDCard):
         # Add timestamp for own messages at bottom
         if self.is_own_message:
             timestamp_label = MDLabel(
-                text=f"[color=#CCCCCC]{time.strftime('%H:%M')}[/color]",
+                text=f"[color=#CCCCCC]{self.sent_at}[/color]",
                 font_size=sp(5),
                 markup=True,
                 halign="right",
@@ -123,10 +125,16 @@ class MessageCard(MDCard):
                 text_color=[0.8, 0.8, 0.8, 1]
             )
             message_layout.add_widget(timestamp_label)
+            self.status_label = timestamp_label
         
         self.add_widget(message_layout)
         message_layout.bind(minimum_height=lambda instance, value: setattr(self, 'height', value + dp(24)))  
     
+    def set_status(self, status: str):
+        """Delivery state of an own message, e.g. "sent" or "seen"."""
+        if self.status_label is not None:
+            self.status_label.text = f"[color=#CCCCCC]{self.sent_at} · {status}[/color]"
+    
     def animate_entrance(self):
         """Add entrance animation to message cards."""
         self.opacity = 0
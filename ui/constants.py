@@ -255,9 +255,19 @@ MESSAGE_ENCODING = 'utf-8'
 
 # Connection Timeouts
 CONNECTION_TIMEOUT = 10.0
+DISCOVERED_CONNECT_TIMEOUT = 2.0  # servers heard on the LAN answer fast or not at all
 RECONNECTION_DELAY = 3.0
+RECONNECT_BASE_DELAY = 0.5  # first retry waits up to this, doubling per attempt
+RECONNECT_MAX_DELAY = 30.0  # cap of the randomized retry delay
 HEARTBEAT_INTERVAL = 30.0
 
+# TLS, used when Features.ENABLE_MESSAGE_ENCRYPTION is on
+TLS_CA_FILE = None  # certificate of the server or its CA, None trusts the system CAs
+TLS_VERIFY = True  # False encrypts without checking who the server is
+
+# End-to-end encryption, used when Features.ENABLE_END_TO_END_ENCRYPTION is on
+E2E_KEY_FILE = "identity.key"  # our private key, created on first use; None makes a new one every start
+
 # ============================================================================
 # FILE TRANSFER CONFIGURATION
 # ============================================================================
@@ -569,7 +579,10 @@ class Features:
     ENABLE_TYPING_INDICATORS = True
     
     # Advanced Features
-    ENABLE_MESSAGE_ENCRYPTION = False
+    ENABLE_AUTO_RECONNECT = True
+    ENABLE_SERVER_DISCOVERY = True
+    ENABLE_MESSAGE_ENCRYPTION = False  # TLS to the server, see TLS_CA_FILE
+    ENABLE_END_TO_END_ENCRYPTION = False  # chat text only readable by its recipients, needs `cryptography`
     ENABLE_VOICE_MESSAGES = False
     ENABLE_VIDEO_CALLS = False
 
@@ -167,6 +167,12 @@ class EnhancedLoginDialog(MDFloatLayout):
         )
         
         # IP address input with enhanced styling
+        self.ip_hint = MDTextFieldHintText(
+            text="Server IP address (e.g., 192.168.1.100)",
+            text_color_normal=[0.6, 0.6, 0.6, 1],
+            text_color_focus=[0.8, 0.8, 0.8, 1],
+        )
+        self._auto_host = None  # host filled in by discovery, not typed
         self.ip_input = MDTextField(
             MDTextFieldLeadingIcon(
                 icon="server-network",
@@ -174,11 +180,7 @@ class EnhancedLoginDialog(MDFloatLayout):
                 icon_color=[0.2, 0.6, 1.0, 1],
                 icon_color_focus=[0.3, 0.7, 1.0, 1],
             ),
-            MDTextFieldHintText(
-                text="Server IP address (e.g., 192.168.1.100)",
-                text_color_normal=[0.6, 0.6, 0.6, 1],
-                text_color_focus=[0.8, 0.8, 0.8, 1],
-            ),
+            self.ip_hint,
             MDTextFieldMaxLengthText(
                 max_text_length=15,
             ),
@@ -419,6 +421,24 @@ class EnhancedLoginDialog(MDFloatLayout):
             self.username_input.text = username
         if host:
             self.ip_input.text = host
+            self._auto_host = host
+    
+    def set_discovered_servers(self, servers):
+        """Prefill the least loaded server found on the network.
+        
+        Only replaces the host while it is empty or still a default we
+        filled in ourselves that is not among the live servers, never
+        something the user typed.
+        """
+        if not servers:
+            return
+        current = self.get_host()
+        live_hosts = [server.host for server in servers]
+        if not current or (current == self._auto_host and current not in live_hosts):
+            self._auto_host = servers[0].host
+            self.ip_input.text = servers[0].host
+        count = len(servers)
+        self.ip_hint.text = f"Server IP address ({count} server{'s' if count != 1 else ''} found nearby)"
     
     def focus_username_input(self):
         """Focus username input with highlight."""
@@ -439,6 +459,7 @@ class LoginDialogManager:
         self.parent_screen = parent_screen
         self.connect_callback = connect_callback
         self.dialog: Optional[EnhancedLoginDialog] = None
+        self.discovered_servers = []
     
     def show_login(self, default_username: str = "", default_host: str = "192.168.0.125"):
         """Show enhanced login dialog."""
@@ -451,6 +472,7 @@ class LoginDialogManager:
         # Create new dialog instance
         self.dialog = EnhancedLoginDialog(self.on_connect_requested)
         self.dialog.set_default_values(default_username, default_host)
+        self.dialog.set_discovered_servers(self.discovered_servers)
         
         # Add to parent screen
         self.parent_screen.add_widget(self.dialog)
@@ -458,6 +480,12 @@ class LoginDialogManager:
         # Focus username input after a short delay
         Clock.schedule_once(lambda dt: self.dialog.focus_username_input(), 0.8)
 
+    def offer_servers(self, servers):
+        """Servers found by discovery, least loaded first."""
+        self.discovered_servers = list(servers)
+        if self.dialog is not None:
+            self.dialog.set_discovered_servers(self.discovered_servers)
+    
     def hide_login(self):
         """Hide login dialog with exit animation."""
         if self.dialog and self.dialog.parent:
@@ -23,6 +23,7 @@ class EnhancedSidebar(MDBoxLayout):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.active_users: List[str] = []
+        self._user_items = {}  # username -> list item, for O(1) deltas
         self.current_username: Optional[str] = None
         self.current_status: str = "Offline"
         self.setup_sidebar()
@@ -313,6 +314,12 @@ class EnhancedSidebar(MDBoxLayout):
         
         self.users_layout.add_widget(self.empty_placeholder)
     
+    def _placeholder_if_empty(self):
+        """Deferred placeholder: a user may have joined in the meantime."""
+        shown = getattr(self, 'empty_placeholder', None) is not None and self.empty_placeholder.parent
+        if not self.active_users and not shown:
+            self.add_empty_state_placeholder()
+    
     def remove_empty_state_placeholder(self):
         """Remove empty state placeholder with animation."""
         if hasattr(self, 'empty_placeholder') and self.empty_placeholder.parent:
@@ -359,16 +366,49 @@ class EnhancedSidebar(MDBoxLayout):
             self.connection_info.text = "Ready to connect"
     
     def add_active_user(self, username: str):
-        """Add user to active list with staggered animation."""
-        if username not in self.active_users:
-            self.active_users.append(username)
-            self.update_users_display()
+        """Add a single user item without rebuilding the list."""
+        if username in self.active_users:
+            return
+        self.active_users.append(username)
+        
+        if hasattr(self, 'empty_placeholder'):
+            self.remove_empty_state_placeholder()
+        
+        user_item = self.create_enhanced_user_item(username)
+        user_item.opacity = 0
+        self._user_items[username] = user_item
+        self.users_layout.add_widget(user_item)
+        Animation(opacity=1, duration=0.4, t='out_cubic').start(user_item)
+        
+        self.update_user_count()
     
     def remove_active_user(self, username: str):
-        """Remove user from active list with fade animation."""
-        if username in self.active_users:
-            self.active_users.remove(username)
-            self.update_users_display()
+        """Remove a single user item with fade animation."""
+        if username not in self.active_users:
+            return
+        self.active_users.remove(username)
+        
+        user_item = self._user_items.pop(username, None)
+        if user_item is not None:
+            fade_out = Animation(opacity=0, duration=0.2)
+            fade_out.bind(
+                on_complete=lambda *x: self.users_layout.remove_widget(user_item)
+            )
+            fade_out.start(user_item)
+        
+        self.update_user_count()
+        if not self.active_users:
+            Clock.schedule_once(lambda dt: self._placeholder_if_empty(), 0.3)
+    
+    def update_user_count(self):
+        """Update the count badge with a bounce."""
+        count = len(self.active_users)
+        self.count_text.text = str(count)
+        
+        if count > 0:
+            bounce = Animation(opacity=0.5, duration=0.2)
+            bounce += Animation(opacity=1.0, duration=0.2)
+            bounce.start(self.users_count_badge)
     
     def update_users_display(self):
         """Update users display with enhanced animations."""
@@ -384,27 +424,25 @@ class EnhancedSidebar(MDBoxLayout):
                     on_complete=lambda anim, widget=child: self.users_layout.remove_widget(widget)
                 )
                 fade_out.start(child)
+        self._user_items.clear()
         
         # Update count with bounce animation
-        count = len(self.active_users)
-        self.count_text.text = str(count)
-        
-        if count > 0:
-            bounce = Animation(opacity=0.5, duration=0.2)
-            bounce += Animation(opacity=1.0, duration=0.2)
-            bounce.start(self.users_count_badge)
+        self.update_user_count()
         
         # Add users with staggered entrance
         Clock.schedule_once(lambda dt: self._add_users_with_animation(), 0.3)
         
         # Add empty state if no users
         if not self.active_users:
-            Clock.schedule_once(lambda dt: self.add_empty_state_placeholder(), 0.4)
+            Clock.schedule_once(lambda dt: self._placeholder_if_empty(), 0.4)
     
     def _add_users_with_animation(self):
             
-        for i, user in enumerate(self.active_users):
+        # Users a delta added since the snapshot already have their row
+        pending = [user for user in self.active_users if user not in self._user_items]
+        for i, user in enumerate(pending):
                 user_item = self.create_enhanced_user_item(user)
+                self._user_items[user] = user_item
                 self.users_layout.add_widget(user_item)
                 
                 # Set the initial state before the animation
@@ -428,6 +466,7 @@ class EnhancedSidebar(MDBoxLayout):
             spacing=dp(12),
             padding=[dp(12), dp(6), dp(12), dp(6)]
         )
+        user_container.username = username
         
         # Hover effect background
         hover_bg = MDCard(
@@ -504,6 +543,7 @@ class EnhancedSidebar(MDBoxLayout):
     def clear_users_list(self):
         """Clear all users with fade animation."""
         self.active_users.clear()
+        self._user_items.clear()
         
         # Fade out all user items
         for child in self.users_layout.children[:]:
@@ -518,7 +558,7 @@ class EnhancedSidebar(MDBoxLayout):
         self.count_text.text = "0"
         
         # Add empty placeholder after delay
-        Clock.schedule_once(lambda dt: self.add_empty_state_placeholder(), 0.4)
+        Clock.schedule_once(lambda dt: self._placeholder_if_empty(), 0.4)
     
     def get_active_users(self) -> List[str]:
         """Get list of active users."""
@@ -573,6 +613,12 @@ class EnhancedSidebar(MDBoxLayout):
                 activity_anim.start(child)
                 break
     
+    def update_latency(self, rtt_ms: float):
+        """Show the measured round-trip time next to the connection info."""
+        if self.current_status == "Online":
+            since = self.connection_info.text.split(" · ")[0]
+            self.connection_info.text = f"{since} · {rtt_ms:.0f} ms"
+    
     def update_connection_time(self):
         """Update connection time display."""
         if self.current_status == "Online" and self.current_username: